@@ -25,20 +25,38 @@ nxrxbot_complete_v3.py - بوت أرقام مجانية - النسخة المك
 import os
 import sqlite3
 import telebot
-from telebot import types
+from telebot import types, apihelper
+import requests
+from requests.adapters import HTTPAdapter
 import random
 import time
 import threading
+import queue
 from datetime import datetime, date, timedelta
 import re
 import logging
 import io
 import math
-from collections import defaultdict, deque
-from typing import Dict, List, Optional, Tuple, Any
+from collections import defaultdict, deque, OrderedDict
+from collections.abc import MutableMapping
+from typing import Dict, List, Optional, Tuple, Any, Callable, Mapping
 import json
 import hashlib
-from contextlib import contextmanager
+import zlib
+import html
+import bisect
+import heapq
+import hmac
+import ipaddress
+import signal
+import asyncio
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass
+from enum import IntEnum
+from types import MappingProxyType
 
 # ================================
 # تكوين البيئة والمتغيرات العامة  
@@ -50,6 +68,97 @@ ADMIN_ID = os.environ.get("ADMIN_ID", "7237912884")
 DB_PATH = os.environ.get("DB_PATH", "free_numbers_bot.db")
 PROOF_CHANNEL_DEFAULT = os.environ.get("PROOF_CHANNEL", "@RC_OPT")
 ACTIVATION_CHANNEL_DEFAULT = os.environ.get("ACTIVATION_CHANNEL", "@TRICKSMASTAR")
+# لقطة التخزين المؤقت المحفوظة عند الإيقاف (فارغ = معطل)
+CACHE_SNAPSHOT_PATH = os.environ.get("CACHE_SNAPSHOT_PATH", "")
+CACHE_SNAPSHOT_MAX_AGE = int(os.environ.get("CACHE_SNAPSHOT_MAX_AGE", "900"))
+# أنواع التحديثات المطلوبة من Telegram (chat_member لتتبع عضوية القنوات)
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+# التخزين المؤقت لعضوية القنوات (ثوانٍ) وعدد خيوط الفحص المتوازي
+MEMBERSHIP_POSITIVE_TTL = int(os.environ.get("MEMBERSHIP_POSITIVE_TTL", "600"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get("MEMBERSHIP_NEGATIVE_TTL", "15"))
+MEMBERSHIP_PROBE_WORKERS = int(os.environ.get("MEMBERSHIP_PROBE_WORKERS", "8"))
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "20000"))
+# محرك التشغيل: sync (TeleBot بخيوط) أو async (AsyncTeleBot مع منفذ لقاعدة البيانات)
+BOT_ENGINE = os.environ.get("BOT_ENGINE", "sync").strip().lower()
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "8"))
+# خيوط الإرسال للمحرك غير المتزامن (تنتظر دورها في OutboundScheduler دون حجب حلقة الأحداث)
+ASYNC_OUTBOUND_WORKERS = int(os.environ.get("ASYNC_OUTBOUND_WORKERS", "32"))
+# خيوط المعالجات المتزامنة غير المنقولة (لوحة التحكم، الإثباتات، الإدخال النصي) في المحرك غير المتزامن
+ASYNC_FALLBACK_WORKERS = int(os.environ.get("ASYNC_FALLBACK_WORKERS", "16"))
+# أقصى تحديثات Webhook قيد المعالجة في المحرك غير المتزامن قبل الرد بـ 503
+ASYNC_WEBHOOK_INFLIGHT = int(os.environ.get("ASYNC_WEBHOOK_INFLIGHT", "1000"))
+# موزع التحديثات: عدد الأجزاء (تحديثات المستخدم الواحد بالترتيب) وسعة طابور كل جزء
+DISPATCH_SHARDS = int(os.environ.get("DISPATCH_SHARDS", "8"))
+DISPATCH_QUEUE_SIZE = int(os.environ.get("DISPATCH_QUEUE_SIZE", "1000"))
+# أقصى انتظار لخيط Webhook عند امتلاء طابور الجزء قبل الرد بـ 503 (يعيد Telegram الإرسال لاحقاً)
+DISPATCH_SUBMIT_TIMEOUT = float(os.environ.get("DISPATCH_SUBMIT_TIMEOUT", "2"))
+# طريقة الاستقبال: polling أو webhook (خادم HTTP محلي خلف وكيل TLS)
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# SO_REUSEPORT: عدة عمليات (مع STATE_BACKEND=sqlite) تستمع على نفس المنفذ ويوزع النظام الاتصالات بينها
+WEBHOOK_REUSE_PORT = os.environ.get("WEBHOOK_REUSE_PORT", "0") == "1"
+
+# الاستقبال عبر getUpdates (وضع polling)
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "50"))
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", "100"))
+# فترة التحذير أثناء انتظار اكتمال الدفعة (الانتظار يستمر حتى الاكتمال قبل تأكيد offset)
+POLL_DRAIN_TIMEOUT = float(os.environ.get("POLL_DRAIN_TIMEOUT", "30"))
+# جدولة الطلبات الصادرة: الحد العام (رسالة/ثانية) وحد كل محادثة (خاصة/مجموعة أو قناة)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+# الإذاعة: حجم دفعة المؤشر (وحفظ التقدم) وعدد الإرسالات المتزامنة
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "200"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_SCHEDULER_INTERVAL = int(os.environ.get("BROADCAST_SCHEDULER_INTERVAL", "60"))
+
+# صندوق الإثباتات الصادر: دمج الإثباتات في منشور واحد عند تراكمها
+PROOF_DIGEST_THRESHOLD = int(os.environ.get("PROOF_DIGEST_THRESHOLD", "5"))
+PROOF_DIGEST_MAX = int(os.environ.get("PROOF_DIGEST_MAX", "10"))
+PROOF_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("PROOF_OUTBOX_MAX_ATTEMPTS", "10"))
+
+# طبقة نقل HTTP: requests (افتراضي) أو httpx مع HTTP/2 إن كان مثبتاً
+HTTP_BACKEND = os.environ.get("HTTP_BACKEND", "requests").lower()
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "20"))
+HTTP_POOL_INTERACTIVE = int(os.environ.get("HTTP_POOL_INTERACTIVE", str(DISPATCH_SHARDS + MEMBERSHIP_PROBE_WORKERS + 4)))
+HTTP_POOL_BULK = int(os.environ.get("HTTP_POOL_BULK", str(BROADCAST_CONCURRENCY + 2)))
+
+# قواطع الدائرة وإعادة المحاولة للطلبات الصادرة
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "15"))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.environ.get("CIRCUIT_MAX_OPEN_SECONDS", "300"))
+CHAT_CIRCUIT_THRESHOLD = int(os.environ.get("CHAT_CIRCUIT_THRESHOLD", "3"))
+CHAT_CIRCUIT_OPEN_SECONDS = float(os.environ.get("CHAT_CIRCUIT_OPEN_SECONDS", "600"))
+OUTBOUND_BACKOFF_BASE = float(os.environ.get("OUTBOUND_BACKOFF_BASE", "0.5"))
+OUTBOUND_BACKOFF_MAX = float(os.environ.get("OUTBOUND_BACKOFF_MAX", "10"))
+
+# حدود معدل المستخدمين لكل إجراء بصيغة "طلبات/ثوانٍ" (طلب الأرقام يتبع جدول الإعدادات)
+RATE_LIMIT_CHANGE = os.environ.get("RATE_LIMIT_CHANGE", "10/60")
+RATE_LIMIT_SEARCH = os.environ.get("RATE_LIMIT_SEARCH", "5/60")
+RATE_LIMIT_PROOF = os.environ.get("RATE_LIMIT_PROOF", "5/300")
+RATE_LIMIT_STRIPES = int(os.environ.get("RATE_LIMIT_STRIPES", "64"))
+# المهام الدورية: عدد خيوط التنفيذ ونسبة التذبذب العشوائي لمواعيدها
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_JITTER = float(os.environ.get("JOB_JITTER", "0.1"))
+# فترة فحص كومة انتهاء PRO (ثوانٍ) - الفحص نفسه لا يلمس قاعدة البيانات إن لم يحن موعد
+PRO_EXPIRY_TICK = float(os.environ.get("PRO_EXPIRY_TICK", "30"))
+# مخزن حالة الجلسات وحدود المعدل: memory (العملية الحالية) أو sqlite (ملف WAL مشترك بين عمليات الجهاز)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").strip().lower()
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.db")
+# تنسيق العمليات عند المخزن المشترك: فترة فحص أجيال التخزين المؤقت وتجديد القيادة، ومدة عقد القيادة (ثوانٍ)
+STATE_SYNC_INTERVAL = float(os.environ.get("STATE_SYNC_INTERVAL", "2"))
+LEADER_LEASE_TTL = float(os.environ.get("LEADER_LEASE_TTL", "15"))
+# الثقة في ترويسات X-Forwarded-* من الوكيل، وقصر المصدر على شبكات Telegram
+WEBHOOK_TRUST_PROXY = os.environ.get("WEBHOOK_TRUST_PROXY", "1") == "1"
+WEBHOOK_CHECK_SOURCE_IP = os.environ.get("WEBHOOK_CHECK_SOURCE_IP", "0") == "1"
 
 # التحقق من وجود المتغيرات الإجبارية
 if not BOT_TOKEN:
@@ -81,29 +190,1346 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ================================
+# موزع التحديثات المجزأ حسب المستخدم
+# ================================
+
+# الحقول التي قد يحمل فيها التحديث مرسلاً أو محادثة
+UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'chat_member', 'my_chat_member',
+    'inline_query', 'chosen_inline_result', 'channel_post', 'edited_channel_post',
+    'chat_join_request', 'pre_checkout_query', 'shipping_query', 'poll_answer'
+)
+
+def update_shard_key(update) -> int:
+    """مفتاح التوزيع: معرف المستخدم المرسل أو المحادثة أو رقم التحديث"""
+    for field in UPDATE_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is None:
+            continue
+        user = getattr(obj, 'from_user', None) or getattr(obj, 'user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(obj, 'chat', None)
+        if chat is not None:
+            return chat.id
+    return update.update_id
+
+class ShardedDispatcher:
+    """توزيع المهام على طوابير ثابتة حسب المفتاح: نفس المفتاح بالترتيب، مفاتيح مختلفة بالتوازي"""
+    
+    def __init__(self, shards: int, queue_size: int):
+        self.shards = max(1, shards)
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(self.shards)]
+        self.stats_lock = threading.Lock()
+        self.shard_stats = [
+            {'processed': 0, 'errors': 0, 'dropped': 0, 'total_wait': 0.0, 'total_run': 0.0, 'max_run': 0.0}
+            for _ in range(self.shards)
+        ]
+        self.workers = []
+    
+    def start(self):
+        """تشغيل خيوط الأجزاء"""
+        if self.workers:
+            return
+        for index in range(self.shards):
+            worker = threading.Thread(target=self._worker, args=(index,), name=f"shard-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def submit(self, key: int, func: Callable, *args, timeout: Optional[float] = None) -> bool:
+        """إضافة مهمة لطابور الجزء الخاص بالمفتاح
+        
+        timeout=None ينتظر حتى يتوفر مكان (ضغط عكسي على حلقة polling)، وغير ذلك
+        يعيد False عند بقاء الطابور ممتلئاً بعد المهلة بدلاً من حجز خيط المستدعي.
+        """
+        index = hash(key) % self.shards
+        try:
+            self.queues[index].put((time.time(), func, args), timeout=timeout)
+            return True
+        except queue.Full:
+            with self.stats_lock:
+                self.shard_stats[index]['dropped'] += 1
+            return False
+    
+    def _worker(self, index: int):
+        """حلقة تنفيذ مهام جزء واحد بالترتيب"""
+        tasks = self.queues[index]
+        stats = self.shard_stats[index]
+        while True:
+            item = tasks.get()
+            if item is None:
+                break
+            queued_at, func, args = item
+            started = time.time()
+            failed = False
+            try:
+                func(*args)
+            except Exception as e:
+                failed = True
+                logger.error(f"❌ خطأ في معالجة تحديث في الجزء {index}: {e}")
+            finally:
+                elapsed = time.time() - started
+                with self.stats_lock:
+                    stats['processed'] += 1
+                    stats['errors'] += failed
+                    stats['total_wait'] += started - queued_at
+                    stats['total_run'] += elapsed
+                    stats['max_run'] = max(stats['max_run'], elapsed)
+                tasks.task_done()
+    
+    def wait_idle(self, timeout: float) -> bool:
+        """انتظار انتهاء كل المهام المرسلة حتى الآن - False عند انقضاء المهلة"""
+        deadline = time.time() + timeout
+        for tasks in self.queues:
+            with tasks.all_tasks_done:
+                while tasks.unfinished_tasks:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    tasks.all_tasks_done.wait(remaining)
+        return True
+    
+    def stop(self, timeout: float = 10.0):
+        """إنهاء الخيوط بعد تفريغ الطوابير"""
+        for tasks in self.queues:
+            tasks.put(None)
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(0.0, deadline - time.time()))
+        self.workers = []
+    
+    def stats(self) -> List[Dict]:
+        """عمق الطابور وزمن الانتظار والتنفيذ لكل جزء"""
+        with self.stats_lock:
+            snapshot = [dict(stats) for stats in self.shard_stats]
+        for index, stats in enumerate(snapshot):
+            processed = stats['processed'] or 1
+            stats['shard'] = index
+            stats['depth'] = self.queues[index].qsize()
+            stats['avg_wait'] = stats['total_wait'] / processed
+            stats['avg_run'] = stats['total_run'] / processed
+        return snapshot
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot يمرر كل تحديث لجزء المستخدم بدلاً من مجمع الخيوط العام"""
+    
+    def __init__(self, token: str, dispatcher: ShardedDispatcher, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = dispatcher
+    
+    def process_new_updates(self, updates):
+        for update in updates:
+            self.dispatcher.submit(update_shard_key(update), self.process_update, update)
+    
+    def enqueue_update(self, update) -> bool:
+        """إدخال تحديث Webhook دون حجز خيط الخادم (False = الجزء مزدحم)"""
+        return self.dispatcher.submit(update_shard_key(update), self.process_update, update,
+                                      timeout=DISPATCH_SUBMIT_TIMEOUT)
+    
+    def process_update(self, update):
+        """معالجة تحديث واحد داخل جزء المستخدم"""
+        user_id = interaction_user_id(update)
+        if user_id is not None:
+            note_user_interaction(user_id)
+            segment_index.touch(user_id)
+        super().process_new_updates([update])
+
 # إنشاء كائن البوت
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+update_dispatcher = ShardedDispatcher(DISPATCH_SHARDS, DISPATCH_QUEUE_SIZE)
+bot = DispatchingTeleBot(BOT_TOKEN, update_dispatcher, parse_mode="HTML")
+
+# ================================
+# طبقة نقل HTTP إلى Bot API
+# ================================
+
+class HttpxResponse:
+    """واجهة requests.Response التي يحتاجها apihelper فوق استجابة httpx"""
+    
+    __slots__ = ('raw',)
+    
+    def __init__(self, raw):
+        self.raw = raw
+    
+    @property
+    def status_code(self) -> int:
+        return self.raw.status_code
+    
+    @property
+    def reason(self) -> str:
+        return self.raw.reason_phrase
+    
+    @property
+    def text(self) -> str:
+        return self.raw.text
+    
+    def json(self):
+        return self.raw.json()
+
+class TelegramTransport:
+    """جلسات keep-alive منفصلة لكل نوع حركة (polling / interactive / bulk) مع زمن كل طريقة API"""
+    
+    POOLS = ('polling', 'interactive', 'bulk')
+    
+    def __init__(self, backend: str, pool_sizes: Dict[str, int], connect_timeout: float, read_timeout: float):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.sessions = {pool: self._requests_session(pool_sizes[pool]) for pool in self.POOLS}
+        self.httpx = None
+        self.clients = {}
+        if backend == "httpx":
+            self._init_httpx(pool_sizes)
+        self.backend = "httpx" if self.clients else "requests"
+        self.lock = threading.Lock()
+        self.pool_calls = {pool: 0 for pool in self.POOLS}
+        self.endpoints: Dict[str, Dict[str, float]] = defaultdict(lambda: {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+    
+    @staticmethod
+    def _requests_session(size: int) -> requests.Session:
+        """جلسة requests بمجمع اتصالات بحجم عدد الخيوط التي تستخدمها (بدون إعادة محاولة على مستوى urllib3)"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, size), max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    def _init_httpx(self, pool_sizes: Dict[str, int]):
+        try:
+            import httpx
+            import h2  # noqa: F401 - مطلوب لـ http2=True
+        except ImportError:
+            logger.warning("⚠️ HTTP_BACKEND=httpx يتطلب تثبيت httpx[http2] - سيتم استخدام requests")
+            return
+        self.httpx = httpx
+        self.clients = {
+            pool: httpx.Client(http2=True, limits=httpx.Limits(max_connections=max(1, size),
+                                                               max_keepalive_connections=max(1, size)))
+            for pool, size in pool_sizes.items()
+        }
+    
+    def _timeout(self, pool: str, timeout, files) -> Tuple[float, float]:
+        # getUpdates يحتاج مهلة قراءة أطول من long polling، والرفع يحتفظ بمهلة apihelper
+        if pool == 'polling' or files:
+            return timeout or (self.connect_timeout, self.read_timeout)
+        return self.connect_timeout, self.read_timeout
+    
+    def request(self, pool: str, method, url, params=None, files=None, timeout=None, proxies=None):
+        """تنفيذ طلب عبر مجمع الاتصالات المحدد وتسجيل زمنه"""
+        method_name = url.rsplit('/', 1)[-1]
+        connect_timeout, read_timeout = self._timeout(pool, timeout, files)
+        client = self.clients.get(pool)
+        failed = True
+        started = time.monotonic()
+        try:
+            if client is not None and not proxies:
+                try:
+                    response = HttpxResponse(client.request(
+                        method.upper(), url, params=params, files=files,
+                        timeout=self.httpx.Timeout(read_timeout, connect=connect_timeout)))
+                except self.httpx.ReadTimeout as e:
+                    # توحيد أخطاء النقل مع requests ليصنفها طبقة المرونة بنفس الطريقة
+                    raise requests.exceptions.ReadTimeout(str(e)) from e
+                except self.httpx.TransportError as e:
+                    raise requests.exceptions.ConnectionError(str(e)) from e
+            else:
+                response = self.sessions[pool].request(method, url, params=params, files=files,
+                                                       timeout=(connect_timeout, read_timeout), proxies=proxies)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            self._record(pool, method_name, time.monotonic() - started, failed)
+    
+    def _record(self, pool: str, method_name: str, elapsed: float, failed: bool):
+        with self.lock:
+            self.pool_calls[pool] += 1
+            stats = self.endpoints[method_name]
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+    
+    def stats_snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            endpoints = {name: dict(stats, avg=stats['total'] / (stats['calls'] or 1))
+                         for name, stats in self.endpoints.items()}
+            return {'backend': self.backend, 'pools': dict(self.pool_calls), 'endpoints': endpoints}
+
+telegram_transport = TelegramTransport(
+    HTTP_BACKEND,
+    {'polling': 2, 'interactive': HTTP_POOL_INTERACTIVE, 'bulk': HTTP_POOL_BULK},
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+)
+
+# ================================
+# مرونة طلبات Telegram (قواطع الدائرة)
+# ================================
+
+# أخطاء تعني أن المحادثة نفسها لا تقبل الرسائل (وليس الطلب)
+CHAT_FAILURE_MARKERS = (
+    'chat not found', 'bot was blocked', 'bot was kicked', 'user is deactivated',
+    'not enough rights', 'have no rights', 'need administrator rights', 'peer_id_invalid'
+)
+
+class CircuitOpenError(Exception):
+    """رفض طلب محلياً لأن دائرة الطريقة أو المحادثة مفتوحة"""
+    
+    def __init__(self, method_name: str, chat_id, retry_in: float):
+        self.method_name = method_name
+        self.chat_id = chat_id
+        self.retry_in = retry_in
+        target = f"المحادثة {chat_id}" if chat_id is not None else f"الطريقة {method_name}"
+        super().__init__(f"دائرة {target} مفتوحة، إعادة المحاولة بعد {retry_in:.0f} ثانية")
+
+class CircuitBreaker:
+    """closed ← open بعد فشل متتالٍ ← half-open بطلب تجريبي واحد، مع مضاعفة مدة الفتح"""
+    
+    PROBE_TIMEOUT = 30
+    
+    def __init__(self, threshold: int, open_seconds: float, max_open_seconds: float):
+        self.threshold = threshold
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probe_started = 0.0
+        self.touched = time.monotonic()
+    
+    @property
+    def is_open(self) -> bool:
+        return self.opened_until > 0
+    
+    def allow(self, now: float) -> float:
+        """0 إذا سُمح بالطلب، وإلا الثواني المتبقية"""
+        self.touched = now
+        if not self.opened_until:
+            return 0.0
+        if now < self.opened_until:
+            return self.opened_until - now
+        # half-open: طلب تجريبي واحد في كل مرة
+        if self.probe_started and now - self.probe_started < self.PROBE_TIMEOUT:
+            return 1.0
+        self.probe_started = now
+        return 0.0
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probe_started = 0.0
+        self.open_seconds = self.base_open_seconds
+    
+    def record_failure(self, now: float) -> bool:
+        """تسجيل فشل - True إذا فُتحت الدائرة الآن"""
+        self.failures += 1
+        self.touched = now
+        if self.probe_started:
+            # فشل الطلب التجريبي: فتح لمدة أطول
+            self.open_seconds = min(self.max_open_seconds, self.open_seconds * 2)
+        elif self.failures < self.threshold:
+            return False
+        self.opened_until = now + self.open_seconds * random.uniform(0.9, 1.1)
+        self.probe_started = 0.0
+        return True
+
+class TelegramResilience:
+    """تصنيف نتائج الطلبات (ok / rate_limited / retryable / permanent) وقواطع لكل طريقة ولكل محادثة"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints: Dict[str, CircuitBreaker] = {}
+        self.chats: Dict[str, CircuitBreaker] = {}
+        self.stats = {'short_circuited': 0, 'retries': 0, 'opened': 0}
+    
+    def check(self, method_name: str, chat_id=None):
+        """رفع CircuitOpenError إذا كانت دائرة الطريقة أو المحادثة مفتوحة"""
+        now = time.monotonic()
+        with self.lock:
+            breaker = self.endpoints.get(method_name)
+            wait = breaker.allow(now) if breaker else 0.0
+            if wait:
+                self.stats['short_circuited'] += 1
+                raise CircuitOpenError(method_name, None, wait)
+            breaker = self.chats.get(str(chat_id)) if chat_id is not None else None
+            wait = breaker.allow(now) if breaker else 0.0
+            if wait:
+                self.stats['short_circuited'] += 1
+                raise CircuitOpenError(method_name, chat_id, wait)
+    
+    @staticmethod
+    def classify(status: Optional[int]) -> str:
+        if status is None or status >= 500:
+            return 'retryable'
+        if status == 429:
+            return 'rate_limited'
+        if status >= 400:
+            return 'permanent'
+        return 'ok'
+    
+    def record(self, method_name: str, chat_id, status: Optional[int], description: str = '') -> str:
+        """تحديث القواطع بنتيجة طلب (status=None لأخطاء الشبكة) وإرجاع تصنيفها"""
+        kind = self.classify(status)
+        now = time.monotonic()
+        with self.lock:
+            if kind == 'retryable':
+                breaker = self.endpoints.setdefault(
+                    method_name, CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_MAX_OPEN_SECONDS))
+                if breaker.record_failure(now):
+                    self.stats['opened'] += 1
+                    logger.warning(f"🔌 فتح دائرة {method_name} بعد {breaker.failures} فشل متتالٍ")
+            elif kind != 'rate_limited' and method_name in self.endpoints:
+                self.endpoints[method_name].record_success()
+            
+            if chat_id is None:
+                return kind
+            key = str(chat_id)
+            chat_failure = kind == 'permanent' and (
+                status == 403 or any(marker in description.lower() for marker in CHAT_FAILURE_MARKERS))
+            if chat_failure:
+                breaker = self.chats.setdefault(
+                    key, CircuitBreaker(CHAT_CIRCUIT_THRESHOLD, CHAT_CIRCUIT_OPEN_SECONDS, CHAT_CIRCUIT_OPEN_SECONDS))
+                if breaker.record_failure(now):
+                    self.stats['opened'] += 1
+                    logger.warning(f"🔌 فتح دائرة المحادثة {chat_id}: {description}")
+            elif kind == 'ok' and key in self.chats:
+                self.chats[key].record_success()
+        return kind
+    
+    def open_wait(self) -> float:
+        """أطول مدة متبقية لدائرة طريقة مفتوحة (لإيقاف الإذاعات مؤقتاً)"""
+        now = time.monotonic()
+        with self.lock:
+            return max((breaker.opened_until - now for breaker in self.endpoints.values()
+                        if breaker.opened_until > now), default=0.0)
+    
+    def backoff(self, failures: int) -> float:
+        """انتظار أسي مع jitter كامل"""
+        with self.lock:
+            self.stats['retries'] += 1
+        return random.uniform(0, min(OUTBOUND_BACKOFF_MAX, OUTBOUND_BACKOFF_BASE * 2 ** failures))
+    
+    def purge(self) -> int:
+        """حذف قواطع المحادثات المغلقة غير النشطة"""
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, breaker in self.chats.items()
+                    if not breaker.is_open and now - breaker.touched > 3600]
+            for key in idle:
+                del self.chats[key]
+        return len(idle)
+    
+    def stats_snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self.lock:
+            return dict(
+                self.stats,
+                open_endpoints=[name for name, breaker in self.endpoints.items() if breaker.opened_until > now],
+                open_chats=sum(1 for breaker in self.chats.values() if breaker.opened_until > now)
+            )
+
+telegram_resilience = TelegramResilience()
+
+def response_description(response) -> str:
+    """وصف الخطأ من استجابة Bot API (فارغ إن لم تكن JSON)"""
+    try:
+        return str(response.json().get('description', ''))
+    except ValueError:
+        return ''
+
+# ================================
+# جدولة الطلبات الصادرة إلى Telegram
+# ================================
+
+# مسارات الأولوية (الأصغر أولاً)
+LANE_INTERACTIVE = 0
+LANE_PROOF = 1
+LANE_BROADCAST = 2
+LANE_NAMES = {LANE_INTERACTIVE: "تفاعلي", LANE_PROOF: "إثباتات", LANE_BROADCAST: "إذاعة"}
+
+# طرق API التي تُحسب ضمن حدود الإرسال (answerCallbackQuery وgetUpdates خارج الجدولة)
+SCHEDULED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument', 'sendAnimation', 'sendAudio',
+    'sendVoice', 'sendSticker', 'sendMediaGroup', 'copyMessage', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup', 'editMessageMedia'
+}
+
+_outbound_context = threading.local()
+
+class outbound_lane:
+    """تحديد مسار الأولوية لطلبات الخيط الحالي: with outbound_lane(LANE_BROADCAST): ..."""
+    
+    def __init__(self, lane: int):
+        self.lane = lane
+    
+    def __enter__(self):
+        self.previous = getattr(_outbound_context, 'lane', LANE_INTERACTIVE)
+        _outbound_context.lane = self.lane
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        _outbound_context.lane = self.previous
+        return False
+
+class OutboundScheduler:
+    """دلو رموز عام + دلو لكل محادثة، مع أولوية المسارات واحترام retry_after"""
+    
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, group_rate: float, max_retries: int):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.cond = threading.Condition()
+        self.tokens = global_rate
+        self.updated = time.monotonic()
+        self.chat_buckets = {}  # {chat_id: [tokens, updated, paused_until]}
+        self.paused_until = [0.0, 0.0, 0.0]  # إيقاف مؤقت لكل مسار بعد 429
+        self.contending = [0, 0, 0]
+        self.stats = {lane: {'sent': 0, 'total_wait': 0.0, 'max_wait': 0.0, 'retry_after': 0} for lane in LANE_NAMES}
+    
+    def _chat_limits(self, chat_id) -> Tuple[float, float]:
+        """(المعدل، السعة) لمحادثة: الخاصة أسرع من المجموعات والقنوات"""
+        # apihelper يمرر chat_id كنص ("123" أو "-100..." أو "@channel")
+        try:
+            is_private = int(chat_id) > 0
+        except (TypeError, ValueError):
+            is_private = False
+        if is_private:
+            return self.chat_rate, self.chat_burst
+        return self.group_rate, 1.0
+    
+    def _chat_wait(self, chat_id, now: float) -> float:
+        """الوقت المتبقي حتى يتوفر رمز للمحادثة"""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            return 0.0
+        rate, burst = self._chat_limits(chat_id)
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if now < bucket[2]:
+            return bucket[2] - now
+        return 0.0 if bucket[0] >= 1 else (1 - bucket[0]) / rate
+    
+    def acquire(self, lane: int, chat_id=None):
+        """انتظار دور الطلب: حد المحادثة أولاً ثم الحد العام بترتيب الأولوية"""
+        started = time.monotonic()
+        registered = False
+        with self.cond:
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._chat_wait(chat_id, now) if chat_id is not None else 0.0
+                    if wait <= 0:
+                        if not registered:
+                            self.contending[lane] += 1
+                            registered = True
+                        self.tokens = min(self.global_rate, self.tokens + (now - self.updated) * self.global_rate)
+                        self.updated = now
+                        if now < self.paused_until[lane]:
+                            wait = self.paused_until[lane] - now
+                        elif any(self.contending[higher] for higher in range(lane)):
+                            wait = 1 / self.global_rate
+                        elif self.tokens < 1:
+                            wait = (1 - self.tokens) / self.global_rate
+                        else:
+                            self.tokens -= 1
+                            if chat_id is not None:
+                                rate, burst = self._chat_limits(chat_id)
+                                bucket = self.chat_buckets.setdefault(chat_id, [burst, now, 0.0])
+                                bucket[0] -= 1
+                            break
+                    self.cond.wait(wait)
+            finally:
+                if registered:
+                    self.contending[lane] -= 1
+                self.cond.notify_all()
+            
+            waited = time.monotonic() - started
+            stats = self.stats[lane]
+            stats['sent'] += 1
+            stats['total_wait'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+    
+    def lane_pause(self, lane: int) -> float:
+        """الثواني المتبقية من إيقاف المسار بعد 429 (0 إن لم يكن موقوفاً)"""
+        with self.cond:
+            return max(0.0, self.paused_until[lane] - time.monotonic())
+    
+    def retry_after(self, lane: int, chat_id, seconds: float):
+        """تسجيل 429: إيقاف المحادثة، وإيقاف هذا المسار والمسارات الأدنى أولوية"""
+        until = time.monotonic() + seconds
+        with self.cond:
+            self.stats[lane]['retry_after'] += 1
+            if chat_id is not None:
+                bucket = self.chat_buckets.setdefault(chat_id, [0.0, time.monotonic(), 0.0])
+                bucket[2] = max(bucket[2], until)
+            for lower in range(lane, len(self.paused_until)):
+                self.paused_until[lower] = max(self.paused_until[lower], until)
+            self.cond.notify_all()
+    
+    def purge(self):
+        """حذف دلاء المحادثات الممتلئة (غير النشطة)"""
+        now = time.monotonic()
+        with self.cond:
+            idle = [chat_id for chat_id, bucket in self.chat_buckets.items()
+                    if now >= bucket[2] and now - bucket[1] > 60]
+            for chat_id in idle:
+                del self.chat_buckets[chat_id]
+        return len(idle)
+    
+    def send(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """بديل مرسل الطلبات في apihelper: جدولة طرق الإرسال، قواطع الدائرة، وإعادة المحاولة"""
+        method_name = url.rsplit('/', 1)[-1]
+        if method_name == 'getUpdates':
+            # حلقة الاستقبال تدير انتظارها بنفسها
+            return telegram_transport.request('polling', method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        
+        scheduled = method_name in SCHEDULED_METHODS
+        lane = getattr(_outbound_context, 'lane', LANE_INTERACTIVE)
+        pool = 'bulk' if scheduled and lane != LANE_INTERACTIVE else 'interactive'
+        chat_id = (params or {}).get('chat_id')
+        # المستخدم ينتظر الطلبات التفاعلية: محاولة إضافية واحدة فقط
+        max_failures = 1 if lane == LANE_INTERACTIVE else self.max_retries
+        # إعادة الإرسال بعد انقطاع القراءة قد تكرر الرسالة
+        non_idempotent = method_name.startswith('send') or method_name in ('copyMessage', 'forwardMessage')
+        attempt = failures = 0
+        while True:
+            telegram_resilience.check(method_name, chat_id)
+            if scheduled:
+                self.acquire(lane, chat_id)
+            try:
+                response = telegram_transport.request(pool, method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            except requests.exceptions.RequestException as e:
+                telegram_resilience.record(method_name, chat_id, None)
+                unsafe = non_idempotent and not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout))
+                if unsafe or failures >= max_failures:
+                    raise
+                failures += 1
+                time.sleep(telegram_resilience.backoff(failures))
+                continue
+            
+            description = response_description(response) if response.status_code >= 400 else ''
+            kind = telegram_resilience.record(method_name, chat_id, response.status_code, description)
+            if kind == 'retryable' and failures < max_failures:
+                failures += 1
+                time.sleep(telegram_resilience.backoff(failures))
+                continue
+            if kind != 'rate_limited' or not scheduled or attempt >= self.max_retries:
+                return response
+            try:
+                retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+            except ValueError:
+                retry_after = 1.0
+            attempt += 1
+            logger.warning(f"⏳ تجاوز حد Telegram في {method_name} (المسار {LANE_NAMES[lane]}): إعادة بعد {retry_after:.0f} ثانية")
+            self.retry_after(lane, chat_id, retry_after)
+    
+    def stats_snapshot(self) -> Dict[int, Dict]:
+        """إحصائيات المسارات مع عدد المنتظرين"""
+        with self.cond:
+            snapshot = {lane: dict(stats) for lane, stats in self.stats.items()}
+            for lane, stats in snapshot.items():
+                stats['waiting'] = self.contending[lane]
+                stats['avg_wait'] = stats['total_wait'] / (stats['sent'] or 1)
+            return snapshot
+
+outbound_scheduler = OutboundScheduler(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE, OUTBOUND_MAX_RETRIES
+)
+apihelper.CUSTOM_REQUEST_SENDER = outbound_scheduler.send
+
+# ================================
+# مخزن الحالة القابل للتبديل (State Backend)
+# ================================
+
+class _RateStripe:
+    """شريحة من جدول الحدود بقفلها الخاص وجيلين من المفاتيح"""
+    __slots__ = ("lock", "current", "previous", "rotated_at")
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current: Dict[int, float] = {}
+        self.previous: Dict[int, float] = {}
+        self.rotated_at = time.monotonic()
+
+# مدة صلاحية كل نوع من جلسات المستخدمين (ثوانٍ منذ آخر timestamp في الجلسة)
+SESSION_TTLS = {"browse": 3600, "proof": 1800, "pattern": 900, "premium": 1800}
+
+class SessionState(IntEnum):
+    """ما ينتظره البوت من رسالة المستخدم النصية التالية"""
+    IDLE = 0
+    AWAITING_PROOF = 1
+    AWAITING_PATTERN = 2
+
+# مساحات الأسماء التي تمثل حالة انتظار (حصرية: تعيين إحداها يلغي الأخرى)
+INPUT_NAMESPACES = {"proof": SessionState.AWAITING_PROOF, "pattern": SessionState.AWAITING_PATTERN}
+NAMESPACE_BITS = {"browse": 1, "proof": 2, "pattern": 4, "premium": 8}
+
+class UserSession:
+    """جلسة المستخدم الموحدة: حالة الانتظار وبياناتها، التصفح، والأرقام المميزة"""
+    __slots__ = ("state", "pending", "browse", "premium", "timers")
+    
+    def __init__(self):
+        self.state = SessionState.IDLE
+        self.pending: Optional[Dict] = None
+        self.browse: Optional[Dict] = None
+        self.premium: Optional[Dict] = None
+        self.timers = 0  # أقنعة مساحات الأسماء التي لها مؤقت في العجلة
+    
+    def record(self, namespace: str) -> Optional[Dict]:
+        state = INPUT_NAMESPACES.get(namespace)
+        if state is not None:
+            return self.pending if self.state == state else None
+        return getattr(self, namespace)
+    
+    def assign(self, namespace: str, value: Optional[Dict]):
+        """تعيين جزء من الجلسة (None = حذفه)"""
+        state = INPUT_NAMESPACES.get(namespace)
+        if state is None:
+            setattr(self, namespace, value)
+        elif value is not None:
+            self.state, self.pending = state, value
+        elif self.state == state:
+            self.state, self.pending = SessionState.IDLE, None
+    
+    def is_empty(self) -> bool:
+        return self.state == SessionState.IDLE and self.browse is None and self.premium is None
+
+class TimingWheel:
+    """عجلة توقيت هرمية: الجدولة O(1) والتقدم O(المنتهي + المُنزل من المستويات العليا)
+    
+    المستوى 0 خانات بدقة resolution، وكل مستوى أعلى يغطي دورة كاملة مما تحته.
+    """
+    
+    def __init__(self, resolution: float = 1.0, slots: int = 64, levels: int = 3):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.wheels: List[List[List[Tuple[int, Any]]]] = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.tick = int(time.time() / resolution)
+        self.pending = 0
+    
+    def schedule(self, deadline: float, item: Any):
+        """جدولة عنصر ليُعاد عند تجاوز deadline (لا يُعاد قبل موعده أبداً)"""
+        self._place(max(math.ceil(deadline / self.resolution), self.tick + 1), item)
+        self.pending += 1
+    
+    def _place(self, due: int, item: Any):
+        delta = due - self.tick
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1) or level == self.levels - 1:
+                self.wheels[level][(due // self.slots ** level) % self.slots].append((due, item))
+                return
+    
+    def advance(self, now: float) -> List[Any]:
+        """تحريك العجلة حتى now وإرجاع العناصر المستحقة"""
+        target = int(now / self.resolution)
+        due_items = []
+        while self.tick < target:
+            self.tick += 1
+            # إنزال خانة المستوى الأعلى عند اكتمال دورة ما تحته
+            for level in range(1, self.levels):
+                span = self.slots ** level
+                if self.tick % span:
+                    break
+                slot = (self.tick // span) % self.slots
+                bucket, self.wheels[level][slot] = self.wheels[level][slot], []
+                for due, item in bucket:
+                    self._place(due, item)
+            slot = self.tick % self.slots
+            bucket, self.wheels[0][slot] = self.wheels[0][slot], []
+            for due, item in bucket:
+                if due <= self.tick:
+                    due_items.append(item)
+                else:
+                    self._place(due, item)
+        self.pending -= len(due_items)
+        return due_items
+
+class MemoryStateBackend:
+    """الحالة في ذاكرة العملية الحالية (الافتراضي - لا تُشارك ولا تبقى بعد إعادة التشغيل)
+    
+    جلسة واحدة بـ __slots__ لكل مستخدم، وانتهاء الصلاحية عبر عجلة توقيت بدل المسح الكامل.
+    """
+    
+    name = "memory"
+    
+    def __init__(self, stripes: int = 64):
+        self._sessions: Dict[int, UserSession] = {}
+        self._lock = threading.Lock()
+        self._wheel = TimingWheel()
+        self._stripes = [_RateStripe() for _ in range(max(1, stripes))]
+    
+    def _arm(self, key: int, session: UserSession, namespace: str, record: Dict):
+        """مؤقت واحد على الأكثر لكل (مستخدم، مساحة) - يُعاد فحصه عند حلول موعده"""
+        bit = NAMESPACE_BITS[namespace]
+        if not session.timers & bit:
+            session.timers |= bit
+            self._wheel.schedule(record.get("timestamp", 0) + SESSION_TTLS[namespace], (key, namespace))
+    
+    def get(self, namespace: str, key: int) -> Optional[Any]:
+        session = self._sessions.get(key)
+        return session.record(namespace) if session else None
+    
+    def set(self, namespace: str, key: int, value: Any):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = UserSession()
+            session.assign(namespace, value)
+            self._arm(key, session, namespace, value)
+    
+    def patch(self, namespace: str, key: int, fields: Dict[str, Any]) -> bool:
+        with self._lock:
+            value = self.get(namespace, key)
+            if value is None:
+                return False
+            value.update(fields)
+            return True
+    
+    def pop(self, namespace: str, key: int) -> Optional[Any]:
+        with self._lock:
+            session = self._sessions.get(key)
+            value = session.record(namespace) if session else None
+            if value is not None:
+                session.assign(namespace, None)
+                if session.is_empty():
+                    del self._sessions[key]
+            return value
+    
+    def contains(self, namespace: str, key: int) -> bool:
+        return self.get(namespace, key) is not None
+    
+    def items(self, namespace: str) -> List[Tuple[int, Any]]:
+        with self._lock:
+            records = [(key, session.record(namespace)) for key, session in self._sessions.items()]
+        return [(key, value) for key, value in records if value is not None]
+    
+    def size(self, namespace: str) -> int:
+        return len(self.items(namespace))
+    
+    def expire(self) -> Dict[str, int]:
+        """حذف الجلسات المنتهية التي حل موعدها في العجلة فقط"""
+        now = time.time()
+        expired = dict.fromkeys(SESSION_TTLS, 0)
+        with self._lock:
+            for key, namespace in self._wheel.advance(now):
+                session = self._sessions.get(key)
+                if session is None:
+                    continue
+                record = session.record(namespace)
+                if record is None:
+                    session.timers &= ~NAMESPACE_BITS[namespace]
+                    continue
+                deadline = record.get("timestamp", 0) + SESSION_TTLS[namespace]
+                if deadline > now:
+                    # جُددت الجلسة منذ الجدولة: إعادتها للعجلة بالموعد الجديد
+                    self._wheel.schedule(deadline, (key, namespace))
+                    continue
+                session.timers &= ~NAMESPACE_BITS[namespace]
+                session.assign(namespace, None)
+                expired[namespace] += 1
+                if session.is_empty():
+                    del self._sessions[key]
+        return expired
+    
+    def rate_acquire(self, key: int, interval: float, tolerance: float, generation: float) -> bool:
+        """خطوة GCRA على شريحة محلية بجيلين يُستبدلان كل generation ثانية"""
+        stripe = self._stripes[key % len(self._stripes)]
+        now = time.monotonic()
+        with stripe.lock:
+            age = now - stripe.rotated_at
+            if age >= generation:
+                stripe.previous = stripe.current if age < 2 * generation else {}
+                stripe.current = {}
+                stripe.rotated_at = now
+            
+            tat = stripe.current.get(key)
+            if tat is None:
+                tat = stripe.previous.get(key, now)
+            if tat < now:
+                tat = now
+            if tat - now > tolerance:
+                return False
+            stripe.current[key] = tat + interval
+            return True
+    
+    def rate_keys(self) -> int:
+        keys = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                keys += len(stripe.current) + len(stripe.previous)
+        return keys
+    
+    def purge(self):
+        """لا شيء: المفاتيح المنتهية تسقط مع تبديل الأجيال"""
+    
+    # عملية واحدة: لا أجيال لمزامنتها وهي القائدة دائماً
+    shared = False
+    
+    def bump(self, scope: str) -> int:
+        return 0
+    
+    def generations(self) -> Dict[str, int]:
+        return {}
+    
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        return True
+    
+    def release_lease(self, name: str, owner: str):
+        pass
+
+class SqliteStateBackend:
+    """حالة مشتركة بين عمليات الجهاز الواحد في ملف SQLite مستقل بوضع WAL
+    
+    القيم تُخزن JSON (الصفوف تعود قوائم) وكل عملية تعديل جملة واحدة ذرية،
+    لذلك يجب تعديل الحقول عبر patch وليس عبر القاموس المُعاد من get.
+    """
+    
+    name = "sqlite"
+    shared = True
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS sessions (
+                namespace TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions(namespace, updated_at);
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key INTEGER PRIMARY KEY,
+                tat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS generations (
+                scope TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+        """)
+    
+    def _connection(self) -> sqlite3.Connection:
+        """اتصال دائم لكل خيط (autocommit) لتجنب كلفة الفتح في كل فحص"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def _execute(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Cursor]:
+        try:
+            return self._connection().execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"❌ خطأ في مخزن الحالة المشترك: {e}")
+            return None
+    
+    def get(self, namespace: str, key: int) -> Optional[Any]:
+        cur = self._execute("SELECT value FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+        row = cur.fetchone() if cur else None
+        return json.loads(row[0]) if row else None
+    
+    def set(self, namespace: str, key: int, value: Any):
+        """حذف حالات الإدخال الأخرى والكتابة في معاملة واحدة (لا تتداخل عمليتان على نفس المستخدم)"""
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if namespace in INPUT_NAMESPACES:
+                    others = [other for other in INPUT_NAMESPACES if other != namespace]
+                    conn.execute(f"DELETE FROM sessions WHERE key = ? AND namespace IN ({','.join('?' * len(others))})",
+                                 (key, *others))
+                conn.execute("""
+                    INSERT INTO sessions (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                """, (namespace, key, json.dumps(value, ensure_ascii=False), time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.error(f"❌ خطأ في مخزن الحالة المشترك: {e}")
+    
+    def patch(self, namespace: str, key: int, fields: Dict[str, Any]) -> bool:
+        cur = self._execute(
+            "UPDATE sessions SET value = json_patch(value, ?), updated_at = ? WHERE namespace = ? AND key = ?",
+            (json.dumps(fields, ensure_ascii=False), time.time(), namespace, key)
+        )
+        return bool(cur and cur.rowcount)
+    
+    def pop(self, namespace: str, key: int) -> Optional[Any]:
+        cur = self._execute("DELETE FROM sessions WHERE namespace = ? AND key = ? RETURNING value", (namespace, key))
+        rows = cur.fetchall() if cur else []
+        return json.loads(rows[0][0]) if rows else None
+    
+    def contains(self, namespace: str, key: int) -> bool:
+        cur = self._execute("SELECT 1 FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+        return bool(cur and cur.fetchone())
+    
+    def items(self, namespace: str) -> List[Tuple[int, Any]]:
+        cur = self._execute("SELECT key, value FROM sessions WHERE namespace = ?", (namespace,))
+        return [(row[0], json.loads(row[1])) for row in cur.fetchall()] if cur else []
+    
+    def size(self, namespace: str) -> int:
+        cur = self._execute("SELECT COUNT(*) FROM sessions WHERE namespace = ?", (namespace,))
+        return cur.fetchone()[0] if cur else 0
+    
+    def expire(self) -> Dict[str, int]:
+        """حذف الجلسات غير المحدثة خلال مدة صلاحيتها (عبر فهرس updated_at)"""
+        now = time.time()
+        expired = {}
+        for namespace, ttl in SESSION_TTLS.items():
+            cur = self._execute("DELETE FROM sessions WHERE namespace = ? AND updated_at < ?", (namespace, now - ttl))
+            expired[namespace] = cur.rowcount if cur else 0
+        return expired
+    
+    def rate_acquire(self, key: int, interval: float, tolerance: float, generation: float) -> bool:
+        """خطوة GCRA في جملة UPSERT واحدة (لا صف مُعاد = مرفوض)"""
+        now = time.time()
+        cur = self._execute("""
+            INSERT INTO rate_limits (key, tat) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET tat = max(tat, ?) + ?
+            WHERE max(tat, ?) - ? <= ?
+            RETURNING tat
+        """, (key, now + interval, now, interval, now, now, tolerance))
+        if cur is None:
+            return True  # عند تعذر المخزن لا نحجب المستخدمين
+        return bool(cur.fetchall())
+    
+    def rate_keys(self) -> int:
+        cur = self._execute("SELECT COUNT(*) FROM rate_limits")
+        return cur.fetchone()[0] if cur else 0
+    
+    def purge(self):
+        """حذف أوقات الوصول المنتهية (لا تؤثر على النتيجة، فقط حجم الملف)"""
+        cur = self._execute("DELETE FROM rate_limits WHERE tat < ?", (time.time(),))
+        if cur and cur.rowcount:
+            logger.info(f"🧹 تم حذف {cur.rowcount} مفتاح منتهٍ من حدود المعدل المشتركة")
+    
+    def bump(self, scope: str) -> int:
+        """زيادة جيل نطاق بعد تعديل محلي (0 عند الخطأ)"""
+        cur = self._execute("""
+            INSERT INTO generations (scope, version) VALUES (?, 1)
+            ON CONFLICT(scope) DO UPDATE SET version = version + 1
+            RETURNING version
+        """, (scope,))
+        rows = cur.fetchall() if cur else []
+        return rows[0][0] if rows else 0
+    
+    def generations(self) -> Dict[str, int]:
+        cur = self._execute("SELECT scope, version FROM generations")
+        return dict(cur.fetchall()) if cur else {}
+    
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """أخذ العقد أو تجديده في جملة واحدة: ينجح فقط لمالكه الحالي أو بعد انتهائه"""
+        now = time.time()
+        cur = self._execute("""
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            RETURNING owner
+        """, (name, owner, now + ttl, now))
+        return bool(cur and cur.fetchall())
+    
+    def release_lease(self, name: str, owner: str):
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+class SessionMap(MutableMapping):
+    """واجهة قاموس لمساحة أسماء في مخزن الحالة (مفاتيحها معرفات المستخدمين)"""
+    
+    def __init__(self, backend, namespace: str):
+        self.backend = backend
+        self.namespace = namespace
+    
+    def __getitem__(self, key: int) -> Any:
+        value = self.backend.get(self.namespace, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key: int, value: Any):
+        self.backend.set(self.namespace, key, value)
+    
+    def __delitem__(self, key: int):
+        if self.backend.pop(self.namespace, key) is None:
+            raise KeyError(key)
+    
+    def __contains__(self, key) -> bool:
+        return self.backend.contains(self.namespace, key)
+    
+    def __iter__(self):
+        return iter([key for key, _ in self.backend.items(self.namespace)])
+    
+    def __len__(self) -> int:
+        return self.backend.size(self.namespace)
+    
+    def get(self, key: int, default: Any = None) -> Any:
+        value = self.backend.get(self.namespace, key)
+        return default if value is None else value
+    
+    def pop(self, key: int, default: Any = None) -> Any:
+        value = self.backend.pop(self.namespace, key)
+        return default if value is None else value
+    
+    def items(self) -> List[Tuple[int, Any]]:
+        return self.backend.items(self.namespace)
+    
+    def patch(self, key: int, **fields) -> bool:
+        """تعديل حقول جلسة موجودة في عملية واحدة (False إن لم تكن موجودة)"""
+        return self.backend.patch(self.namespace, key, fields)
+
+def create_state_backend():
+    """إنشاء مخزن الحالة حسب STATE_BACKEND (الرجوع للذاكرة عند الفشل)"""
+    if STATE_BACKEND == "sqlite":
+        try:
+            backend = SqliteStateBackend(STATE_DB_PATH)
+            logger.info(f"🗂️ مخزن الحالة المشترك: {STATE_DB_PATH}")
+            return backend
+        except sqlite3.Error as e:
+            logger.error(f"❌ تعذر فتح مخزن الحالة المشترك {STATE_DB_PATH}: {e} - استخدام الذاكرة")
+    return MemoryStateBackend(RATE_LIMIT_STRIPES)
+
+state_backend = create_state_backend()
+
+class ProcessCoordinator:
+    """تنسيق العمليات التي تشترك في مخزن الحالة
+    
+    - أجيال التخزين المؤقت: كل تعديل محلي يزيد جيل نطاقه في المخزن، وكل عملية تفحص
+      الأجيال دورياً وتُبطل تخزينها المحلي للنطاقات التي غيّرتها عملية أخرى.
+    - القيادة: عقد بمدة محددة تجدده عملية واحدة؛ المهام الخلفية والناشرون والاستقبال
+      عبر getUpdates تعمل في القائد فقط، ويتولاها غيره خلال مدة العقد إن توقف.
+    
+    مع مخزن الذاكرة (عملية واحدة) العملية قائدة دائماً ولا توجد أجيال.
+    """
+    
+    LEASE_NAME = "leader"
+    
+    def __init__(self, backend, interval: float, lease_ttl: float):
+        self.backend = backend
+        self.interval = max(0.5, interval)
+        self.lease_ttl = max(self.interval * 3, lease_ttl)
+        self.owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        # القيادة محسوبة محلياً من آخر تجديد: تسقط قبل أن يستطيع غيرها أخذ العقد
+        self.lease_until = 0.0 if backend.shared else float('inf')
+        self.known: Dict[str, int] = {}
+        self.handlers: Dict[str, List[Callable[[], Any]]] = defaultdict(list)
+        self.leadership_handlers: List[Callable[[], Any]] = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = {'ticks': 0, 'bumps': 0, 'invalidations': 0, 'elections': 0}
+    
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self.lease_until
+    
+    def watch(self, bus, scope: str, *event_types: type):
+        """زيادة جيل النطاق عند نشر هذه الأحداث محلياً"""
+        if not self.backend.shared:
+            return
+        for event_type in event_types:
+            bus.subscribe(event_type, lambda e: self.bump(scope))
+    
+    def on_change(self, scope: str, handler: Callable[[], Any]):
+        """تسجيل إبطال للتخزين المحلي عند تغيير النطاق من عملية أخرى"""
+        self.handlers[scope].append(handler)
+    
+    def on_leadership(self, handler: Callable[[], Any]):
+        """تسجيل ما يُشغل عند تولي القيادة (مثل استئناف الإذاعات)"""
+        self.leadership_handlers.append(handler)
+    
+    def bump(self, scope: str):
+        version = self.backend.bump(scope)
+        with self.lock:
+            self.stats['bumps'] += 1
+            # إذا لم يغيّر غيرنا النطاق منذ آخر فحص فلا حاجة لإبطال تخزيننا
+            if version and version == self.known.get(scope, 0) + 1:
+                self.known[scope] = version
+    
+    def tick(self):
+        """تجديد العقد ثم إبطال النطاقات التي تغيرت في عمليات أخرى"""
+        if not self.backend.shared:
+            return
+        
+        was_leader = self.is_leader
+        started = time.time()
+        if self.backend.acquire_lease(self.LEASE_NAME, self.owner, self.lease_ttl):
+            self.lease_until = started + self.lease_ttl
+        if self.is_leader and not was_leader:
+            self.stats['elections'] += 1
+            logger.info(f"👑 تولت هذه العملية ({self.owner}) قيادة المهام الخلفية")
+            self._run(self.leadership_handlers)
+        elif was_leader and not self.is_leader:
+            logger.warning(f"⚠️ فقدت هذه العملية ({self.owner}) القيادة - إيقاف المهام الخلفية")
+        
+        changed = []
+        generations = self.backend.generations()
+        with self.lock:
+            self.stats['ticks'] += 1
+            for scope, version in generations.items():
+                if self.known.get(scope) != version:
+                    # أول فحص يحفظ الأجيال فقط: التخزين حُمّل للتو من قاعدة البيانات
+                    if scope in self.known or self.stats['ticks'] > 1:
+                        changed.append(scope)
+                    self.known[scope] = version
+            self.stats['invalidations'] += len(changed)
+        for scope in changed:
+            self._run(self.handlers.get(scope, ()))
+    
+    @staticmethod
+    def _run(handlers):
+        for handler in handlers:
+            try:
+                handler()
+            except Exception as e:
+                logger.error(f"❌ خطأ في مزامنة العمليات: {e}")
+    
+    def run(self):
+        """حلقة التنسيق (لا تُشغل مع مخزن الذاكرة)"""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"❌ خطأ في تنسيق العمليات: {e}")
+    
+    def stop(self):
+        """إيقاف الحلقة وتحرير العقد ليتولاه غيرنا فوراً"""
+        self.stop_event.set()
+        if self.backend.shared and self.is_leader:
+            self.lease_until = 0.0
+            self.backend.release_lease(self.LEASE_NAME, self.owner)
+    
+    def stats_snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats, shared=self.backend.shared, leader=self.is_leader, owner=self.owner,
+                        scopes=len(self.known))
+
+process_coordinator = ProcessCoordinator(state_backend, STATE_SYNC_INTERVAL, LEADER_LEASE_TTL)
 
 # ================================
 # المتغيرات العالمية والحالات
 # ================================
 
 # حالة تصفح المستخدمين
-BROWSE = {}  # {user_id: {country_id, last_number_id, last_msg, timestamp}}
+BROWSE = SessionMap(state_backend, "browse")  # {user_id: {country_id, last_number_id, last_msg, timestamp}}
 # حالة الإدارة
 ADMIN_STATE = {}  # {admin_id: {action, step, data, timestamp}}
 # المستخدمين في انتظار إثبات
-AWAITING_PROOF = {}  # {user_id: {number, platform, country_name, country_flag, timestamp}}
+AWAITING_PROOF = SessionMap(state_backend, "proof")  # {user_id: {number, platform, country_name, country_flag, timestamp}}
 # المستخدمين في انتظار نمط رقم  
-AWAITING_NUMBER_PATTERN = {}  # {user_id: {country_id, timestamp}}
+AWAITING_NUMBER_PATTERN = SessionMap(state_backend, "pattern")  # {user_id: {country_id, timestamp}}
 # المستخدمين في انتظار فلترة أرقام مميزة
-AWAITING_PREMIUM_FILTER = {}  # {user_id: {country_id, premium_type, numbers, current_index, timestamp}}
+AWAITING_PREMIUM_FILTER = SessionMap(state_backend, "premium")  # {user_id: {country_id, premium_type, numbers, current_index, timestamp}}
 
 # حالة الإذاعة
-BROADCAST_STATE = {}  # {broadcast_id: {ad_id, current_user_id, total_users, errors, start_time}}
+BROADCAST_STATE = {}  # {broadcast_id: {ad_id, current_user_id, total_users, sent, failed, blocked, rate_limited, start_time}}
+
+# ================================
+# ناقل أحداث النطاق (Domain Event Bus)
+# ================================
+
+@dataclass(frozen=True)
+class DomainEvent:
+    """حدث نطاق أساسي - يُنشر بعد نجاح كل عملية تعديل"""
+
+@dataclass(frozen=True)
+class NumberAdded(DomainEvent):
+    country_id: int
+    count: int = 1
+
+@dataclass(frozen=True)
+class NumbersDeleted(DomainEvent):
+    country_id: int
+    count: int = 0
+
+@dataclass(frozen=True)
+class CountryChanged(DomainEvent):
+    country_id: Optional[int] = None  # None = كل الدول
+
+@dataclass(frozen=True)
+class UserRegistered(DomainEvent):
+    user_id: int
+
+@dataclass(frozen=True)
+class UserPointsChanged(DomainEvent):
+    user_id: int
+    delta: int = 0
+
+@dataclass(frozen=True)
+class UserProChanged(DomainEvent):
+    user_id: int
+    is_pro: bool
+    expires_at: Optional[float] = None  # طابع انتهاء الاشتراك الجديد (إن كان معروفاً)
+
+@dataclass(frozen=True)
+class ProExpired(DomainEvent):
+    user_ids: Tuple[int, ...]
+
+@dataclass(frozen=True)
+class UserBanChanged(DomainEvent):
+    user_id: int
+    banned: bool
+
+@dataclass(frozen=True)
+class UserInvited(DomainEvent):
+    user_id: int
+    inviter_id: int
+
+@dataclass(frozen=True)
+class UserReachabilityChanged(DomainEvent):
+    user_ids: Tuple[int, ...]
+    reachable: bool
+
+@dataclass(frozen=True)
+class ProofSubmitted(DomainEvent):
+    user_id: int
+    outbox_id: int
+
+@dataclass(frozen=True)
+class SettingChanged(DomainEvent):
+    key: str
+    value: str
+
+@dataclass(frozen=True)
+class ChannelsChanged(DomainEvent):
+    channel: Optional[str] = None
+
+@dataclass(frozen=True)
+class MembershipChanged(DomainEvent):
+    user_id: int
+    channel: str
+    is_member: bool
+
+class EventBus:
+    """ناقل أحداث داخل العملية: المعدِّلات تنشر والتخزين المؤقت يشترك"""
+    
+    def __init__(self):
+        self._handlers: Dict[type, List[Callable[[DomainEvent], None]]] = defaultdict(list)
+        self._lock = threading.Lock()
+    
+    def subscribe(self, event_type: type, handler: Callable[[DomainEvent], None]):
+        """الاشتراك في نوع حدث (والأنواع المشتقة منه)"""
+        with self._lock:
+            self._handlers[event_type].append(handler)
+    
+    def publish(self, event: DomainEvent):
+        """نشر حدث لكل المشتركين بشكل متزامن"""
+        for event_type in type(event).__mro__:
+            for handler in list(self._handlers.get(event_type, ())):
+                try:
+                    handler(event)
+                except Exception as e:
+                    logger.error(f"❌ خطأ في معالج الحدث {type(event).__name__}: {e}")
 
-# معدل الاستخدام - نظام تحديد المعدل
-RATE_LIMITER = defaultdict(deque)  # {user_id: deque of timestamps}
+# إنشاء ناقل الأحداث
+event_bus = EventBus()
 
 # ================================
 # نظام التخزين المؤقت (Cache System)
@@ -115,16 +1541,148 @@ class CacheManager:
     def __init__(self):
         self.countries_cache = {}
         self.country_counts_cache = {}
-        self.settings_cache = {}
+        self.country_rows_cache = {}
+        self.country_buttons_cache = None
+        self.required_channels_cache = None
         self.user_stats_cache = {}
+        # None = لم يتم التحميل بعد (الرجوع لقاعدة البيانات)
+        self.banned_users: Optional[set] = None
+        self.unreachable_users: Optional[set] = None  # حظروا البوت أو حُذفت حساباتهم
+        self.pro_users: Optional[Dict[int, Optional[float]]] = None  # {user_id: expiry_ts or None}
         
+        # الإلغاء يتم عبر ناقل الأحداث، لذا فالمدد طويلة كشبكة أمان فقط
         self.CACHE_TTL = {
-            'countries': 300,
-            'country_counts': 60, 
-            'settings': 600,
-            'user_stats': 300
+            'countries': 3600,
+            'country_counts': 3600, 
+            'country_rows': 3600,
+            'country_buttons': 3600,
+            'required_channels': 3600,
+            'user_stats': 3600
         }
     
+    def subscribe_to(self, bus: EventBus):
+        """ربط الإلغاء بأحداث النطاق"""
+        bus.subscribe(NumberAdded, lambda e: self.invalidate_country_cache(e.country_id))
+        bus.subscribe(NumbersDeleted, lambda e: self.invalidate_country_cache(e.country_id))
+        bus.subscribe(CountryChanged, lambda e: self.invalidate_country_cache())
+        bus.subscribe(UserRegistered, lambda e: self.invalidate_user_cache(e.user_id))
+        bus.subscribe(UserPointsChanged, lambda e: self.invalidate_user_cache(e.user_id))
+        bus.subscribe(UserProChanged, lambda e: self.invalidate_user_cache(e.user_id))
+        bus.subscribe(UserProChanged, self._on_pro_changed)
+        bus.subscribe(ProExpired, self._on_pro_expired)
+        bus.subscribe(UserBanChanged, self._on_ban_changed)
+        bus.subscribe(UserReachabilityChanged, self._on_reachability_changed)
+        bus.subscribe(ChannelsChanged, lambda e: setattr(self, 'required_channels_cache', None))
+    
+    def _on_ban_changed(self, event: "UserBanChanged"):
+        """تحديث مجموعة المحظورين"""
+        banned = self.banned_users
+        if banned is None:
+            return
+        if event.banned:
+            banned.add(event.user_id)
+        else:
+            banned.discard(event.user_id)
+    
+    def _on_reachability_changed(self, event: "UserReachabilityChanged"):
+        """تحديث مجموعة المستخدمين غير القابلين للوصول"""
+        unreachable = self.unreachable_users
+        if unreachable is None:
+            return
+        if event.reachable:
+            unreachable.difference_update(event.user_ids)
+        else:
+            unreachable.update(event.user_ids)
+    
+    def _on_pro_changed(self, event: "UserProChanged"):
+        """تحديث خريطة مشتركي PRO"""
+        pro_users = self.pro_users
+        if pro_users is None:
+            return
+        if not event.is_pro:
+            pro_users.pop(event.user_id, None)
+            return
+        if event.expires_at is not None:
+            pro_users[event.user_id] = event.expires_at
+            return
+        
+        conn = self.db_connect()
+        if conn is None:
+            self.pro_users = None
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT is_pro, pro_expiry FROM users WHERE id = ?", (event.user_id,))
+            row = cur.fetchone()
+            if row and row[0]:
+                pro_users[event.user_id] = parse_db_timestamp(row[1])
+            else:
+                pro_users.pop(event.user_id, None)
+        except Exception as e:
+            logger.error(f"خطأ في تحديث cache PRO للمستخدم {event.user_id}: {e}")
+            self.pro_users = None
+        finally:
+            conn.close()
+    
+    def _on_pro_expired(self, event: "ProExpired"):
+        """تحديث جماعي: إزالة المنتهين من خريطة PRO وتعديل إحصائياتهم المخزنة في مكانها"""
+        pro_users = self.pro_users
+        for user_id in event.user_ids:
+            if pro_users is not None:
+                pro_users.pop(user_id, None)
+            entry = self.user_stats_cache.get(user_id)
+            if entry is not None and 'is_pro' in entry:
+                entry['is_pro'] = False
+                entry['pro_expiry'] = None
+    
+    def load_banned_users(self) -> int:
+        """تحميل مجموعة المستخدمين المحظورين بالكامل"""
+        conn = self.db_connect()
+        if conn is None:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM users WHERE banned = 1")
+            self.banned_users = {row[0] for row in cur.fetchall()}
+            return len(self.banned_users)
+        except Exception as e:
+            logger.error(f"خطأ في تحميل المحظورين: {e}")
+            return 0
+        finally:
+            conn.close()
+    
+    def load_unreachable_users(self) -> int:
+        """تحميل مجموعة المستخدمين غير القابلين للوصول"""
+        conn = self.db_connect()
+        if conn is None:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM users WHERE unreachable = 1")
+            self.unreachable_users = {row[0] for row in cur.fetchall()}
+            return len(self.unreachable_users)
+        except Exception as e:
+            logger.error(f"خطأ في تحميل المستخدمين غير القابلين للوصول: {e}")
+            return 0
+        finally:
+            conn.close()
+    
+    def load_pro_users(self) -> int:
+        """تحميل مشتركي PRO مع تواريخ الانتهاء"""
+        conn = self.db_connect()
+        if conn is None:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id, pro_expiry FROM users WHERE is_pro = 1")
+            self.pro_users = {row[0]: parse_db_timestamp(row[1]) for row in cur.fetchall()}
+            return len(self.pro_users)
+        except Exception as e:
+            logger.error(f"خطأ في تحميل مشتركي PRO: {e}")
+            return 0
+        finally:
+            conn.close()
+    
     def _is_expired(self, cache_time: float, ttl: int) -> bool:
         """فحص انتهاء صلاحية العنصر"""
         return time.time() - cache_time > ttl
@@ -152,6 +1710,7 @@ class CacheManager:
                 rows = cur.fetchall()
                 self.countries_cache = {
                     row[0]: {
+                        'id': row[0],
                         'name': row[1],
                         'flag': row[2],
                         'platform': row[3],
@@ -193,22 +1752,85 @@ class CacheManager:
                 }
             except Exception as e:
                 logger.error(f"خطأ في تحديث cache عدد الأرقام: {e}")
+                return {'total_count': 0, 'premium_count': 0, 'cache_time': time.time()}
             finally:
                 conn.close()
         
         return self.country_counts_cache[country_id]
     
+    def get_required_channels(self) -> List[str]:
+        """جلب القنوات التي تتطلب الانضمام مع التخزين المؤقت"""
+        entry = self.required_channels_cache
+        if entry is None or self._is_expired(entry['cache_time'], self.CACHE_TTL['required_channels']):
+            conn = self.db_connect()
+            if conn is None:
+                return []
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT channel FROM mandatory_channels WHERE require_join_for_points = 1")
+                entry = {'channels': [row[0] for row in cur.fetchall()], 'cache_time': time.time()}
+                self.required_channels_cache = entry
+            except Exception as e:
+                logger.error(f"خطأ في جلب القنوات المطلوبة: {e}")
+                return []
+            finally:
+                conn.close()
+        
+        return entry['channels']
+    
+    def get_country(self, country_id: int) -> Optional[Dict]:
+        """جلب سجل دولة (مفعلة أو معطلة) مع التخزين المؤقت"""
+        entry = self.country_rows_cache.get(country_id)
+        if entry is None or self._is_expired(entry['cache_time'], self.CACHE_TTL['country_rows']):
+            conn = self.db_connect()
+            if conn is None:
+                return None
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT * FROM countries WHERE id = ?", (country_id,))
+                row = cur.fetchone()
+                entry = {'row': dict(row) if row else None, 'cache_time': time.time()}
+                self.country_rows_cache[country_id] = entry
+            except Exception as e:
+                logger.error(f"خطأ في جلب الدولة {country_id}: {e}")
+                return None
+            finally:
+                conn.close()
+        
+        return entry['row']
+    
+    def get_country_buttons(self) -> List[Tuple[str, int]]:
+        """جلب أزرار قائمة الدول (النص، المعرف) مع التخزين المؤقت"""
+        entry = self.country_buttons_cache
+        if entry is None or self._is_expired(entry['cache_time'], self.CACHE_TTL['country_buttons']):
+            buttons = []
+            for country in self.get_countries():
+                emoji = country['flag'] or '🏴'
+                counts = self.get_country_counts(country['id'])
+                
+                # عرض العدد مع الميزة المميزة
+                count_text = f"({counts['total_count']})"
+                if counts['premium_count']:
+                    count_text += f" 💎{counts['premium_count']}"
+                
+                buttons.append((f"{emoji} {country['name']} {count_text}", country['id']))
+            
+            entry = {'buttons': buttons, 'cache_time': time.time()}
+            self.country_buttons_cache = entry
+        
+        return entry['buttons']
+    
     def invalidate_country_cache(self, country_id: int = None):
         """إلغاء التخزين المؤقت للدول"""
         if country_id:
             self.country_counts_cache.pop(country_id, None)
+            # العدد المتاح جزء من قائمة الدول والأزرار
+            self.countries_cache = {}
         else:
-            self.countries_cache.clear()
+            self.countries_cache = {}
             self.country_counts_cache.clear()
-    
-    def invalidate_settings_cache(self):
-        """إلغاء التخزين المؤقت للإعدادات"""
-        self.settings_cache.clear()
+            self.country_rows_cache.clear()
+        self.country_buttons_cache = None
     
     def invalidate_user_cache(self, user_id: int = None):
         """إلغاء التخزين المؤقت للمستخدمين"""
@@ -217,6 +1839,65 @@ class CacheManager:
         else:
             self.user_stats_cache.clear()
 
+    def dump_snapshot(self, path: str) -> bool:
+        """حفظ حالة التخزين المؤقت في ملف محلي (كتابة ذرية)"""
+        snapshot = {
+            'saved_at': time.time(),
+            'countries': list(self.countries_cache.values()),
+            'country_counts': {str(k): v for k, v in self.country_counts_cache.items()},
+            'country_rows': {str(k): v['row'] for k, v in self.country_rows_cache.items()},
+            'banned_users': sorted(self.banned_users) if self.banned_users is not None else None,
+            'unreachable_users': sorted(self.unreachable_users) if self.unreachable_users is not None else None,
+            'pro_users': {str(k): v for k, v in self.pro_users.items()} if self.pro_users is not None else None,
+        }
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            logger.info(f"💾 تم حفظ لقطة التخزين المؤقت في {path}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ لقطة التخزين المؤقت: {e}")
+            return False
+    
+    def load_snapshot(self, path: str, max_age: int) -> bool:
+        """تحميل لقطة التخزين المؤقت إذا كانت حديثة بما يكفي"""
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            
+            age = time.time() - snapshot.get('saved_at', 0)
+            if age > max_age:
+                logger.info(f"⏭️ لقطة التخزين المؤقت قديمة ({int(age)} ثانية) - تم تجاهلها")
+                return False
+            
+            now = time.time()
+            self.countries_cache = {
+                country['id']: dict(country, cache_time=now) for country in snapshot.get('countries', [])
+            }
+            self.country_counts_cache = {
+                int(k): dict(v, cache_time=now) for k, v in snapshot.get('country_counts', {}).items()
+            }
+            self.country_rows_cache = {
+                int(k): {'row': v, 'cache_time': now} for k, v in snapshot.get('country_rows', {}).items()
+            }
+            self.country_buttons_cache = None
+            if snapshot.get('banned_users') is not None:
+                self.banned_users = set(snapshot['banned_users'])
+            if snapshot.get('unreachable_users') is not None:
+                self.unreachable_users = set(snapshot['unreachable_users'])
+            if snapshot.get('pro_users') is not None:
+                self.pro_users = {int(k): v for k, v in snapshot['pro_users'].items()}
+            
+            logger.info(f"📂 تم تحميل لقطة التخزين المؤقت ({int(age)} ثانية): {len(self.countries_cache)} دولة")
+            return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في تحميل لقطة التخزين المؤقت: {e}")
+            return False
+
     def db_connect(self):
         """الاتصال بقاعدة البيانات"""
         try:
@@ -227,13 +1908,32 @@ class CacheManager:
             logger.error(f"خطأ في الاتصال بقاعدة البيانات: {e}")
             return None
 
+def parse_db_timestamp(value: Optional[str]) -> Optional[float]:
+    """تحويل تاريخ قاعدة البيانات إلى طابع زمني (None إذا كان فارغاً أو غير صالح)"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
 # إنشاء مدير التخزين المؤقت
 cache_manager = CacheManager()
+cache_manager.subscribe_to(event_bus)
 
 # ================================
 # إعداد قاعدة البيانات والتحسينات
 # ================================
 
+def ensure_columns(cur, table: str, columns: Dict[str, str]):
+    """إضافة الأعمدة الناقصة لجدول موجود (ترحيل قواعد البيانات القديمة)"""
+    cur.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cur.fetchall()}
+    for name, definition in columns.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            logger.info(f"🧱 تمت إضافة العمود {table}.{name}")
+
 def init_db():
     """تهيئة قاعدة البيانات مع الفهارس والأداء المحسن"""
     try:
@@ -418,11 +2118,102 @@ def init_db():
             )
         """)
         
-        # إنشاء الفهارس للأداء المحسن
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_users_points ON users(points DESC)",
-            "CREATE INDEX IF NOT EXISTS idx_users_is_pro ON users(is_pro, pro_expiry)",
-            "CREATE INDEX IF NOT EXISTS idx_users_banned ON users(banned)",
+        # المستخدمون الذين حظروا البوت أو حُذفت حساباتهم (يُستثنون من الإذاعة)
+        ensure_columns(cur, "users", {"unreachable": "INTEGER DEFAULT 0"})
+        
+        # إعلانات الوسائط: رسالة مصدر تُنسخ أو file_id مخزن لدى Telegram
+        ensure_columns(cur, "advertisements", {
+            "media_type": "TEXT DEFAULT NULL",
+            "file_id": "TEXT DEFAULT NULL",
+            "source_chat_id": "INTEGER DEFAULT NULL",
+            "source_message_id": "INTEGER DEFAULT NULL"
+        })
+        
+        # أعمدة محرك الإذاعة القابل للاستئناف
+        ensure_columns(cur, "broadcast_progress", {
+            "target_audience": "TEXT DEFAULT 'all'",
+            "blocked_count": "INTEGER DEFAULT 0",
+            "rate_limited_count": "INTEGER DEFAULT 0",
+            "schedule_id": "INTEGER DEFAULT NULL",
+            "audience_snapshot": "BLOB DEFAULT NULL",
+            "pace_until": "REAL DEFAULT NULL"
+        })
+        
+        # الإذاعات المجدولة مع لقطة الجمهور وقت الجدولة
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS scheduled_broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ad_id INTEGER NOT NULL,
+                target_audience TEXT DEFAULT 'all',
+                audience_snapshot BLOB,
+                audience_count INTEGER DEFAULT 0,
+                run_at TEXT NOT NULL,
+                window_start INTEGER DEFAULT NULL,
+                window_end INTEGER DEFAULT NULL,
+                interval_hours INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'scheduled',
+                last_broadcast_id TEXT DEFAULT NULL,
+                created_by INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(ad_id) REFERENCES advertisements(id) ON DELETE CASCADE
+            )
+        """)
+        
+        # إنشاء جدول عضوية القنوات (من تحديثات chat_member)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS channel_members (
+                channel TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                is_member INTEGER NOT NULL,
+                status TEXT,
+                source TEXT DEFAULT 'event',
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (channel, user_id)
+            )
+        """)
+        
+        # صندوق الإثباتات الصادر (يُكتب في نفس معاملة الإثبات)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS proof_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                proof_id INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                message TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                last_error TEXT DEFAULT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                sent_at TEXT DEFAULT NULL,
+                FOREIGN KEY(proof_id) REFERENCES proofs(id) ON DELETE CASCADE
+            )
+        """)
+        
+        # حالة التشغيل المستمرة (مثل offset آخر تحديث مستلم)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS runtime_state (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # اهتمام المستخدمين بالدول (لشرائح الجمهور)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_country_interest (
+                user_id INTEGER NOT NULL,
+                country_id INTEGER NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, country_id)
+            )
+        """)
+        
+        # إنشاء الفهارس للأداء المحسن
+        indexes = [
+            "CREATE INDEX IF NOT EXISTS idx_users_points ON users(points DESC)",
+            "CREATE INDEX IF NOT EXISTS idx_users_is_pro ON users(is_pro, pro_expiry)",
+            "CREATE INDEX IF NOT EXISTS idx_users_banned ON users(banned)",
             "CREATE INDEX IF NOT EXISTS idx_numbers_country ON numbers(country_id)",
             "CREATE INDEX IF NOT EXISTS idx_numbers_premium ON numbers(country_id, is_premium)",
             "CREATE INDEX IF NOT EXISTS idx_proofs_user ON proofs(user_id)",
@@ -431,6 +2222,9 @@ def init_db():
             "CREATE INDEX IF NOT EXISTS idx_points_history_user ON points_history(user_id, created_at)",
             "CREATE INDEX IF NOT EXISTS idx_pro_subscriptions_user ON pro_subscriptions(user_id, is_active, expires_at)",
             "CREATE INDEX IF NOT EXISTS idx_broadcast_progress_broadcast_id ON broadcast_progress(broadcast_id)",
+            "CREATE INDEX IF NOT EXISTS idx_broadcast_progress_status ON broadcast_progress(status)",
+            "CREATE INDEX IF NOT EXISTS idx_scheduled_broadcasts_due ON scheduled_broadcasts(status, run_at)",
+            "CREATE INDEX IF NOT EXISTS idx_proof_outbox_due ON proof_outbox(status, next_attempt_at)",
         ]
         
         for index_sql in indexes:
@@ -440,25 +2234,7 @@ def init_db():
                 logger.warning(f"خطأ في إنشاء الفهرس {index_sql}: {e}")
         
         # إدراج الإعدادات الافتراضية
-        default_settings = [
-            ("activation_channel", ACTIVATION_CHANNEL_DEFAULT),
-            ("proof_channel", PROOF_CHANNEL_DEFAULT),
-            ("daily_bonus_points", "10"),
-            ("invite_points", "5"),
-            ("proof_points", "3"),
-            ("numbers_channel", ""),
-            ("pro_days_duration", "30"),
-            ("pro_points_cost", "100"),
-            ("max_numbers_per_country", "1000"),
-            ("auto_cleanup_days", "30"),
-            ("premium_number_bonus", "2"),
-            ("welcome_message", "1"),
-            ("broadcast_interval", "24"),
-            ("rate_limit_requests", "5"),
-            ("rate_limit_window", "10")
-        ]
-        
-        for key, value in default_settings:
+        for key, value in DEFAULT_SETTINGS.items():
             cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
         
         conn.commit()
@@ -486,20 +2262,168 @@ def init_db():
         if 'conn' in locals():
             conn.close()
 
-@contextmanager
-def db_connect():
-    """مدير سياق للاتصال بقاعدة البيانات"""
-    conn = None
+def db_connect() -> Optional[sqlite3.Connection]:
+    """الاتصال بقاعدة البيانات (يُغلق الاتصال من قبل المستدعي)"""
     try:
         conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         conn.row_factory = sqlite3.Row
-        yield conn
+        return conn
     except Exception as e:
         logger.error(f"خطأ في الاتصال بقاعدة البيانات: {e}")
-        yield None
-    finally:
-        if conn:
-            conn.close()
+        return None
+
+# ================================
+# نظام الإعدادات المكتوبة (Typed Settings)
+# ================================
+
+# القيم الافتراضية لجدول الإعدادات
+DEFAULT_SETTINGS = {
+    "activation_channel": ACTIVATION_CHANNEL_DEFAULT,
+    "proof_channel": PROOF_CHANNEL_DEFAULT,
+    "daily_bonus_points": "10",
+    "invite_points": "5",
+    "proof_points": "3",
+    "numbers_channel": "",
+    "pro_days_duration": "30",
+    "pro_points_cost": "100",
+    "max_numbers_per_country": "1000",
+    "auto_cleanup_days": "30",
+    "premium_number_bonus": "2",
+    "welcome_message": "1",
+    "broadcast_interval": "24",
+    "rate_limit_requests": "5",
+    "rate_limit_window": "10",
+}
+
+def _parse_int_setting(values: Mapping[str, str], key: str) -> int:
+    """تحويل إعداد إلى رقم صحيح مع الرجوع للقيمة الافتراضية"""
+    try:
+        return int(str(values.get(key)).strip())
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ قيمة غير صالحة للإعداد {key}: {values.get(key)!r}")
+        return int(DEFAULT_SETTINGS[key])
+
+def _parse_bool_setting(values: Mapping[str, str], key: str) -> bool:
+    """تحويل إعداد إلى قيمة منطقية"""
+    return str(values.get(key, "")).strip().lower() in ("1", "true", "yes", "on")
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """نسخة ثابتة من جدول الإعدادات بأنواع محوّلة مسبقاً"""
+    version: int
+    activation_channel: str
+    proof_channel: str
+    numbers_channel: str
+    daily_bonus_points: int
+    invite_points: int
+    proof_points: int
+    pro_days_duration: int
+    pro_points_cost: int
+    max_numbers_per_country: int
+    auto_cleanup_days: int
+    premium_number_bonus: int
+    welcome_message: bool
+    broadcast_interval: int
+    rate_limit_requests: int
+    rate_limit_window: int
+    raw: Mapping[str, str]
+
+    @classmethod
+    def from_values(cls, rows: Mapping[str, str], version: int) -> "SettingsSnapshot":
+        """بناء نسخة من قيم الجدول (النصية)"""
+        values = dict(DEFAULT_SETTINGS)
+        values.update({k: v for k, v in rows.items() if v is not None})
+        
+        return cls(
+            version=version,
+            activation_channel=values["activation_channel"] or ACTIVATION_CHANNEL_DEFAULT,
+            proof_channel=values["proof_channel"] or PROOF_CHANNEL_DEFAULT,
+            numbers_channel=values["numbers_channel"] or "",
+            daily_bonus_points=_parse_int_setting(values, "daily_bonus_points"),
+            invite_points=_parse_int_setting(values, "invite_points"),
+            proof_points=_parse_int_setting(values, "proof_points"),
+            pro_days_duration=_parse_int_setting(values, "pro_days_duration"),
+            pro_points_cost=_parse_int_setting(values, "pro_points_cost"),
+            max_numbers_per_country=_parse_int_setting(values, "max_numbers_per_country"),
+            auto_cleanup_days=_parse_int_setting(values, "auto_cleanup_days"),
+            premium_number_bonus=_parse_int_setting(values, "premium_number_bonus"),
+            welcome_message=_parse_bool_setting(values, "welcome_message"),
+            broadcast_interval=_parse_int_setting(values, "broadcast_interval"),
+            rate_limit_requests=max(1, _parse_int_setting(values, "rate_limit_requests")),
+            rate_limit_window=max(1, _parse_int_setting(values, "rate_limit_window")),
+            raw=MappingProxyType(values)
+        )
+
+class Settings:
+    """مدير الإعدادات: تحميل الجدول مرة واحدة، تبديل ذري للنسخة، وإشعار المشتركين"""
+    
+    def __init__(self):
+        self._snapshot: Optional[SettingsSnapshot] = None
+        self._lock = threading.Lock()
+        self._subscribers: List[Callable[[Optional[SettingsSnapshot], SettingsSnapshot], None]] = []
+    
+    @property
+    def current(self) -> SettingsSnapshot:
+        """النسخة الحالية (قراءة بدون أقفال ولا انتهاء صلاحية)"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.reload()
+        return snapshot
+    
+    def reload(self) -> SettingsSnapshot:
+        """إعادة تحميل جدول الإعدادات بالكامل"""
+        conn = db_connect()
+        rows = {}
+        if conn is not None:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT key, value FROM settings")
+                rows = {row[0]: row[1] for row in cur.fetchall()}
+            except Exception as e:
+                logger.error(f"خطأ في تحميل الإعدادات: {e}")
+                if self._snapshot is not None:
+                    return self._snapshot
+            finally:
+                conn.close()
+        
+        with self._lock:
+            old = self._snapshot
+            new = SettingsSnapshot.from_values(rows, (old.version + 1) if old else 1)
+            self._snapshot = new
+        
+        self._notify(old, new)
+        return new
+    
+    def update(self, key: str, value: str) -> SettingsSnapshot:
+        """تطبيق تغيير إعداد واحد على نسخة جديدة"""
+        if self._snapshot is None:
+            # بدون نسخة محملة نبني على جدول الإعدادات وليس على القيم الافتراضية
+            self.reload()
+        with self._lock:
+            old = self._snapshot
+            values = dict(old.raw) if old else {}
+            values[key] = value
+            new = SettingsSnapshot.from_values(values, (old.version + 1) if old else 1)
+            self._snapshot = new
+        
+        self._notify(old, new)
+        return new
+    
+    def subscribe(self, callback: Callable[[Optional[SettingsSnapshot], SettingsSnapshot], None]):
+        """تسجيل دالة تُستدعى عند تغيير الإعدادات (القديمة، الجديدة)"""
+        self._subscribers.append(callback)
+    
+    def _notify(self, old: Optional[SettingsSnapshot], new: SettingsSnapshot):
+        """إشعار المشتركين بالنسخة الجديدة"""
+        for callback in list(self._subscribers):
+            try:
+                callback(old, new)
+            except Exception as e:
+                logger.error(f"❌ خطأ في مشترك الإعدادات {callback}: {e}")
+
+# إنشاء مدير الإعدادات
+settings = Settings()
+event_bus.subscribe(SettingChanged, lambda e: settings.update(e.key, e.value))
 
 # ================================
 # نظام استيراد الأرقام بالجملة (Bulk Import)
@@ -554,8 +2478,7 @@ def bulk_import_numbers(country_id: int, numbers_iterable, batch_size: int = 500
                     stats['inserted'] += len(batch)
                     conn.commit()
                     
-                    # إلغاء التخزين المؤقت
-                    cache_manager.invalidate_country_cache(country_id)
+                    event_bus.publish(NumberAdded(country_id, len(batch)))
                     
                     logger.info(f"✅ تم إدراج دفعة من {len(batch)} رقم للدولة {country_id}")
                     
@@ -580,6 +2503,7 @@ def bulk_import_numbers(country_id: int, numbers_iterable, batch_size: int = 500
                 """, batch)
                 stats['inserted'] += len(batch)
                 conn.commit()
+                event_bus.publish(NumberAdded(country_id, len(batch)))
                 logger.info(f"✅ تم إدراج آخر دفعة من {len(batch)} رقم")
             except Exception as e:
                 stats['errors'] += len(batch)
@@ -670,64 +2594,111 @@ def get_number_by_id(number_id: int) -> Optional[Dict]:
 
 def get_country_by_id(country_id: int) -> Optional[Dict]:
     """جلب دولة بواسطة ID"""
-    conn = db_connect()
-    if conn is None:
-        return None
-    
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT * FROM countries WHERE id = ?", (country_id,))
-        row = cur.fetchone()
-        return dict(row) if row else None
-    except Exception as e:
-        logger.error(f"خطأ في جلب الدولة {country_id}: {e}")
-        return None
-    finally:
-        conn.close()
+    row = cache_manager.get_country(country_id)
+    return dict(row) if row else None
 
 # ================================
 # نظام تحديد المعدل (Rate Limiting)
 # ================================
 
-def check_rate_limit(user_id: int) -> bool:
-    """فحص إذا كان المستخدم ضمن المعدل المسموح"""
-    now = time.time()
-    window = int(get_setting("rate_limit_window", "10"))
-    max_requests = int(get_setting("rate_limit_requests", "5"))
-    
-    # تنظيف الطوابع الزمنية القديمة
-    while RATE_LIMITER[user_id] and now - RATE_LIMITER[user_id][0] > window:
-        RATE_LIMITER[user_id].popleft()
-    
-    # فحص الحد
-    if len(RATE_LIMITER[user_id]) >= max_requests:
-        return False
-    
-    # إضافة الطابع الزمني الحالي
-    RATE_LIMITER[user_id].append(now)
-    return True
-
-def cleanup_rate_limiter():
-    """تنظيف نظام تحديد المعدل من البيانات القديمة"""
-    now = time.time()
-    window = int(get_setting("rate_limit_window", "10"))
-    
-    # إزالة المستخدمين غير النشطين
-    expired_users = [
-        uid for uid, timestamps in RATE_LIMITER.items()
-        if not timestamps or now - timestamps[-1] > window * 2
-    ]
-    
-    for uid in expired_users:
-        RATE_LIMITER.pop(uid, None)
+@dataclass(frozen=True)
+class RateBudget:
+    """ميزانية إجراء في GCRA: الفاصل بين الطلبات والتسامح مع الدفعة"""
+    interval: float   # T = النافذة / عدد الطلبات
+    tolerance: float  # τ = T × (عدد الطلبات - 1)
+    window: float
+    
+    @classmethod
+    def of(cls, requests: int, window: float) -> "RateBudget":
+        requests = max(1, int(requests))
+        window = max(0.001, float(window))
+        interval = window / requests
+        return cls(interval, interval * (requests - 1), window)
+    
+    @classmethod
+    def parse(cls, spec: str, default: str) -> "RateBudget":
+        """تحليل صيغة "طلبات/ثوانٍ" مع الرجوع للقيمة الافتراضية عند الخطأ"""
+        try:
+            requests, window = spec.split("/", 1)
+            return cls.of(int(requests), float(window))
+        except (ValueError, AttributeError):
+            logger.warning(f"⚠️ حد معدل غير صالح: {spec!r} - استخدام {default}")
+            requests, window = default.split("/", 1)
+            return cls.of(int(requests), float(window))
+
+class GCRALimiter:
+    """محدد معدل GCRA: قيمة عشرية واحدة (وقت الوصول النظري) لكل (مستخدم، إجراء)
+    
+    التخزين في مخزن الحالة: شرائح محلية بجيلين يُستبدلان كل نافذة (ذاكرة)
+    أو جدول مشترك بين العمليات (sqlite) - في الحالتين بلا مسح دوري.
+    """
     
-    if expired_users:
-        logger.info(f"🧹 تم تنظيف {len(expired_users)} مستخدم من نظام تحديد المعدل")
+    ACTIONS = ("number", "change", "search", "proof")
+    
+    def __init__(self, backend):
+        self.backend = backend
+        self._index = {action: i for i, action in enumerate(self.ACTIONS)}
+        self._budgets: Dict[str, RateBudget] = {}
+        self._generation = 60.0
+        self._lock = threading.Lock()
+        self.stats = {'allowed': 0, 'denied': 0}
+    
+    def configure(self, action: str, budget: RateBudget):
+        """تعيين ميزانية إجراء (مدة الجيل = أطول نافذة)"""
+        self._budgets[action] = budget
+        self._generation = max(b.window for b in self._budgets.values())
+    
+    def sync_settings(self, old: Optional[SettingsSnapshot], new: SettingsSnapshot):
+        """مشترك الإعدادات: حد طلب الأرقام يتبع جدول الإعدادات"""
+        if (old is None or "number" not in self._budgets
+                or (old.rate_limit_requests, old.rate_limit_window) != (new.rate_limit_requests, new.rate_limit_window)):
+            self.configure("number", RateBudget.of(new.rate_limit_requests, new.rate_limit_window))
+    
+    def allow(self, user_id: int, action: str = "number") -> bool:
+        """فحص واستهلاك طلب واحد - ثابت الزمن والذاكرة"""
+        budget = self._budgets.get(action)
+        if budget is None:
+            self.sync_settings(None, settings.current)
+            budget = self._budgets[action]
+        key = user_id * len(self.ACTIONS) + self._index[action]
+        allowed = self.backend.rate_acquire(key, budget.interval, budget.tolerance, self._generation)
+        with self._lock:
+            self.stats['allowed' if allowed else 'denied'] += 1
+        return allowed
+    
+    def stats_snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = dict(self.stats)
+        snapshot['keys'] = self.backend.rate_keys()
+        snapshot['backend'] = self.backend.name
+        return snapshot
+
+# إنشاء محدد المعدل
+rate_limiter = GCRALimiter(state_backend)
+rate_limiter.configure("change", RateBudget.parse(RATE_LIMIT_CHANGE, "10/60"))
+rate_limiter.configure("search", RateBudget.parse(RATE_LIMIT_SEARCH, "5/60"))
+rate_limiter.configure("proof", RateBudget.parse(RATE_LIMIT_PROOF, "5/300"))
+settings.subscribe(rate_limiter.sync_settings)
+
+def check_rate_limit(user_id: int, action: str = "number") -> bool:
+    """فحص إذا كان المستخدم ضمن المعدل المسموح لهذا الإجراء"""
+    return rate_limiter.allow(user_id, action)
 
 # ================================
 # نظام النقاط المتقدم
 # ================================
 
+def write_points(cur: sqlite3.Cursor, user_id: int, points: int, reason: str = ""):
+    """كتابات إضافة النقاط داخل معاملة المستدعي (ينشر المستدعي UserPointsChanged بعد الحفظ)"""
+    # تحديث النقاط وآخر نشاط
+    cur.execute("UPDATE users SET points = points + ?, last_activity = CURRENT_TIMESTAMP WHERE id = ?", (points, user_id))
+    
+    # إضافة للسجل
+    cur.execute("INSERT INTO points_history (user_id, points, reason) VALUES (?, ?, ?)", 
+               (user_id, points, reason))
+    cur.execute("INSERT INTO logs (who, action, meta) VALUES (?, 'add_points', ?)",
+               (user_id, f"points={points} reason={reason}"))
+
 def add_points(user_id: int, points: int, reason: str = "") -> bool:
     """إضافة نقاط للمستخدم مع تحديث التخزين المؤقت"""
     conn = db_connect()
@@ -736,22 +2707,11 @@ def add_points(user_id: int, points: int, reason: str = "") -> bool:
     
     cur = conn.cursor()
     try:
-        # تحديث النقاط
-        cur.execute("UPDATE users SET points = points + ? WHERE id = ?", (points, user_id))
-        
-        # إضافة للسجل
-        cur.execute("INSERT INTO points_history (user_id, points, reason) VALUES (?, ?, ?)", 
-                   (user_id, points, reason))
-        
-        # تحديث آخر نشاط
-        cur.execute("UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
-        
+        write_points(cur, user_id, points, reason)
         conn.commit()
         
-        # إلغاء التخزين المؤقت للمستخدم
-        cache_manager.invalidate_user_cache(user_id)
+        event_bus.publish(UserPointsChanged(user_id, points))
         
-        insert_log(user_id, "add_points", f"points={points} reason={reason}")
         logger.info(f"➕ تمت إضافة {points} نقطة للمستخدم {user_id} بسبب: {reason}")
         return True
         
@@ -820,7 +2780,7 @@ def claim_daily_bonus(user_id: int) -> bool:
     
     cur = conn.cursor()
     try:
-        daily_points = int(get_setting("daily_bonus_points", "10"))
+        daily_points = settings.current.daily_bonus_points
         today = date.today().strftime('%Y-%m-%d')
         
         # تحديث نقاط المستخدم
@@ -833,8 +2793,7 @@ def claim_daily_bonus(user_id: int) -> bool:
         
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_user_cache(user_id)
+        event_bus.publish(UserPointsChanged(user_id, daily_points))
         
         logger.info(f"🎁 تم استلام المكافأة اليومية للمستخدم {user_id}: {daily_points} نقطة")
         return True
@@ -849,7 +2808,7 @@ def award_invite_points(inviter_id: int, invited_id: int) -> bool:
     """منح نقاط الدعوة بعد التأكد من انضمام للقنوات المطلوبة"""
     try:
         if user_is_member_of_required_channels(invited_id):
-            invite_points = int(get_setting("invite_points", "5"))
+            invite_points = settings.current.invite_points
             if add_points(inviter_id, invite_points, "invite"):
                 safe_send(inviter_id, f"🎉 <b>تم انضمام المستخدم المدعو للقنوات!</b>\n\n📥 حصلت على <b>{invite_points} نقطة</b> مكافأة دعوة!")
                 return True
@@ -889,8 +2848,7 @@ def set_user_pro(user_id: int, days_duration: int = 30, method: str = "admin", p
         
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_user_cache(user_id)
+        event_bus.publish(UserProChanged(user_id, True, parse_db_timestamp(expiry_date)))
         
         insert_log(ADMIN_ID if method == "admin" else user_id, "set_user_pro", 
                   f"user_id={user_id} days={days_duration} method={method}")
@@ -904,9 +2862,17 @@ def set_user_pro(user_id: int, days_duration: int = 30, method: str = "admin", p
         conn.close()
 
 def is_user_pro(user_id: int) -> bool:
-    """فحص إذا كان المستخدم لديه اشتراك PRO نشط"""
-    if user_id not in cache_manager.user_stats_cache or cache_manager._is_expired(
-        cache_manager.user_stats_cache[user_id]['cache_time'],
+    """فحص إذا كان المستخدم لديه اشتراك PRO نشط (قراءة فقط - الإزالة مهمة كومة الانتهاء)"""
+    pro_users = cache_manager.pro_users
+    if pro_users is not None:
+        if user_id not in pro_users:
+            return False
+        expiry = pro_users[user_id]
+        return expiry is None or expiry > time.time()
+    
+    entry = cache_manager.user_stats_cache.get(user_id)
+    if entry is None or 'is_pro' not in entry or cache_manager._is_expired(
+        entry['cache_time'],
         cache_manager.CACHE_TTL['user_stats']
     ):
         conn = db_connect()
@@ -917,38 +2883,22 @@ def is_user_pro(user_id: int) -> bool:
         try:
             cur.execute("SELECT is_pro, pro_expiry FROM users WHERE id = ?", (user_id,))
             row = cur.fetchone()
-            
-            is_pro = False
-            if row and row[0]:
-                # فحص انتهاء الصلاحية
-                if row[1]:
-                    try:
-                        expiry_date = datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S')
-                        if expiry_date > datetime.now():
-                            is_pro = True
-                        else:
-                            # إزالة PRO منتهي الصلاحية
-                            remove_user_pro(user_id)
-                    except ValueError:
-                        # إذا كان تنسيق التاريخ غير صحيح
-                        is_pro = True
-            
-            # تحديث التخزين المؤقت
-            cache_manager.user_stats_cache[user_id] = {
-                'points': get_user_points(user_id),
-                'is_pro': is_pro,
-                'cache_time': time.time()
-            }
-            
-            return is_pro
-            
         except Exception as e:
             logger.error(f"خطأ في فحص PRO: {e}")
             return False
         finally:
             conn.close()
-    else:
-        return cache_manager.user_stats_cache[user_id]['is_pro']
+        
+        # تحديث التخزين المؤقت (تاريخ غير صالح يُعامل كاشتراك بلا انتهاء)
+        entry = {
+            'points': get_user_points(user_id),
+            'is_pro': bool(row and row[0]),
+            'pro_expiry': parse_db_timestamp(row[1]) if row else None,
+            'cache_time': time.time()
+        }
+        cache_manager.user_stats_cache[user_id] = entry
+    
+    return entry['is_pro'] and (entry.get('pro_expiry') is None or entry['pro_expiry'] > time.time())
 
 def remove_user_pro(user_id: int) -> bool:
     """إزالة حالة PRO من المستخدم"""
@@ -962,8 +2912,7 @@ def remove_user_pro(user_id: int) -> bool:
         cur.execute("UPDATE pro_subscriptions SET is_active = 0 WHERE user_id = ? AND is_active = 1", (user_id,))
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_user_cache(user_id)
+        event_bus.publish(UserProChanged(user_id, False))
         
         insert_log(ADMIN_ID, "remove_user_pro", f"user_id={user_id}")
         logger.info(f"❌ تم إزالة PRO من المستخدم {user_id}")
@@ -975,44 +2924,127 @@ def remove_user_pro(user_id: int) -> bool:
     finally:
         conn.close()
 
-def pro_expiry_worker():
-    """خيط عمل فحص انتهاء صلاحية PRO"""
-    while True:
+class ProExpiryQueue:
+    """كومة صغرى لمواعيد انتهاء PRO القادمة
+    
+    كل فحص يسحب المستحقين فقط ويطبق إلغاءهم في معاملة واحدة؛ المدخلات القديمة
+    (بعد تجديد الاشتراك) لا تطابق شرط pro_expiry في UPDATE فتُتجاهل.
+    """
+    
+    RELOAD_INTERVAL = 3600  # إعادة البناء من قاعدة البيانات (تغييرات من عمليات أخرى)
+    CHUNK_SIZE = 500
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap: List[Tuple[float, int]] = []
+        self.loaded_at = 0.0
+        self.stats = {'expired': 0, 'batches': 0}
+    
+    def subscribe_to(self, bus: EventBus):
+        bus.subscribe(UserProChanged, self._on_pro_changed)
+    
+    def _on_pro_changed(self, event: "UserProChanged"):
+        if event.is_pro and event.expires_at is not None:
+            with self.lock:
+                heapq.heappush(self.heap, (event.expires_at, event.user_id))
+    
+    def load(self) -> int:
+        """بناء الكومة من الاشتراكات النشطة ذات تاريخ الانتهاء"""
+        conn = db_connect()
+        if conn is None:
+            return 0
+        cur = conn.cursor()
         try:
-            conn = db_connect()
-            if conn is None:
-                time.sleep(300)
-                continue
-                
-            cur = conn.cursor()
-            
-            # العثور على اشتراكات PRO منتهية الصلاحية
-            cur.execute("""
-                SELECT id FROM users 
-                WHERE is_pro = 1 AND pro_expiry IS NOT NULL AND pro_expiry < datetime('now')
-            """)
-            
-            expired_users = [row[0] for row in cur.fetchall()]
-            
-            for user_id in expired_users:
-                remove_user_pro(user_id)
-                logger.info(f"⏰ تم انتهاء صلاحية PRO للمستخدم {user_id}")
-            
+            cur.execute("SELECT id, pro_expiry FROM users WHERE is_pro = 1 AND pro_expiry IS NOT NULL")
+            heap = [(expiry, row[0]) for row in cur.fetchall()
+                    if (expiry := parse_db_timestamp(row[1])) is not None]
+        except Exception as e:
+            logger.error(f"خطأ في تحميل مواعيد انتهاء PRO: {e}")
+            return 0
+        finally:
             conn.close()
-            
-            # تشغيل كل ساعة
-            time.sleep(3600)
-            
+        
+        heapq.heapify(heap)
+        with self.lock:
+            self.heap = heap
+            self.loaded_at = time.time()
+        return len(heap)
+    
+    def expire_due(self) -> int:
+        """إلغاء كل الاشتراكات المستحقة في معاملة واحدة (مهمة دورية)"""
+        if time.time() - self.loaded_at > self.RELOAD_INTERVAL:
+            self.load()
+        
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+        if not due:
+            return 0
+        
+        conn = db_connect()
+        if conn is None:
+            self._requeue(due)
+            return 0
+        
+        cutoff = datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')
+        user_ids = sorted({user_id for _, user_id in due})
+        cur = conn.cursor()
+        try:
+            expired = []
+            for start in range(0, len(user_ids), self.CHUNK_SIZE):
+                chunk = user_ids[start:start + self.CHUNK_SIZE]
+                cur.execute(f"""
+                    UPDATE users SET is_pro = 0, pro_expiry = NULL
+                    WHERE id IN ({','.join('?' * len(chunk))})
+                      AND is_pro = 1 AND pro_expiry IS NOT NULL AND pro_expiry <= ?
+                    RETURNING id
+                """, (*chunk, cutoff))
+                expired.extend(row[0] for row in cur.fetchall())
+            if expired:
+                cur.executemany("UPDATE pro_subscriptions SET is_active = 0 WHERE user_id = ? AND is_active = 1",
+                                [(user_id,) for user_id in expired])
+                cur.executemany("INSERT INTO logs (who, action, meta) VALUES (?, 'expire_user_pro', ?)",
+                                [(user_id, f"user_id={user_id}") for user_id in expired])
+            conn.commit()
         except Exception as e:
-            logger.error(f"❌ خطأ في worker انتهاء PRO: {e}")
-            time.sleep(300)
+            conn.rollback()
+            logger.error(f"❌ خطأ في إلغاء اشتراكات PRO المنتهية: {e}")
+            self._requeue(due)
+            return 0
+        finally:
+            conn.close()
+        
+        with self.lock:
+            self.stats['expired'] += len(expired)
+            self.stats['batches'] += 1
+        if expired:
+            event_bus.publish(ProExpired(tuple(expired)))
+            logger.info(f"⏰ تم انتهاء صلاحية PRO لـ {len(expired)} مستخدم")
+        return len(expired)
+    
+    def _requeue(self, entries: List[Tuple[float, int]]):
+        with self.lock:
+            for entry in entries:
+                heapq.heappush(self.heap, entry)
+    
+    def stats_snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats, pending=len(self.heap),
+                        next_in=max(0.0, self.heap[0][0] - time.time()) if self.heap else None)
+
+# إنشاء كومة انتهاء PRO
+pro_expiry_queue = ProExpiryQueue()
+pro_expiry_queue.subscribe_to(event_bus)
 
 def buy_pro_with_points(user_id: int) -> bool:
     """شراء PRO باستخدام النقاط"""
     try:
         user_points = get_user_points(user_id)
-        pro_cost = int(get_setting("pro_points_cost", "100"))
-        pro_days = int(get_setting("pro_days_duration", "30"))
+        snapshot = settings.current
+        pro_cost = snapshot.pro_points_cost
+        pro_days = snapshot.pro_days_duration
         
         if user_points < pro_cost:
             return False
@@ -1023,19 +3055,20 @@ def buy_pro_with_points(user_id: int) -> bool:
         
         cur = conn.cursor()
         try:
-            # خصم النقاط وإنشاء اشتراك PRO في عملية واحدة
+            # خصم النقاط وإنشاء اشتراك PRO في عملية واحدة (بنفس التوقيت المحلي لـ set_user_pro)
+            expiry_date = (datetime.now() + timedelta(days=pro_days)).strftime('%Y-%m-%d %H:%M:%S')
             cur.execute("UPDATE users SET points = points - ? WHERE id = ?", (pro_cost, user_id))
             cur.execute("""
                 INSERT INTO pro_subscriptions (user_id, method, points_paid, days, expires_at) 
-                VALUES (?, 'points', ?, ?, datetime('now', '+{} days'))
-            """.format(pro_days), (user_id, pro_cost, pro_days))
-            cur.execute("UPDATE users SET is_pro = 1, pro_expiry = datetime('now', '+{} days') WHERE id = ?".format(pro_days), (user_id,))
+                VALUES (?, 'points', ?, ?, ?)
+            """, (user_id, pro_cost, pro_days, expiry_date))
+            cur.execute("UPDATE users SET is_pro = 1, pro_expiry = ? WHERE id = ?", (expiry_date, user_id))
             cur.execute("INSERT INTO points_history (user_id, points, reason) VALUES (?, ?, ?)", (user_id, -pro_cost, "pro_purchase"))
             
             conn.commit()
             
-            # إلغاء التخزين المؤقت
-            cache_manager.invalidate_user_cache(user_id)
+            event_bus.publish(UserPointsChanged(user_id, -pro_cost))
+            event_bus.publish(UserProChanged(user_id, True, parse_db_timestamp(expiry_date)))
             
             insert_log(user_id, "buy_pro", f"points={pro_cost} days={pro_days}")
             logger.info(f"💰 تم شراء PRO للمستخدم {user_id} بـ {pro_cost} نقطة لمدة {pro_days} يوم")
@@ -1111,8 +3144,7 @@ def add_number(country_id: int, number: str, platform: str = "Telegram", is_prem
         
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_country_cache(country_id)
+        event_bus.publish(NumberAdded(country_id, 1))
         
         logger.info(f"➕ تم إضافة رقم {number} للدولة {country_id}")
         return True
@@ -1135,8 +3167,7 @@ def delete_numbers_by_pattern(country_id: int, pattern: str) -> int:
         deleted_count = cur.rowcount
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_country_cache(country_id)
+        event_bus.publish(NumbersDeleted(country_id, deleted_count))
         
         insert_log(ADMIN_ID, "delete_numbers", f"country_id={country_id} pattern={pattern} count={deleted_count}")
         logger.info(f"🗑️ تم حذف {deleted_count} رقم بنمط {pattern} للدولة {country_id}")
@@ -1267,181 +3298,857 @@ def find_numbers_by_pattern(country_id: int, pattern: str) -> List[Dict]:
 # نظام القنوات المطلوبة
 # ================================
 
-def user_is_member_of_required_channels(user_id: int) -> bool:
-    """فحص انضمام المستخدم للقنوات المطلوبة"""
-    required_channels = get_channels_requiring_join()
+class MembershipCache:
+    """تخزين مؤقت لعضوية (مستخدم، قناة) بمدة منفصلة للنتائج الإيجابية والسلبية"""
     
-    if not required_channels:
-        return True  # لا توجد قنوات مطلوبة
+    def __init__(self, positive_ttl: int, negative_ttl: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._entries: Dict[Tuple[int, str], Tuple[bool, float]] = {}
     
-    for channel in required_channels:
+    def get(self, user_id: int, channel: str) -> Optional[bool]:
+        """حالة العضوية المخزنة (None إذا لم تكن معروفة أو انتهت)"""
+        entry = self._entries.get((user_id, channel))
+        if entry is None:
+            return None
+        is_member, expires_at = entry
+        if expires_at < time.time():
+            self._entries.pop((user_id, channel), None)
+            return None
+        return is_member
+    
+    def put(self, user_id: int, channel: str, is_member: bool):
+        """تخزين نتيجة فحص العضوية"""
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[(user_id, channel)] = (is_member, time.time() + ttl)
+    
+    def purge_expired(self) -> int:
+        """إزالة العناصر المنتهية"""
+        now = time.time()
+        expired = [key for key, (_, expires_at) in list(self._entries.items()) if expires_at < now]
+        for key in expired:
+            self._entries.pop(key, None)
+        return len(expired)
+
+class MembershipStore:
+    """سجل عضوية دائم تغذيه تحديثات chat_member (البوت مشرف في القنوات)
+    
+    القناة "متتبَّعة" بعد وصول أول حدث منها، وعندها تكون أي حالة مسجلة
+    لها موثوقة لأن أي تغيير لاحق سيصل كحدث.
+    """
+    
+    def __init__(self):
+        self._state: Dict[Tuple[str, int], bool] = {}
+        self._tracked: set = set()
+        self._loaded = False
+        self._synced_at = ""  # وقت قاعدة البيانات عند آخر تحميل (للتحميل التدريجي)
+        self._lock = threading.Lock()
+    
+    def load(self) -> int:
+        """تحميل السجل من قاعدة البيانات إلى الذاكرة"""
+        conn = db_connect()
+        if conn is None:
+            return 0
         try:
-            if channel.startswith('-'):
-                # قناة مجموعة
-                chat_member = bot.get_chat_member(int(channel), user_id)
-            else:
-                # قناة عادية
-                channel_clean = channel.lstrip('@')
-                chat_member = bot.get_chat_member(channel_clean, user_id)
-            
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                return False
-                
+            cur = conn.cursor()
+            synced_at = cur.execute("SELECT CURRENT_TIMESTAMP").fetchone()[0]
+            cur.execute("SELECT channel, user_id, is_member, source FROM channel_members")
+            state = {}
+            tracked = set()
+            for row in cur.fetchall():
+                state[(row[0], row[1])] = bool(row[2])
+                if row[3] == 'event':
+                    tracked.add(row[0])
+            with self._lock:
+                self._state = state
+                self._tracked = tracked
+                self._loaded = True
+                self._synced_at = synced_at
+            return len(state)
         except Exception as e:
-            logger.warning(f"خطأ في فحص عضوية المستخدم {user_id} في {channel}: {e}")
-            return False
-    
-    return True
-
-def get_user_missing_channels(user_id: int) -> List[str]:
-    """جلب القنوات التي لم ينضم إليها المستخدم"""
-    required_channels = get_channels_requiring_join()
-    missing_channels = []
+            logger.error(f"خطأ في تحميل سجل العضوية: {e}")
+            return 0
+        finally:
+            conn.close()
     
-    for channel in required_channels:
+    def refresh(self) -> int:
+        """تحميل ما تغير منذ آخر تحميل فقط (تسجيلات عمليات أخرى)"""
+        if not self._loaded:
+            return self.load()
+        conn = db_connect()
+        if conn is None:
+            return 0
         try:
-            if channel.startswith('-'):
-                chat_member = bot.get_chat_member(int(channel), user_id)
-            else:
-                channel_clean = channel.lstrip('@')
-                chat_member = bot.get_chat_member(channel_clean, user_id)
-            
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                missing_channels.append(channel)
-                
+            cur = conn.cursor()
+            synced_at = cur.execute("SELECT CURRENT_TIMESTAMP").fetchone()[0]
+            # >= لأن الدقة بالثانية: صفوف نفس الثانية تُقرأ مرة أخرى (الكتابة متطابقة)
+            cur.execute("SELECT channel, user_id, is_member, source FROM channel_members WHERE updated_at >= ?",
+                       (self._synced_at,))
+            rows = cur.fetchall()
+            with self._lock:
+                for row in rows:
+                    self._state[(row[0], row[1])] = bool(row[2])
+                    if row[3] == 'event':
+                        self._tracked.add(row[0])
+                self._synced_at = synced_at
+            return len(rows)
         except Exception as e:
-            logger.warning(f"خطأ في فحص عضوية المستخدم {user_id} في {channel}: {e}")
-            missing_channels.append(channel)
+            logger.error(f"خطأ في تحديث سجل العضوية: {e}")
+            return 0
+        finally:
+            conn.close()
     
-    return missing_channels
-
-def get_channels_requiring_join() -> List[str]:
-    """جلب القنوات التي تتطلب الانضمام للحصول على النقاط"""
-    conn = db_connect()
-    if conn is None:
-        return []
+    def get(self, user_id: int, channel: str) -> Optional[bool]:
+        """الحالة المسجلة (None إذا كانت القناة غير متتبعة أو لا توجد حالة)"""
+        if not self._loaded:
+            self.load()
+        if channel not in self._tracked:
+            return None
+        return self._state.get((channel, user_id))
     
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT channel FROM mandatory_channels WHERE require_join_for_points = 1")
-        rows = cur.fetchall()
-        return [row[0] for row in rows]
-    except Exception as e:
-        logger.error(f"خطأ في جلب القنوات المطلوبة: {e}")
-        return []
-    finally:
-        conn.close()
-
-# ================================
-# نظام الإذاعة المتقدم
-# ================================
-
-def start_broadcast(ad_id: int, target_audience: str = 'all') -> str:
-    """بدء إذاعة مع إمكانية الاستئناف"""
-    try:
-        # إنشاء معرف فريد للإذاعة
-        broadcast_id = hashlib.md5(f"{ad_id}_{time.time()}".encode()).hexdigest()[:16]
-        
-        # جلب الإعداد
+    def is_tracked(self, channel: str) -> bool:
+        """هل تصل أحداث chat_member من هذه القناة"""
+        if not self._loaded:
+            self.load()
+        return channel in self._tracked
+    
+    def record(self, channel: str, user_id: int, is_member: bool, status: str = "", source: str = "event"):
+        """تسجيل حالة عضوية (كتابة فورية في قاعدة البيانات)"""
         conn = db_connect()
         if conn is None:
-            return None
-        
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM advertisements WHERE id = ? AND is_active = 1", (ad_id,))
-        ad = cur.fetchone()
-        
-        if not ad:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO channel_members (channel, user_id, is_member, status, source, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(channel, user_id) DO UPDATE SET
+                    is_member = excluded.is_member,
+                    status = excluded.status,
+                    source = excluded.source,
+                    updated_at = excluded.updated_at
+            """, (channel, user_id, 1 if is_member else 0, status, source))
+            conn.commit()
+            
+            with self._lock:
+                self._state[(channel, user_id)] = is_member
+                if source == 'event':
+                    self._tracked.add(channel)
+        except Exception as e:
+            logger.error(f"خطأ في تسجيل عضوية {user_id} في {channel}: {e}")
+            return
+        finally:
             conn.close()
-            return None
         
-        # جلب قائمة المستخدمين حسب الجمهور المستهدف
-        if target_audience == 'pro':
-            cur.execute("SELECT id FROM users WHERE banned = 0 AND is_pro = 1")
-        elif target_audience == 'points':
-            cur.execute("SELECT id FROM users WHERE banned = 0 AND points > 0")
+        event_bus.publish(MembershipChanged(user_id, channel, is_member))
+
+# إنشاء تخزين العضوية ومجمع خيوط الفحص المتوازي
+membership_store = MembershipStore()
+membership_cache = MembershipCache(MEMBERSHIP_POSITIVE_TTL, MEMBERSHIP_NEGATIVE_TTL)
+event_bus.subscribe(MembershipChanged, lambda e: membership_cache.put(e.user_id, e.channel, e.is_member))
+MEMBERSHIP_EXECUTOR = ThreadPoolExecutor(max_workers=MEMBERSHIP_PROBE_WORKERS, thread_name_prefix="membership")
+
+def probe_channel_membership(user_id: int, channel: str) -> Optional[bool]:
+    """فحص عضوية المستخدم في قناة عبر Telegram (None عند الخطأ)"""
+    try:
+        if channel.startswith('-'):
+            # قناة مجموعة
+            chat_member = bot.get_chat_member(int(channel), user_id)
         else:
-            cur.execute("SELECT id FROM users WHERE banned = 0")
-        
-        users = [row[0] for row in cur.fetchall()]
-        
-        # حفظ حالة الإذاعة
-        cur.execute("""
-            INSERT INTO broadcast_progress (broadcast_id, ad_id, total_users, status)
-            VALUES (?, ?, ?, 'running')
-        """, (broadcast_id, ad_id, len(users)))
-        
-        conn.commit()
-        conn.close()
-        
-        # بدء خيط الإذاعة
-        broadcast_thread = threading.Thread(
-            target=broadcast_worker, 
-            args=(broadcast_id, ad_id, users),
-            daemon=True
-        )
-        broadcast_thread.start()
+            # قناة عادية
+            chat_member = bot.get_chat_member(f"@{channel.lstrip('@')}", user_id)
         
-        logger.info(f"📢 تم بدء الإذاعة {broadcast_id} لـ {len(users)} مستخدم")
-        return broadcast_id
+        return chat_member.status in ['member', 'administrator', 'creator']
         
     except Exception as e:
-        logger.error(f"❌ خطأ في بدء الإذاعة: {e}")
+        logger.warning(f"خطأ في فحص عضوية المستخدم {user_id} في {channel}: {e}")
         return None
 
-def broadcast_worker(broadcast_id: str, ad_id: int, users: List[int]):
-    """خيط عمل الإذاعة"""
-    try:
-        conn = db_connect()
-        if conn is None:
-            return
-            
-        cur = conn.cursor()
-        
-        # جلب محتوى الإعلان
-        cur.execute("SELECT * FROM advertisements WHERE id = ?", (ad_id,))
-        ad = cur.fetchone()
+def user_is_member_of_required_channels(user_id: int) -> bool:
+    """فحص انضمام المستخدم للقنوات المطلوبة"""
+    return not get_user_missing_channels(user_id)
+
+def lookup_known_membership(user_id: int) -> Tuple[List[str], set, List[str]]:
+    """تصنيف القنوات المطلوبة: (القنوات، المفقودة المعروفة، غير المعروفة وتحتاج فحصاً)"""
+    required_channels = get_channels_requiring_join()
+    missing = set()
+    unknown = []
+    for channel in required_channels:
+        # السجل المبني على الأحداث أولاً، ثم التخزين المؤقت
+        state = membership_store.get(user_id, channel)
+        if state is None:
+            state = membership_cache.get(user_id, channel)
+        if state is None:
+            unknown.append(channel)
+        elif not state:
+            missing.add(channel)
+    return required_channels, missing, unknown
+
+def apply_membership_probes(user_id: int, unknown: List[str], results: List[Optional[bool]], missing: set):
+    """تسجيل نتائج الفحص المباشر وإضافة القنوات غير المنضم إليها إلى المفقودة"""
+    for channel, is_member in zip(unknown, results):
+        if is_member is None:
+            # لا نخزن الأخطاء - تُعتبر القناة مفقودة لهذه المرة فقط
+            missing.add(channel)
+            continue
+        if membership_store.is_tracked(channel):
+            # القناة متتبعة: الحالة المسجلة تبقى صحيحة حتى يصل حدث جديد
+            membership_store.record(channel, user_id, is_member, source='probe')
+        else:
+            membership_cache.put(user_id, channel, is_member)
+        if not is_member:
+            missing.add(channel)
+
+def get_user_missing_channels(user_id: int) -> List[str]:
+    """جلب القنوات التي لم ينضم إليها المستخدم في مرور واحد (تخزين مؤقت + فحص متوازٍ)"""
+    required_channels, missing, unknown = lookup_known_membership(user_id)
+    if not required_channels:
+        return []  # لا توجد قنوات مطلوبة
+    
+    if unknown:
+        if len(unknown) == 1:
+            results = [probe_channel_membership(user_id, unknown[0])]
+        else:
+            results = list(MEMBERSHIP_EXECUTOR.map(lambda ch: probe_channel_membership(user_id, ch), unknown))
+        apply_membership_probes(user_id, unknown, results, missing)
+    
+    return [channel for channel in required_channels if channel in missing]
+
+def get_channels_requiring_join() -> List[str]:
+    """جلب القنوات التي تتطلب الانضمام للحصول على النقاط"""
+    return cache_manager.get_required_channels()
+
+def match_required_channel(chat) -> Optional[str]:
+    """مطابقة محادثة Telegram مع قناة إجبارية مسجلة"""
+    username = f"@{chat.username}".lower() if getattr(chat, 'username', None) else None
+    for channel in get_channels_requiring_join():
+        if channel == str(chat.id):
+            return channel
+        if username and f"@{channel.lstrip('@')}".lower() == username:
+            return channel
+    return None
+
+# ================================
+# محرك شرائح الجمهور (Bitmaps)
+# ================================
+
+class SegmentExpressionError(ValueError):
+    """تعبير شريحة غير صالح"""
+
+# مدة صلاحية الشرائح ذات المعامل (active:N, invited:K) قبل إعادة حسابها
+SEGMENT_PARAM_TTL = 60
+SEGMENT_TOKEN_RE = re.compile(r"\s*(?:(\()|(\))|([&|\-!~])|([a-z_]+(?::\d+)?))", re.IGNORECASE)
+
+class SegmentIds(list):
+    """معرفات بترتيب البتات: بادئة مرتبة تصاعدياً من آخر بناء ثم المستخدمون الجدد بترتيب الوصول"""
+    __slots__ = ('sorted_count',)
+    
+    def __init__(self, ids=(), sorted_count: int = 0):
+        super().__init__(ids)
+        self.sorted_count = sorted_count
+
+class SegmentIndex:
+    """شرائح الجمهور كـ bitmaps (أعداد صحيحة) على ترتيب كثيف للمستخدمين
+    
+    البناء الكامل يرتب حسب المعرف؛ المستخدمون الجدد يُلحقون بالنهاية دون إعادة بناء
+    (معرفات Telegram ليست متزايدة)، ومهمة الشرائح الدورية تعيد الترتيب.
+    """
+    
+    FLAGS = ('banned', 'pro', 'points', 'reachable')
+    
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ids = SegmentIds()  # البت رقم i = المستخدم ids[i]
+        self.ordinals: Dict[int, int] = {}
+        self.flags: Dict[str, int] = {flag: 0 for flag in self.FLAGS}
+        self.countries: Dict[int, int] = {}
+        self.last_active: List[float] = []
+        self.invites: List[int] = []
+        self.param_cache: Dict[str, Tuple[int, float]] = {}
+        self.built_at = 0.0
+    
+    def db_connect(self) -> Optional[sqlite3.Connection]:
+        return db_connect()
+    
+    def rebuild(self) -> int:
+        """إعادة بناء جميع الشرائح من قاعدة البيانات"""
+        conn = self.db_connect()
+        if conn is None:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, banned, is_pro, points, unreachable, total_invites,
+                       CAST(strftime('%s', last_activity) AS INTEGER)
+                FROM users ORDER BY id
+            """)
+            rows = cur.fetchall()
+            cur.execute("SELECT user_id, country_id FROM user_country_interest")
+            interest = cur.fetchall()
+        except Exception as e:
+            logger.error(f"❌ خطأ في بناء شرائح الجمهور: {e}")
+            return 0
+        finally:
+            conn.close()
         
-        if not ad:
+        ids = [row[0] for row in rows]
+        ordinals = {user_id: index for index, user_id in enumerate(ids)}
+        size = len(ids) // 8 + 1
+        banned, pro, points, reachable = (bytearray(size) for _ in range(4))
+        for index, row in enumerate(rows):
+            byte, bit = index >> 3, 1 << (index & 7)
+            if row[1]:
+                banned[byte] |= bit
+            if row[2]:
+                pro[byte] |= bit
+            if row[3] and row[3] > 0:
+                points[byte] |= bit
+            if not row[4]:
+                reachable[byte] |= bit
+        flag_bits = {'banned': banned, 'pro': pro, 'points': points, 'reachable': reachable}
+        
+        country_bits: Dict[int, bytearray] = {}
+        for user_id, country_id in interest:
+            index = ordinals.get(user_id)
+            if index is not None:
+                bits = country_bits.setdefault(country_id, bytearray(len(ids) // 8 + 1))
+                bits[index >> 3] |= 1 << (index & 7)
+        
+        with self.lock:
+            # قائمة جديدة وليس تعديلاً: النتائج المحسوبة سابقاً تبقى مرتبطة بترتيبها
+            self.ids = SegmentIds(ids, len(ids))
+            self.ordinals = ordinals
+            self.flags = {flag: int.from_bytes(bits, 'little') for flag, bits in flag_bits.items()}
+            self.countries = {cid: int.from_bytes(bits, 'little') for cid, bits in country_bits.items()}
+            self.last_active = [row[6] or 0 for row in rows]
+            self.invites = [row[5] or 0 for row in rows]
+            self.param_cache.clear()
+            self.built_at = time.time()
+        return len(ids)
+    
+    def ensure_built(self):
+        """البناء عند أول استخدام"""
+        if not self.built_at:
+            self.rebuild()
+    
+    def _ordinal(self, user_id: int) -> Optional[int]:
+        """ترتيب المستخدم (المستخدم الجديد يُلحق بالنهاية بترتيب الوصول)"""
+        index = self.ordinals.get(user_id)
+        if index is not None:
+            return index
+        index = len(self.ids)
+        self.ids.append(user_id)
+        self.ordinals[user_id] = index
+        self.last_active.append(time.time())
+        self.invites.append(0)
+        return index
+    
+    def _set_bit(self, bitmap: int, index: int, value: bool) -> int:
+        return bitmap | (1 << index) if value else bitmap & ~(1 << index)
+    
+    def refresh_user(self, user_id: int):
+        """تحديث شرائح مستخدم واحد من قاعدة البيانات"""
+        if not self.built_at:
+            return
+        conn = self.db_connect()
+        if conn is None:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT banned, is_pro, points, unreachable, total_invites FROM users WHERE id = ?", (user_id,))
+            row = cur.fetchone()
+        except Exception as e:
+            logger.error(f"خطأ في تحديث شرائح المستخدم {user_id}: {e}")
+            return
+        finally:
             conn.close()
+        if not row:
             return
         
-        sent_count = 0
-        failed_count = 0
-        errors_list = []
+        with self.lock:
+            index = self._ordinal(user_id)
+            if index is None:
+                return
+            values = {'banned': row[0], 'pro': row[1], 'points': (row[2] or 0) > 0, 'reachable': not row[3]}
+            for flag, value in values.items():
+                self.flags[flag] = self._set_bit(self.flags[flag], index, bool(value))
+            if self.invites[index] != (row[4] or 0):
+                self.invites[index] = row[4] or 0
+                self.param_cache = {k: v for k, v in self.param_cache.items() if not k.startswith('invited:')}
+    
+    def touch(self, user_id: int):
+        """تسجيل نشاط المستخدم في الذاكرة"""
+        index = self.ordinals.get(user_id)
+        if index is not None:
+            self.last_active[index] = time.time()
+    
+    def add_country_interest(self, user_id: int, country_id: int) -> bool:
+        """إضافة المستخدم لشريحة الدولة (False إذا كان موجوداً)"""
+        with self.lock:
+            index = self.ordinals.get(user_id)
+            if index is None:
+                return True
+            bitmap = self.countries.get(country_id, 0)
+            if bitmap >> index & 1:
+                return False
+            self.countries[country_id] = bitmap | (1 << index)
+            return True
+    
+    def subscribe_to(self, bus: EventBus):
+        """التحديث التدريجي من أحداث النطاق"""
+        for event_type in (UserRegistered, UserPointsChanged, UserProChanged, UserBanChanged):
+            bus.subscribe(event_type, lambda e: self.refresh_user(e.user_id))
+        bus.subscribe(UserInvited, lambda e: self.refresh_user(e.inviter_id))
+        bus.subscribe(UserReachabilityChanged, self._on_reachability_changed)
+        bus.subscribe(ProExpired, self._on_pro_expired)
+    
+    def _on_pro_expired(self, event: "ProExpired"):
+        with self.lock:
+            for user_id in event.user_ids:
+                index = self.ordinals.get(user_id)
+                if index is not None:
+                    self.flags['pro'] = self._set_bit(self.flags['pro'], index, False)
+    
+    def _on_reachability_changed(self, event: "UserReachabilityChanged"):
+        with self.lock:
+            for user_id in event.user_ids:
+                index = self.ordinals.get(user_id)
+                if index is not None:
+                    self.flags['reachable'] = self._set_bit(self.flags['reachable'], index, event.reachable)
+    
+    def _threshold_bitmap(self, values: List[float], threshold: float) -> int:
+        """bitmap للقيم >= الحد (بناء عبر bytearray بدلاً من عمليات bit متتالية)"""
+        bits = bytearray(len(values) // 8 + 1)
+        for index, value in enumerate(values):
+            if value >= threshold:
+                bits[index >> 3] |= 1 << (index & 7)
+        return int.from_bytes(bits, 'little')
+    
+    def _segment(self, name: str) -> int:
+        """bitmap لشريحة أساسية أو ذات معامل"""
+        base, _, param = name.partition(':')
+        if base == 'all' and not param:
+            return (1 << len(self.ids)) - 1
+        if base in self.flags and not param:
+            return self.flags[base]
+        if not param:
+            raise SegmentExpressionError(f"شريحة غير معروفة: {name}")
+        
+        value = int(param)
+        if base == 'country':
+            return self.countries.get(value, 0)
+        if base not in ('active', 'invited'):
+            raise SegmentExpressionError(f"شريحة غير معروفة: {name}")
+        
+        cached = self.param_cache.get(name)
+        if cached and time.time() - cached[1] < SEGMENT_PARAM_TTL:
+            return cached[0]
+        if base == 'active':
+            bitmap = self._threshold_bitmap(self.last_active, time.time() - value * 86400)
+        else:
+            bitmap = self._threshold_bitmap(self.invites, value)
+        self.param_cache[name] = (bitmap, time.time())
+        return bitmap
+    
+    def select(self, expression: str) -> Tuple[int, List[int]]:
+        """تقييم تعبير مثل 'pro & active:7 - country:3' => (bitmap، قائمة المعرفات المرتبطة)"""
+        self.ensure_built()
+        tokens = self._tokenize(expression)
+        with self.lock:
+            universe = (1 << len(self.ids)) - 1
+            position = 0
+            
+            def parse_or() -> int:
+                nonlocal position
+                result = parse_and()
+                while position < len(tokens) and tokens[position] in ('|', 'or'):
+                    position += 1
+                    result |= parse_and()
+                return result
+            
+            def parse_and() -> int:
+                nonlocal position
+                result = parse_not()
+                while position < len(tokens) and tokens[position] in ('&', '-', 'and'):
+                    operator = tokens[position]
+                    position += 1
+                    operand = parse_not()
+                    result = result & ~operand if operator == '-' else result & operand
+                return result
+            
+            def parse_not() -> int:
+                nonlocal position
+                if position >= len(tokens):
+                    raise SegmentExpressionError("تعبير ناقص")
+                token = tokens[position]
+                position += 1
+                if token in ('!', '~', 'not'):
+                    return universe & ~parse_not()
+                if token == '(':
+                    result = parse_or()
+                    if position >= len(tokens) or tokens[position] != ')':
+                        raise SegmentExpressionError("قوس غير مغلق")
+                    position += 1
+                    return result
+                if token in (')', '&', '|', '-', 'and', 'or'):
+                    raise SegmentExpressionError(f"رمز غير متوقع: {token}")
+                return self._segment(token)
+            
+            bitmap = parse_or()
+            if position != len(tokens):
+                raise SegmentExpressionError(f"رمز غير متوقع: {tokens[position]}")
+            return bitmap & universe, self.ids
+    
+    def _tokenize(self, expression: str) -> List[str]:
+        tokens = []
+        position = 0
+        expression = expression.strip().lower()
+        while position < len(expression):
+            match = SEGMENT_TOKEN_RE.match(expression, position)
+            if not match or match.end() == position:
+                raise SegmentExpressionError(f"رمز غير صالح عند: {expression[position:position + 10]}")
+            tokens.append(next(group for group in match.groups() if group))
+            position = match.end()
+        if not tokens:
+            raise SegmentExpressionError("تعبير فارغ")
+        return tokens
+    
+    def audience(self, expression: str) -> Tuple[int, List[int]]:
+        """جمهور الإذاعة: التعبير مع استبعاد المحظورين وغير القابلين للوصول"""
+        bitmap, ids = self.select(expression)
+        with self.lock:
+            return bitmap & self.flags['reachable'] & ~self.flags['banned'], ids
+    
+    def filter_deliverable(self, user_ids: List[int]) -> List[int]:
+        """إبقاء من لا يزال قابلاً للإذاعة (غير محظور ولم يحظر البوت) من قائمة معرفات"""
+        with self.lock:
+            excluded = self.flags['banned'] | ~self.flags['reachable']
+            result = []
+            for user_id in user_ids:
+                index = self.ordinals.get(user_id)
+                if index is not None and not (excluded >> index) & 1:
+                    result.append(user_id)
+            return result
+    
+    @staticmethod
+    def count(bitmap: int) -> int:
+        return bin(bitmap).count('1')
+    
+    @staticmethod
+    def _iter_sorted_prefix(bitmap: int, ids: SegmentIds, start: int):
+        """معرفات البادئة المرتبة المحددة في bitmap بدءاً من الموضع start (تصاعدياً)"""
+        prefix = ids.sorted_count
+        bitmap = (bitmap >> start) & ((1 << max(0, prefix - start)) - 1)
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+        for byte_index, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                yield ids[start + byte_index * 8 + low.bit_length() - 1]
+                byte ^= low
+    
+    @staticmethod
+    def iter_batches(bitmap: int, ids: SegmentIds, after_id: int, batch_size: int):
+        """توليد دفعات معرفات من bitmap تصاعدياً بعد after_id (دون بناء القائمة كاملة)
+        
+        البادئة المرتبة تُمشى بتاً بت، والذيل غير المرتب (المنضمون منذ آخر بناء) يُرتب ويُدمج.
+        """
+        prefix = ids.sorted_count
+        start = bisect.bisect_right(ids, after_id, 0, prefix)
+        tail_bits = bitmap >> prefix
+        tail = sorted(
+            ids[prefix + offset] for offset in range(tail_bits.bit_length())
+            if tail_bits >> offset & 1 and ids[prefix + offset] > after_id
+        )
+        batch = []
+        for user_id in heapq.merge(SegmentIndex._iter_sorted_prefix(bitmap, ids, start), tail):
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+segment_index = SegmentIndex()
+segment_index.subscribe_to(event_bus)
+
+def record_country_interest(user_id: int, country_id: int):
+    """تسجيل اهتمام المستخدم بدولة (كتابة واحدة فقط لكل زوج)"""
+    if not segment_index.add_country_interest(user_id, country_id):
+        return
+    
+    conn = db_connect()
+    if conn is None:
+        return
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("INSERT OR IGNORE INTO user_country_interest (user_id, country_id) VALUES (?, ?)",
+                   (user_id, country_id))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"خطأ في تسجيل اهتمام المستخدم {user_id} بالدولة {country_id}: {e}")
+    finally:
+        conn.close()
+
+# ================================
+# نظام الإذاعة المتقدم
+# ================================
+
+BROADCAST_STATE_LOCK = threading.Lock()
+
+def start_broadcast(ad_id: int, target_audience: str = 'all') -> str:
+    """بدء إذاعة مع إمكانية الاستئناف"""
+    try:
+        # إنشاء معرف فريد للإذاعة
+        broadcast_id = hashlib.md5(f"{ad_id}_{time.time()}".encode()).hexdigest()[:16]
+        
+        conn = db_connect()
+        if conn is None:
+            return None
         
-        for user_id in users:
-            try:
-                # فحص إذا تم إيقاف الإذاعة
-                cur.execute("SELECT status FROM broadcast_progress WHERE broadcast_id = ?", (broadcast_id,))
-                status_row = cur.fetchone()
-                
-                if not status_row or status_row[0] != 'running':
-                    break
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM advertisements WHERE id = ? AND is_active = 1", (ad_id,))
+        
+        if not cur.fetchone():
+            conn.close()
+            return None
+        
+        # عدد الجمهور فقط - المعرفات تُقرأ من bitmap الشريحة على دفعات أثناء الإرسال
+        try:
+            audience, _ = segment_index.audience(target_audience)
+        except SegmentExpressionError as e:
+            logger.error(f"❌ جمهور إذاعة غير صالح '{target_audience}': {e}")
+            conn.close()
+            return None
+        total_users = segment_index.count(audience)
+        
+        # حفظ حالة الإذاعة
+        cur.execute("""
+            INSERT INTO broadcast_progress (broadcast_id, ad_id, total_users, status, target_audience)
+            VALUES (?, ?, ?, 'running', ?)
+        """, (broadcast_id, ad_id, total_users, target_audience))
+        
+        conn.commit()
+        conn.close()
+        
+        launch_broadcast(broadcast_id)
+        
+        logger.info(f"📢 تم بدء الإذاعة {broadcast_id} لـ {total_users} مستخدم")
+        return broadcast_id
+        
+    except Exception as e:
+        logger.error(f"❌ خطأ في بدء الإذاعة: {e}")
+        return None
+
+def launch_broadcast(broadcast_id: str) -> bool:
+    """تشغيل خيط الإذاعة إذا لم يكن يعمل في هذه العملية (في العملية التابعة تنتظر مهمة resume في القائد)"""
+    if not process_coordinator.is_leader:
+        return False
+    with BROADCAST_STATE_LOCK:
+        if broadcast_id in BROADCAST_STATE:
+            return False
+        BROADCAST_STATE[broadcast_id] = {'start_time': time.time()}
+    
+    broadcast_thread = threading.Thread(
+        target=broadcast_worker,
+        args=(broadcast_id,),
+        name=f"broadcast-{broadcast_id}",
+        daemon=True
+    )
+    broadcast_thread.start()
+    return True
+
+def resume_broadcasts() -> int:
+    """استئناف الإذاعات التي كانت تعمل قبل إعادة التشغيل من current_user_id"""
+    conn = db_connect()
+    if conn is None:
+        return 0
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT broadcast_id, current_user_id FROM broadcast_progress WHERE status = 'running'")
+        rows = cur.fetchall()
+    except Exception as e:
+        logger.error(f"❌ خطأ في جلب الإذاعات الجارية: {e}")
+        return 0
+    finally:
+        conn.close()
+    
+    resumed = 0
+    for row in rows:
+        if launch_broadcast(row['broadcast_id']):
+            resumed += 1
+            logger.info(f"🔁 استئناف الإذاعة {row['broadcast_id']} بعد المستخدم {row['current_user_id']}")
+    return resumed
+
+# دوال الإرسال بـ file_id لكل نوع وسائط (لا تُرفع أي بايتات لكل مستلم)
+AD_MEDIA_SENDERS = {
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'animation': 'send_animation',
+    'document': 'send_document',
+}
+
+def format_broadcast_text(ad) -> str:
+    """نص رسالة الإعلان"""
+    return f"<b>{ad['title']}</b>\n\n{ad['content']}"
+
+def broadcast_sender(ad) -> Callable[[int], Any]:
+    """دالة إرسال الإعلان لمستخدم واحد: نسخ رسالة المصدر، أو وسائط بـ file_id، أو نص"""
+    if ad['source_chat_id'] and ad['source_message_id']:
+        # copyMessage يحافظ على الوسائط والتنسيق والأزرار دون إعادة رفع
+        return lambda user_id: bot.copy_message(user_id, ad['source_chat_id'], ad['source_message_id'])
+    
+    text = format_broadcast_text(ad)
+    if ad['file_id'] and ad['media_type'] in AD_MEDIA_SENDERS:
+        send_media = getattr(bot, AD_MEDIA_SENDERS[ad['media_type']])
+        return lambda user_id: send_media(user_id, ad['file_id'], caption=text)
+    
+    return lambda user_id: bot.send_message(user_id, text)
+
+def deliver_broadcast(user_id: int, send: Callable[[int], Any]) -> Tuple[str, Optional[str]]:
+    """إرسال رسالة إذاعة لمستخدم: (sent | blocked | rate_limited | failed | deferred، الخطأ)
+    
+    deferred = انقطاع عام في Telegram (دائرة مفتوحة): لم يُرسل شيء ويُعاد المستلم بعد انتظار الدفعة.
+    """
+    try:
+        send(user_id)
+        return 'sent', None
+    except CircuitOpenError as e:
+        if e.chat_id is not None:
+            return 'failed', f"{user_id}: {e}"
+        return 'deferred', None
+    except telebot.apihelper.ApiTelegramException as e:
+        error_class = classify_send_error(e)
+        if error_class == 'unreachable':
+            # المستخدم حظر البوت أو حذف حسابه - ليس خطأً يستحق التسجيل
+            return 'blocked', None
+        if error_class == 'rate_limited':
+            # الجدولة أعادت المحاولة وأوقفت المسار واستنفدت محاولاتها: نهائي لهذا المستلم
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            return 'rate_limited', f"{user_id}: 429 retry_after={retry_after}"
+        return 'failed', f"{user_id}: {e.description}"
+    except Exception as e:
+        return 'failed', f"{user_id}: {e}"
+
+def broadcast_worker(broadcast_id: str):
+    """خيط عمل الإذاعة: دفعات بمؤشر id، إرسال متزامن، وحفظ التقدم لكل دفعة"""
+    conn = db_connect()
+    if conn is None:
+        with BROADCAST_STATE_LOCK:
+            BROADCAST_STATE.pop(broadcast_id, None)
+        return
+    
+    cur = conn.cursor()
+    # خيوط الإرسال تعمل في مسار الإذاعة (أدنى أولوية في الجدولة)
+    executor = ThreadPoolExecutor(
+        max_workers=BROADCAST_CONCURRENCY,
+        thread_name_prefix=f"bc-{broadcast_id[:6]}",
+        initializer=lambda: setattr(_outbound_context, 'lane', LANE_BROADCAST)
+    )
+    try:
+        cur.execute("SELECT * FROM broadcast_progress WHERE broadcast_id = ?", (broadcast_id,))
+        progress = cur.fetchone()
+        if not progress:
+            return
+        
+        cur.execute("SELECT * FROM advertisements WHERE id = ?", (progress['ad_id'],))
+        ad = cur.fetchone()
+        if not ad:
+            cur.execute("UPDATE broadcast_progress SET status = 'failed', end_time = CURRENT_TIMESTAMP WHERE broadcast_id = ?", (broadcast_id,))
+            conn.commit()
+            return
+        
+        send = broadcast_sender(ad)
+        cursor_id = progress['current_user_id'] or 0
+        snapshot_ids = unpack_user_ids(progress['audience_snapshot']) if progress['audience_snapshot'] else None
+        if snapshot_ids is not None:
+            # جمهور مُجمّد وقت الجدولة - يُستبعد فقط من حُظر أو حظر البوت منذ ذلك الحين
+            batches = snapshot_batches(snapshot_ids, cursor_id, BROADCAST_BATCH_SIZE)
+            remaining = len(snapshot_ids) - bisect.bisect_right(snapshot_ids, cursor_id)
+        else:
+            audience, audience_ids = segment_index.audience(progress['target_audience'] or 'all')
+            batches = segment_index.iter_batches(audience, audience_ids, cursor_id, BROADCAST_BATCH_SIZE)
+            remaining = 0
+        counts = {
+            'sent': progress['sent_count'] or 0,
+            # failed_count المحفوظ يشمل تجاوزات الحد
+            'failed': (progress['failed_count'] or 0) - (progress['rate_limited_count'] or 0),
+            'blocked': progress['blocked_count'] or 0,
+            'rate_limited': progress['rate_limited_count'] or 0,
+        }
+        errors_list = deque((progress['errors'] or '').splitlines(), maxlen=10)
+        
+        def save_progress(cursor_id: int):
+            cur.execute("""
+                UPDATE broadcast_progress 
+                SET sent_count = ?, failed_count = ?, blocked_count = ?, rate_limited_count = ?,
+                    current_user_id = ?, errors = ?
+                WHERE broadcast_id = ?
+            """, (counts['sent'], counts['failed'] + counts['rate_limited'], counts['blocked'], counts['rate_limited'],
+                  cursor_id, '\n'.join(errors_list), broadcast_id))
+            conn.commit()
+            
+            with BROADCAST_STATE_LOCK:
+                BROADCAST_STATE[broadcast_id].update(ad_id=progress['ad_id'], current_user_id=cursor_id,
+                                                     total_users=progress['total_users'], **counts)
+        
+        for batch in batches:
+            pending = segment_index.filter_deliverable(batch) if snapshot_ids is not None else batch
+            retrying = False
+            while True:
+                # فحص الإيقاف مرة لكل دفعة (ولكل إعادة للمؤجلين)
+                if not is_broadcast_running(cur, broadcast_id):
+                    logger.info(f"⏹️ توقفت الإذاعة {broadcast_id} عند المستخدم {cursor_id}")
+                    return
                 
-                # إرسال الرسالة
-                if safe_send(user_id, f"<b>{ad[1]}</b>\n\n{ad[2]}"):
-                    sent_count += 1
-                else:
-                    failed_count += 1
-                    errors_list.append(f"فشل إرسال للمستخدم {user_id}")
+                # إيقاف مؤقت بدل آلاف الطلبات المحكوم عليها بالفشل أثناء انقطاع Telegram
+                outage = telegram_resilience.open_wait()
+                if outage > 0 or retrying:
+                    if outage > 0:
+                        logger.warning(f"⏸️ إيقاف الإذاعة {broadcast_id} مؤقتاً {outage:.0f} ثانية (دائرة مفتوحة)")
+                    if not sleep_while_broadcast_running(cur, broadcast_id, max(outage, 1.0)):
+                        logger.info(f"⏹️ توقفت الإذاعة {broadcast_id} عند المستخدم {cursor_id}")
+                        return
                 
-                # تحديث التقدم
-                cur.execute("""
-                    UPDATE broadcast_progress 
-                    SET sent_count = ?, failed_count = ?, current_user_id = ?, errors = ?
-                    WHERE broadcast_id = ?
-                """, (sent_count, failed_count, user_id, '\n'.join(errors_list[-10:]), broadcast_id))
+                # تجاوز الحد يوقف مسار الإذاعة في الجدولة: الانتظار هنا مرة للدفعة بدل كل خيط إرسال
+                paused = outbound_scheduler.lane_pause(LANE_BROADCAST)
+                if paused > 0 and not sleep_while_broadcast_running(cur, broadcast_id, paused):
+                    logger.info(f"⏹️ توقفت الإذاعة {broadcast_id} عند المستخدم {cursor_id}")
+                    return
                 
-                conn.commit()
+                blocked_ids = []
+                deferred = []
+                for user_id, (outcome, error) in zip(pending, executor.map(lambda uid: deliver_broadcast(uid, send), pending)):
+                    if outcome == 'deferred':
+                        deferred.append(user_id)
+                        continue
+                    counts[outcome] += 1
+                    if outcome == 'blocked':
+                        blocked_ids.append(user_id)
+                    if error:
+                        errors_list.append(error)
                 
-                # انتظار قصير لتجنب rate limiting
-                time.sleep(0.1)
+                # استبعاد من حظروا البوت من الإذاعات القادمة
+                mark_users_unreachable(blocked_ids)
                 
-            except Exception as e:
-                failed_count += 1
-                errors_list.append(f"خطأ في إرسال الإذاعة للمستخدم {user_id}: {str(e)}")
-                logger.error(f"❌ خطأ في إرسال الإذاعة للمستخدم {user_id}: {e}")
+                if not deferred:
+                    break
+                # المؤشر لا يتجاوز أول مؤجل: عند الإيقاف الآن يُستأنف منه
+                save_progress(max([cursor_id] + [user_id for user_id in batch if user_id < deferred[0]]))
+                pending = deferred
+                retrying = True
+            
+            cursor_id = batch[-1]
+            save_progress(cursor_id)
+            
+            # توزيع الإرسال على نافذة الإذاعة المجدولة بدل إرسال كل شيء دفعة واحدة
+            remaining -= len(batch)
+            if progress['pace_until'] and remaining > 0:
+                delay = (progress['pace_until'] - time.time()) * len(batch) / (remaining + len(batch))
+                if delay > 0 and not sleep_while_broadcast_running(cur, broadcast_id, delay):
+                    logger.info(f"⏹️ توقفت الإذاعة {broadcast_id} عند المستخدم {cursor_id}")
+                    return
         
         # إنهاء الإذاعة
         cur.execute("""
@@ -1449,14 +4156,41 @@ def broadcast_worker(broadcast_id: str, ad_id: int, users: List[int]):
             SET status = 'completed', end_time = CURRENT_TIMESTAMP
             WHERE broadcast_id = ?
         """, (broadcast_id,))
-        
+        cur.execute("UPDATE advertisements SET sent_to = sent_to + ? WHERE id = ?", (counts['sent'], progress['ad_id']))
         conn.commit()
-        conn.close()
         
-        logger.info(f"✅ تمت الإذاعة {broadcast_id}: {sent_count} نجح، {failed_count} فشل")
+        logger.info(f"✅ تمت الإذاعة {broadcast_id}: {counts['sent']} نجح، {counts['blocked']} محظور، "
+                    f"{counts['failed']} فشل، {counts['rate_limited']} تجاوز الحد")
         
     except Exception as e:
         logger.error(f"❌ خطأ في worker الإذاعة: {e}")
+    finally:
+        executor.shutdown(wait=True)
+        conn.close()
+        with BROADCAST_STATE_LOCK:
+            BROADCAST_STATE.pop(broadcast_id, None)
+
+def is_broadcast_running(cur, broadcast_id: str) -> bool:
+    """هل لا تزال الإذاعة في حالة running (لم يوقفها المشرف) وهذه العملية القائدة
+    
+    فقدان القيادة يوقف الخيط دون تغيير الحالة، فيكملها القائد الجديد من current_user_id.
+    """
+    if not process_coordinator.is_leader:
+        return False
+    cur.execute("SELECT status FROM broadcast_progress WHERE broadcast_id = ?", (broadcast_id,))
+    status_row = cur.fetchone()
+    return bool(status_row) and status_row[0] == 'running'
+
+def sleep_while_broadcast_running(cur, broadcast_id: str, delay: float) -> bool:
+    """انتظار (توزيع أو انقطاع) مع فحص الإيقاف كل بضع ثوانٍ - False إذا أُوقفت الإذاعة"""
+    deadline = time.time() + delay
+    while True:
+        left = deadline - time.time()
+        if left <= 0:
+            return True
+        time.sleep(min(left, 5))
+        if not is_broadcast_running(cur, broadcast_id):
+            return False
 
 def get_broadcast_progress(broadcast_id: str) -> Optional[Dict]:
     """جلب تقدم الإذاعة"""
@@ -1474,20 +4208,10 @@ def get_broadcast_progress(broadcast_id: str) -> Optional[Dict]:
         
         row = cur.fetchone()
         if row:
-            return {
-                'broadcast_id': row[1],
-                'ad_id': row[2],
-                'current_user_id': row[3],
-                'total_users': row[4],
-                'sent_count': row[5],
-                'failed_count': row[6],
-                'status': row[7],
-                'start_time': row[8],
-                'end_time': row[9],
-                'errors': row[10],
-                'title': row[11],
-                'content': row[12]
-            }
+            progress = dict(row)
+            progress.pop('id', None)
+            progress.pop('audience_snapshot', None)
+            return progress
         return None
         
     except Exception as e:
@@ -1520,97 +4244,329 @@ def stop_broadcast(broadcast_id: str) -> bool:
         conn.close()
 
 # ================================
-# إدارة المستخدمين والتحكم
+# الإذاعات المجدولة والمتكررة
 # ================================
 
-def add_user_if_not_exists(user):
-    """إضافة المستخدم إذا لم يكن موجوداً"""
+def pack_user_ids(user_ids: List[int]) -> bytes:
+    """ضغط قائمة معرفات مرتبة: فروق متتالية بترميز varint ثم zlib"""
+    out = bytearray()
+    previous = 0
+    for user_id in user_ids:
+        delta = user_id - previous
+        previous = user_id
+        while delta >= 0x80:
+            out.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return zlib.compress(bytes(out))
+
+def unpack_user_ids(blob: bytes) -> List[int]:
+    """فك ضغط لقطة معرفات من pack_user_ids"""
+    user_ids = []
+    current = shift = delta = 0
+    for byte in zlib.decompress(blob):
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        current += delta
+        user_ids.append(current)
+        delta = shift = 0
+    return user_ids
+
+def snapshot_audience(target_audience: str) -> Tuple[bytes, int]:
+    """لقطة مضغوطة لجمهور الشريحة الآن (تُرفع SegmentExpressionError إن كان التعبير غير صالح)"""
+    audience, ids = segment_index.audience(target_audience)
+    user_ids = [user_id for batch in segment_index.iter_batches(audience, ids, 0, BROADCAST_BATCH_SIZE)
+                for user_id in batch]
+    return pack_user_ids(user_ids), len(user_ids)
+
+def snapshot_batches(user_ids: List[int], after_id: int, batch_size: int):
+    """دفعات من لقطة مرتبة بعد after_id"""
+    start = bisect.bisect_right(user_ids, after_id)
+    for offset in range(start, len(user_ids), batch_size):
+        yield user_ids[offset:offset + batch_size]
+
+def send_window_bounds(moment: datetime, window: Optional[Tuple[int, int]]) -> Tuple[datetime, Optional[datetime]]:
+    """أول لحظة إرسال مسموحة بعد moment ونهاية نافذتها (النافذة بالساعات وقد تتجاوز منتصف الليل)"""
+    if not window:
+        return moment, None
+    start_hour, end_hour = window
+    length = (end_hour - start_hour) % 24 or 24
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    # النافذة التي بدأت أمس قد تكون لا تزال مفتوحة
+    for offset in (-1, 0, 1):
+        start = day + timedelta(days=offset, hours=start_hour)
+        end = start + timedelta(hours=length)
+        if moment < end:
+            return max(moment, start), end
+    start = day + timedelta(days=2, hours=start_hour)
+    return start, start + timedelta(hours=length)
+
+def schedule_broadcast(ad_id: int, target_audience: str = 'all', run_at: Optional[datetime] = None,
+                       window: Optional[Tuple[int, int]] = None, interval_hours: int = 0,
+                       created_by: Optional[int] = None) -> Optional[int]:
+    """جدولة إذاعة لمرة واحدة أو متكررة مع تجميد الجمهور في لقطة مضغوطة"""
+    try:
+        snapshot, audience_count = snapshot_audience(target_audience)
+    except SegmentExpressionError as e:
+        logger.error(f"❌ جمهور جدولة غير صالح '{target_audience}': {e}")
+        return None
+    
+    run_at, _ = send_window_bounds(run_at or datetime.now(), window)
+    
     conn = db_connect()
     if conn is None:
-        return
+        return None
     
     cur = conn.cursor()
     try:
-        cur.execute("SELECT id FROM users WHERE id = ?", (user.id,))
+        cur.execute("SELECT id FROM advertisements WHERE id = ? AND is_active = 1", (ad_id,))
         if not cur.fetchone():
-            cur.execute("""
-                INSERT INTO users (id, username, first_name, last_name, notified_admin)
-                VALUES (?, ?, ?, ?, 0)
-            """, (user.id, user.username or "", user.first_name or "", user.last_name or ""))
-            conn.commit()
-            logger.info(f"➕ مستخدم جديد: {user.id} - @{user.username}")
-            
-            # فحص الدعوات
-            invited_by = ADMIN_STATE.get(user.id)
-            if isinstance(invited_by, int) and invited_by != user.id:
-                set_invited_by(user.id, invited_by)
-                award_invite_points(invited_by, user.id)
-            
-            # إلغاء التخزين المؤقت
-            cache_manager.invalidate_user_cache(user.id)
-            
+            return None
+        
+        cur.execute("""
+            INSERT INTO scheduled_broadcasts (ad_id, target_audience, audience_snapshot, audience_count,
+                                              run_at, window_start, window_end, interval_hours, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (ad_id, target_audience, snapshot, audience_count, run_at.strftime('%Y-%m-%d %H:%M:%S'),
+              window[0] if window else None, window[1] if window else None, interval_hours, created_by))
+        conn.commit()
+        
+        logger.info(f"🗓️ جدولة الإعلان {ad_id} في {run_at:%Y-%m-%d %H:%M} لـ {audience_count} مستخدم "
+                    f"({len(snapshot)} بايت)")
+        return cur.lastrowid
     except Exception as e:
-        logger.error(f"❌ خطأ في إضافة المستخدم: {e}")
+        logger.error(f"❌ خطأ في جدولة الإذاعة: {e}")
+        return None
     finally:
         conn.close()
 
-def set_invited_by(user_id: int, inviter_id: int):
-    """تعيين الداعي"""
+def cancel_scheduled_broadcast(schedule_id: int) -> bool:
+    """إلغاء إذاعة مجدولة (لا يوقف إذاعة بدأت بالفعل)"""
     conn = db_connect()
     if conn is None:
-        return
+        return False
     
     cur = conn.cursor()
     try:
-        cur.execute("UPDATE users SET invited_by = ? WHERE id = ?", (inviter_id, user_id))
-        cur.execute("UPDATE users SET total_invites = total_invites + 1 WHERE id = ?", (inviter_id,))
+        cur.execute("UPDATE scheduled_broadcasts SET status = 'cancelled' WHERE id = ? AND status = 'scheduled'",
+                   (schedule_id,))
         conn.commit()
-        logger.info(f"👥 تم تعيين الداعي {inviter_id} للمستخدم {user_id}")
+        return cur.rowcount > 0
     except Exception as e:
-        logger.error(f"❌ خطأ في تعيين الداعي: {e}")
+        logger.error(f"خطأ في إلغاء الجدولة: {e}")
+        return False
     finally:
         conn.close()
 
-def get_user_pro_info(user_id: int) -> Optional[Dict]:
-    """جلب معلومات اشتراك PRO"""
+def get_scheduled_broadcasts(limit: int = 20) -> List[Dict]:
+    """الإذاعات المجدولة القادمة"""
     conn = db_connect()
     if conn is None:
-        return None
+        return []
     
     cur = conn.cursor()
     try:
         cur.execute("""
-            SELECT ps.*, u.username FROM pro_subscriptions ps
-            LEFT JOIN users u ON ps.user_id = u.id
-            WHERE ps.user_id = ? AND ps.is_active = 1
-            ORDER BY ps.started_at DESC LIMIT 1
-        """, (user_id,))
-        
-        row = cur.fetchone()
-        return dict(row) if row else None
-        
+            SELECT sb.id, sb.ad_id, sb.target_audience, sb.audience_count, sb.run_at, sb.window_start,
+                   sb.window_end, sb.interval_hours, sb.last_broadcast_id, a.title
+            FROM scheduled_broadcasts sb
+            LEFT JOIN advertisements a ON sb.ad_id = a.id
+            WHERE sb.status = 'scheduled'
+            ORDER BY sb.run_at LIMIT ?
+        """, (limit,))
+        return [dict(row) for row in cur.fetchall()]
     except Exception as e:
-        logger.error(f"خطأ في جلب معلومات PRO: {e}")
-        return None
+        logger.error(f"خطأ في جلب الإذاعات المجدولة: {e}")
+        return []
     finally:
         conn.close()
 
-def get_pro_users_count() -> int:
-    """جلب عدد مشتركي PRO النشطين"""
+def run_scheduled_broadcast(schedule) -> Optional[str]:
+    """تشغيل إذاعة مجدولة حان وقتها وجدولة تكرارها التالي"""
+    window = (schedule['window_start'], schedule['window_end']) if schedule['window_start'] is not None else None
+    now = datetime.now()
+    start, window_end = send_window_bounds(now, window)
+    
     conn = db_connect()
     if conn is None:
-        return 0
+        return None
     
     cur = conn.cursor()
     try:
+        if start > now:
+            # فات موعد النافذة (توقف البوت مثلاً): الانتظار حتى النافذة التالية بدل الإرسال وقت الذروة
+            cur.execute("UPDATE scheduled_broadcasts SET run_at = ? WHERE id = ?",
+                       (start.strftime('%Y-%m-%d %H:%M:%S'), schedule['id']))
+            conn.commit()
+            return None
+        
+        broadcast_id = hashlib.md5(f"sched_{schedule['id']}_{time.time()}".encode()).hexdigest()[:16]
         cur.execute("""
-            SELECT COUNT(*) as count FROM users 
-            WHERE is_pro = 1 AND (pro_expiry IS NULL OR pro_expiry > datetime('now'))
-        """)
-        result = cur.fetchone()
-        return result[0] if result else 0
-    except Exception as e:
-        logger.error(f"خطأ في جلب عدد PRO: {e}")
+            INSERT INTO broadcast_progress (broadcast_id, ad_id, total_users, status, target_audience,
+                                            schedule_id, audience_snapshot, pace_until)
+            VALUES (?, ?, ?, 'running', ?, ?, ?, ?)
+        """, (broadcast_id, schedule['ad_id'], schedule['audience_count'], schedule['target_audience'],
+              schedule['id'], schedule['audience_snapshot'], window_end.timestamp() if window_end else None))
+        
+        if schedule['interval_hours']:
+            # التكرار التالي بلقطة جمهور جديدة تؤخذ الآن
+            next_run = datetime.strptime(schedule['run_at'], '%Y-%m-%d %H:%M:%S')
+            while next_run <= now:
+                next_run += timedelta(hours=schedule['interval_hours'])
+            next_run, _ = send_window_bounds(next_run, window)
+            cur.execute("""
+                UPDATE scheduled_broadcasts SET run_at = ?, last_broadcast_id = ? WHERE id = ?
+            """, (next_run.strftime('%Y-%m-%d %H:%M:%S'), broadcast_id, schedule['id']))
+        else:
+            cur.execute("UPDATE scheduled_broadcasts SET status = 'done', last_broadcast_id = ? WHERE id = ?",
+                       (broadcast_id, schedule['id']))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"❌ خطأ في تشغيل الإذاعة المجدولة {schedule['id']}: {e}")
+        return None
+    finally:
+        conn.close()
+    
+    launch_broadcast(broadcast_id)
+    logger.info(f"🗓️ بدء الإذاعة المجدولة {schedule['id']} ({broadcast_id}) لـ {schedule['audience_count']} مستخدم")
+    return broadcast_id
+
+def refresh_schedule_snapshot(schedule_id: int, target_audience: str):
+    """أخذ لقطة جمهور جديدة للتكرار القادم"""
+    try:
+        snapshot, audience_count = snapshot_audience(target_audience)
+    except SegmentExpressionError as e:
+        logger.error(f"❌ جمهور جدولة غير صالح '{target_audience}': {e}")
+        return
+    
+    conn = db_connect()
+    if conn is None:
+        return
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("UPDATE scheduled_broadcasts SET audience_snapshot = ?, audience_count = ? WHERE id = ?",
+                   (snapshot, audience_count, schedule_id))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"خطأ في تحديث لقطة الجمهور للجدولة {schedule_id}: {e}")
+    finally:
+        conn.close()
+
+def run_due_schedules():
+    """تشغيل الإذاعات المجدولة التي حل موعدها (مهمة دورية)"""
+    conn = db_connect()
+    if conn is None:
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT * FROM scheduled_broadcasts
+            WHERE status = 'scheduled' AND run_at <= ?
+            ORDER BY run_at
+        """, (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        due = cur.fetchall()
+    finally:
+        conn.close()
+    
+    for schedule in due:
+        if run_scheduled_broadcast(schedule) and schedule['interval_hours']:
+            refresh_schedule_snapshot(schedule['id'], schedule['target_audience'])
+
+# ================================
+# إدارة المستخدمين والتحكم
+# ================================
+
+def add_user_if_not_exists(user):
+    """إضافة المستخدم إذا لم يكن موجوداً"""
+    conn = db_connect()
+    if conn is None:
+        return
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT id FROM users WHERE id = ?", (user.id,))
+        if not cur.fetchone():
+            cur.execute("""
+                INSERT INTO users (id, username, first_name, last_name, notified_admin)
+                VALUES (?, ?, ?, ?, 0)
+            """, (user.id, user.username or "", user.first_name or "", user.last_name or ""))
+            conn.commit()
+            logger.info(f"➕ مستخدم جديد: {user.id} - @{user.username}")
+            
+            # فحص الدعوات
+            invited_by = ADMIN_STATE.get(user.id)
+            if isinstance(invited_by, int) and invited_by != user.id:
+                set_invited_by(user.id, invited_by)
+                award_invite_points(invited_by, user.id)
+            
+            event_bus.publish(UserRegistered(user.id))
+            
+    except Exception as e:
+        logger.error(f"❌ خطأ في إضافة المستخدم: {e}")
+    finally:
+        conn.close()
+
+def set_invited_by(user_id: int, inviter_id: int):
+    """تعيين الداعي"""
+    conn = db_connect()
+    if conn is None:
+        return
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("UPDATE users SET invited_by = ? WHERE id = ?", (inviter_id, user_id))
+        cur.execute("UPDATE users SET total_invites = total_invites + 1 WHERE id = ?", (inviter_id,))
+        conn.commit()
+        event_bus.publish(UserInvited(user_id, inviter_id))
+        logger.info(f"👥 تم تعيين الداعي {inviter_id} للمستخدم {user_id}")
+    except Exception as e:
+        logger.error(f"❌ خطأ في تعيين الداعي: {e}")
+    finally:
+        conn.close()
+
+def get_user_pro_info(user_id: int) -> Optional[Dict]:
+    """جلب معلومات اشتراك PRO"""
+    conn = db_connect()
+    if conn is None:
+        return None
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT ps.*, u.username FROM pro_subscriptions ps
+            LEFT JOIN users u ON ps.user_id = u.id
+            WHERE ps.user_id = ? AND ps.is_active = 1
+            ORDER BY ps.started_at DESC LIMIT 1
+        """, (user_id,))
+        
+        row = cur.fetchone()
+        return dict(row) if row else None
+        
+    except Exception as e:
+        logger.error(f"خطأ في جلب معلومات PRO: {e}")
+        return None
+    finally:
+        conn.close()
+
+def get_pro_users_count() -> int:
+    """جلب عدد مشتركي PRO النشطين"""
+    conn = db_connect()
+    if conn is None:
+        return 0
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT COUNT(*) as count FROM users 
+            WHERE is_pro = 1 AND (pro_expiry IS NULL OR pro_expiry > datetime('now'))
+        """)
+        result = cur.fetchone()
+        return result[0] if result else 0
+    except Exception as e:
+        logger.error(f"خطأ في جلب عدد PRO: {e}")
         return 0
     finally:
         conn.close()
@@ -1665,6 +4621,10 @@ def get_points_history(user_id: int, limit: int = 10) -> List[Dict]:
 
 def is_user_banned(user_id: int) -> bool:
     """فحص إذا كان المستخدم محظوراً"""
+    banned_users = cache_manager.banned_users
+    if banned_users is not None:
+        return user_id in banned_users
+    
     conn = db_connect()
     if conn is None:
         return False
@@ -1691,6 +4651,8 @@ def ban_user(user_id: int) -> bool:
         cur.execute("UPDATE users SET banned = 1 WHERE id = ?", (user_id,))
         conn.commit()
         
+        event_bus.publish(UserBanChanged(user_id, True))
+        
         insert_log(ADMIN_ID, "ban_user", f"user_id={user_id}")
         logger.info(f"🔒 تم حظر المستخدم {user_id}")
         return True
@@ -1712,6 +4674,8 @@ def unban_user(user_id: int) -> bool:
         cur.execute("UPDATE users SET banned = 0 WHERE id = ?", (user_id,))
         conn.commit()
         
+        event_bus.publish(UserBanChanged(user_id, False))
+        
         insert_log(ADMIN_ID, "unban_user", f"user_id={user_id}")
         logger.info(f"🔓 تم إلغاء حظر المستخدم {user_id}")
         return True
@@ -1722,6 +4686,82 @@ def unban_user(user_id: int) -> bool:
     finally:
         conn.close()
 
+# أوصاف أخطاء 403 التي تعني أن المستخدم لن يستقبل الرسائل حتى يتفاعل مجدداً
+UNREACHABLE_ERROR_MARKERS = ("blocked", "deactivated", "can't initiate", "kicked")
+
+def classify_send_error(error: Exception) -> str:
+    """تصنيف خطأ الإرسال: unreachable | rate_limited | error (لاستثناءات TeleBot وAsyncTeleBot)"""
+    error_code = getattr(error, 'error_code', None)
+    description = (getattr(error, 'description', None) or "").lower()
+    if error_code == 403 and any(marker in description for marker in UNREACHABLE_ERROR_MARKERS):
+        return 'unreachable'
+    if error_code == 429:
+        return 'rate_limited'
+    return 'error'
+
+def mark_users_unreachable(user_ids: List[int]) -> int:
+    """تعليم المستخدمين كغير قابلين للوصول (استعلام واحد للدفعة)"""
+    if not user_ids:
+        return 0
+    
+    conn = db_connect()
+    if conn is None:
+        return 0
+    
+    cur = conn.cursor()
+    try:
+        cur.executemany("UPDATE users SET unreachable = 1 WHERE id = ? AND unreachable = 0",
+                       [(user_id,) for user_id in user_ids])
+        conn.commit()
+        # بلا تغيير فعلي لا حدث (كل حدث يرفع جيل "users" في العمليات الأخرى)
+        if cur.rowcount:
+            event_bus.publish(UserReachabilityChanged(tuple(user_ids), False))
+        return cur.rowcount
+    except Exception as e:
+        logger.error(f"❌ خطأ في تعليم المستخدمين غير القابلين للوصول: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def mark_user_reachable(user_id: int):
+    """إعادة تفعيل المستخدم بعد تفاعله مع البوت"""
+    conn = db_connect()
+    if conn is None:
+        return
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("UPDATE users SET unreachable = 0 WHERE id = ? AND unreachable = 1", (user_id,))
+        conn.commit()
+        if cur.rowcount:
+            event_bus.publish(UserReachabilityChanged((user_id,), True))
+            logger.info(f"🔔 عاد المستخدم {user_id} للتفاعل - تمت إعادة تفعيله للإذاعة")
+        elif cache_manager.unreachable_users is not None:
+            # المجموعة المحلية قديمة: تصحيحها محلياً حتى لا يتكرر الاستعلام مع كل تفاعل
+            cache_manager.unreachable_users.discard(user_id)
+    except Exception as e:
+        logger.error(f"خطأ في إعادة تفعيل المستخدم {user_id}: {e}")
+    finally:
+        conn.close()
+
+def is_user_marked_unreachable(user_id: int) -> bool:
+    """فحص في الذاكرة (True إذا لم تُحمّل المجموعة بعد حتى يُفحص في قاعدة البيانات)"""
+    unreachable = cache_manager.unreachable_users
+    return unreachable is None or user_id in unreachable
+
+def note_user_interaction(user_id: int):
+    """إعادة التفعيل فقط إذا كان المستخدم معلّماً"""
+    if is_user_marked_unreachable(user_id):
+        mark_user_reachable(user_id)
+
+def interaction_user_id(update) -> Optional[int]:
+    """المستخدم الذي تفاعل مع البوت في التحديث (رسالة أو زر)"""
+    for field in ('message', 'callback_query'):
+        obj = getattr(update, field, None)
+        if obj is not None and getattr(obj, 'from_user', None) is not None:
+            return obj.from_user.id
+    return None
+
 def mark_user_notified(user_id: int):
     """تعيين المستخدم كمُخطَر للمشرف"""
     conn = db_connect()
@@ -1796,8 +4836,7 @@ def set_setting(key: str, value: str):
         cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_settings_cache()
+        event_bus.publish(SettingChanged(key, value))
         
         insert_log(ADMIN_ID, f"set_setting {key}", value)
         logger.info(f"⚙️ تم تحديث الإعداد: {key} = {value}")
@@ -1808,36 +4847,9 @@ def set_setting(key: str, value: str):
         conn.close()
 
 def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
-    """جلب إعداد مع التخزين المؤقت"""
-    if key not in cache_manager.settings_cache or cache_manager._is_expired(
-        cache_manager.settings_cache[key]['cache_time'],
-        cache_manager.CACHE_TTL['settings']
-    ):
-        conn = db_connect()
-        if conn is None:
-            return default
-        
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = cur.fetchone()
-            value = row[0] if row else default
-            
-            # تحديث التخزين المؤقت
-            cache_manager.settings_cache[key] = {
-                'value': value,
-                'cache_time': time.time()
-            }
-            
-            return value
-            
-        except Exception as e:
-            logger.error(f"خطأ في جلب الإعداد: {e}")
-            return default
-        finally:
-            conn.close()
-    else:
-        return cache_manager.settings_cache[key]['value']
+    """جلب قيمة إعداد نصية من النسخة الحالية"""
+    value = settings.current.raw.get(key)
+    return value if value is not None else default
 
 def add_mandatory_channel(channel: str, is_group: bool = False, require_join: bool = True):
     """إضافة قناة إجبارية"""
@@ -1854,6 +4866,8 @@ def add_mandatory_channel(channel: str, is_group: bool = False, require_join: bo
         
         conn.commit()
         
+        event_bus.publish(ChannelsChanged(channel))
+        
         insert_log(ADMIN_ID, "add_mandatory_channel", 
                   f"{channel} is_group={is_group} require_join={require_join}")
         logger.info(f"📢 تمت إضافة القناة الإجبارية: {channel}")
@@ -1874,6 +4888,8 @@ def remove_mandatory_channel(channel: str):
         cur.execute("DELETE FROM mandatory_channels WHERE channel = ?", (channel,))
         conn.commit()
         
+        event_bus.publish(ChannelsChanged(channel))
+        
         insert_log(ADMIN_ID, "remove_mandatory_channel", channel)
         logger.info(f"🗑️ تمت إزالة القناة الإجبارية: {channel}")
         
@@ -1893,8 +4909,7 @@ def update_country_activation_channel(country_id: int, channel: str):
         cur.execute("UPDATE countries SET activation_channel = ? WHERE id = ?", (channel, country_id))
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_country_cache()
+        event_bus.publish(CountryChanged(country_id))
         
         insert_log(ADMIN_ID, "update_country_channel", f"country_id={country_id} channel={channel}")
         logger.info(f"🔗 تم تحديث قناة تفعيل الدولة {country_id} إلى {channel}")
@@ -1906,20 +4921,8 @@ def update_country_activation_channel(country_id: int, channel: str):
 
 def get_country_activation_channel(country_id: int) -> Optional[str]:
     """جلب قناة التفعيل للدولة"""
-    conn = db_connect()
-    if conn is None:
-        return None
-    
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT activation_channel FROM countries WHERE id = ?", (country_id,))
-        row = cur.fetchone()
-        return row[0] if row and row[0] else None
-    except Exception as e:
-        logger.error(f"خطأ في جلب قناة التفعيل: {e}")
-        return None
-    finally:
-        conn.close()
+    row = cache_manager.get_country(country_id)
+    return row['activation_channel'] if row and row['activation_channel'] else None
 
 def toggle_country_status(country_id: int) -> Optional[int]:
     """تبديل حالة الدولة (تفعيل/إلغاء تفعيل)"""
@@ -1937,8 +4940,7 @@ def toggle_country_status(country_id: int) -> Optional[int]:
         
         conn.commit()
         
-        # إلغاء التخزين المؤقت
-        cache_manager.invalidate_country_cache()
+        event_bus.publish(CountryChanged(country_id))
         
         insert_log(ADMIN_ID, "toggle_country", f"country_id={country_id} status={new_status}")
         logger.info(f"🌐 تم تبديل حالة الدولة {country_id} إلى {'مفعل' if new_status else 'معطل'}")
@@ -1951,6 +4953,14 @@ def toggle_country_status(country_id: int) -> Optional[int]:
     finally:
         conn.close()
 
+def write_number_used(cur: sqlite3.Cursor, number_id: Optional[int]):
+    """كتابة استخدام الرقم داخل معاملة المستدعي"""
+    cur.execute("""
+        UPDATE numbers 
+        SET times_used = times_used + 1, last_used = CURRENT_TIMESTAMP 
+        WHERE id = ?
+    """, (number_id,))
+
 def mark_number_used(number_id: int):
     """تعيين الرقم كمستخدم"""
     conn = db_connect()
@@ -1959,12 +4969,7 @@ def mark_number_used(number_id: int):
     
     cur = conn.cursor()
     try:
-        cur.execute("""
-            UPDATE numbers 
-            SET times_used = times_used + 1, last_used = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        """, (number_id,))
-        
+        write_number_used(cur, number_id)
         conn.commit()
         
     except Exception as e:
@@ -1976,8 +4981,10 @@ def mark_number_used(number_id: int):
 # إدارة الإعلانات
 # ================================
 
-def create_advertisement(title: str, content: str, created_by: int, target_audience: str = 'all') -> Optional[int]:
-    """إنشاء إعلان جديد"""
+def create_advertisement(title: str, content: str, created_by: int, target_audience: str = 'all',
+                         media_type: Optional[str] = None, file_id: Optional[str] = None,
+                         source_chat_id: Optional[int] = None, source_message_id: Optional[int] = None) -> Optional[int]:
+    """إنشاء إعلان جديد (نصي، أو وسائط عبر file_id، أو نسخة من رسالة مصدر)"""
     conn = db_connect()
     if conn is None:
         return None
@@ -1985,9 +4992,10 @@ def create_advertisement(title: str, content: str, created_by: int, target_audie
     cur = conn.cursor()
     try:
         cur.execute("""
-            INSERT INTO advertisements (title, content, created_by, target_audience)
-            VALUES (?, ?, ?, ?)
-        """, (title, content, created_by, target_audience))
+            INSERT INTO advertisements (title, content, created_by, target_audience,
+                                        media_type, file_id, source_chat_id, source_message_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (title, content, created_by, target_audience, media_type, file_id, source_chat_id, source_message_id))
         
         ad_id = cur.lastrowid
         conn.commit()
@@ -2136,6 +5144,10 @@ def insert_log(who: int, action: str, meta: str = ""):
 # وظائف مساعدة وأدوات
 # ================================
 
+def is_command_message(message) -> bool:
+    """رسالة أمر (/...) - تُترك لمعالجات الأوامر ولا تُعامل كإدخال لحالة انتظار"""
+    return bool(message.text) and message.text.startswith('/')
+
 def is_admin(user_id: int) -> bool:
     """فحص إذا كان المستخدم مشرفاً"""
     return user_id == ADMIN_ID
@@ -2150,17 +5162,81 @@ def safe_send(user_id: int, text: str, reply_markup: Optional[types.InlineKeyboa
     """إرسال رسالة آمن"""
     try:
         return bot.send_message(user_id, text, reply_markup=reply_markup, **kwargs)
+    except CircuitOpenError as e:
+        # رُفض محلياً دون طلب: لا داعي لسجل خطأ وكتابة في قاعدة البيانات لكل رسالة
+        logger.debug(f"تخطي الإرسال للمستخدم {user_id}: {e}")
+        return None
     except Exception as e:
+        if classify_send_error(e) == 'unreachable':
+            # المستخدم حظر البوت: تعليمه بدلاً من تسجيل خطأ في كل محاولة
+            mark_users_unreachable([user_id])
+            return None
         logger.error(f"❌ فشل في إرسال الرسالة للمستخدم {user_id}: {e}")
         insert_log(ADMIN_ID, "send_failed", f"user={user_id} error={e}")
         return None
 
+class RenderCache:
+    """بصمة آخر نص ولوحة أزرار عُرضت لكل رسالة (LRU) لتجنب تعديلات مطابقة"""
+    
+    NOT_MODIFIED = "message is not modified"
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[int, int], bytes]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'edits': 0, 'skipped': 0, 'not_modified': 0}
+    
+    @staticmethod
+    def fingerprint(text: str, reply_markup: Optional[types.InlineKeyboardMarkup]) -> bytes:
+        markup_json = reply_markup.to_json() if reply_markup is not None else ''
+        return hashlib.blake2b(f"{text}\x00{markup_json}".encode(), digest_size=16).digest()
+    
+    def is_current(self, chat_id: int, message_id: int, fingerprint: bytes) -> bool:
+        """هل هذه البصمة معروضة حالياً (عندها يُتخطى التعديل ويُحسب)"""
+        with self.lock:
+            if self.entries.get((chat_id, message_id)) != fingerprint:
+                return False
+            self.entries.move_to_end((chat_id, message_id))
+            self.stats['skipped'] += 1
+            return True
+    
+    def remember(self, chat_id: int, message_id: int, fingerprint: bytes, not_modified: bool = False):
+        with self.lock:
+            self.entries[(chat_id, message_id)] = fingerprint
+            self.entries.move_to_end((chat_id, message_id))
+            self.stats['not_modified' if not_modified else 'edits'] += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def forget(self, chat_id: int, message_id: int):
+        with self.lock:
+            self.entries.pop((chat_id, message_id), None)
+    
+    def stats_snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries))
+
+# مع المخزن المشترك قد تعدّل عملية أخرى نفس الرسالة، فلا يُوثق بالبصمة المحلية (سعة 0 = تعطيل)
+render_cache = RenderCache(0 if state_backend.shared else RENDER_CACHE_SIZE)
+
 def safe_edit_message(text: str, chat_id: int, message_id: int, reply_markup: Optional[types.InlineKeyboardMarkup] = None) -> bool:
-    """تحرير رسالة آمن"""
+    """تحرير رسالة آمن (يتخطى التعديل إذا كان المحتوى المعروض مطابقاً)"""
+    fingerprint = render_cache.fingerprint(text, reply_markup)
+    if render_cache.is_current(chat_id, message_id, fingerprint):
+        return True
     try:
         bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup, parse_mode="HTML")
+        render_cache.remember(chat_id, message_id, fingerprint)
         return True
+    except CircuitOpenError as e:
+        logger.debug(f"تخطي تحرير الرسالة {message_id}: {e}")
+        return False
     except Exception as e:
+        if RenderCache.NOT_MODIFIED in str(e):
+            # المحتوى مطابق لما عُرض قبل إنشاء البصمة (مثلاً بعد إعادة التشغيل)
+            render_cache.remember(chat_id, message_id, fingerprint, not_modified=True)
+            return True
+        render_cache.forget(chat_id, message_id)
         logger.error(f"❌ فشل في تحرير الرسالة {message_id} في المحادثة {chat_id}: {e}")
         return False
 
@@ -2169,6 +5245,9 @@ def safe_delete_message(chat_id: int, message_id: int) -> bool:
     try:
         bot.delete_message(chat_id, message_id)
         return True
+    except CircuitOpenError as e:
+        logger.debug(f"تخطي حذف الرسالة {message_id}: {e}")
+        return False
     except Exception as e:
         logger.error(f"❌ فشل في حذف الرسالة {message_id} من المحادثة {chat_id}: {e}")
         return False
@@ -2210,14 +5289,15 @@ def validate_proof_code(code: str) -> Optional[str]:
     
     return clean_code.upper()
 
+def mask_proof_number(number: str) -> str:
+    """إخفاء جزء من الرقم للخصوصية"""
+    if len(number) >= 6:
+        return f"{number[:3]}...{number[-2:]}"
+    return "***"
+
 def format_proof_message(user, number: str, platform: str, code: str, country_name: str, country_flag: str) -> str:
     """تنسيق رسالة إثبات"""
-    # إخفاء جزء من الرقم للخصوصية
-    if len(number) >= 6:
-        masked_number = f"{number[:3]}...{number[-2:]}"
-    else:
-        masked_number = "***"
-    
+    masked_number = mask_proof_number(number)
     user_display = f"@{user.username}" if user.username else user.first_name
     
     return f"""✅ <b>إثبات تفعيل جديد</b>
@@ -2233,6 +5313,12 @@ def format_proof_message(user, number: str, platform: str, code: str, country_na
 👨‍💻 <b>المطور:</b> @GR_3D
     """
 
+def format_proof_summary(user, number: str, platform: str, code: str, country_name: str, country_flag: str) -> str:
+    """سطر إثبات مختصر لمنشورات الدمج"""
+    user_display = f"@{user.username}" if user.username else user.first_name
+    return (f"{country_flag} {country_name} | {user_display} | <code>{mask_proof_number(number)}</code> | "
+            f"{platform} | <code>{code}</code>")
+
 def format_numbers_added_message(country_name: str, country_flag: str, platform: str, numbers_count: int, premium_count: int = 0) -> str:
     """تنسيق رسالة إضافة أرقام"""
     premium_text = f"\n💎 <b>الأرقام المميزة:</b> {premium_count}" if premium_count > 0 else ""
@@ -2351,10 +5437,11 @@ def admin_main_keyboard() -> types.InlineKeyboardMarkup:
         types.InlineKeyboardButton("⭐ إدارة PRO", callback_data="adm_manage_pro"),
         types.InlineKeyboardButton("📋 الإثباتات", callback_data="adm_list_proofs"),
         types.InlineKeyboardButton("🏆 قائمة المتصدرين", callback_data="adm_top_users"),
-        types.InlineKeyboardButton("📊 الإحصائيات", callback_data="adm_stats"),
+        types.InlineKeyboardButton("📊 الإحصائيات", callback_data="as"),
         types.InlineKeyboardButton("🔄 تنظيف البيانات", callback_data="adm_cleanup"),
-        types.InlineKeyboardButton("🆘 مساعدة المشرف", callback_data="adm_help"),
-        types.InlineKeyboardButton("🔙 رجوع للرئيسية", callback_data="back_main")
+        types.InlineKeyboardButton("⚡ الأداء", callback_data="ap"),
+        types.InlineKeyboardButton("🆘 مساعدة المشرف", callback_data="ah"),
+        types.InlineKeyboardButton("🔙 رجوع للرئيسية", callback_data="m")
     ]
     
     # ترتيب الأزرار في صفوف من 2
@@ -2369,7 +5456,7 @@ def admin_main_keyboard() -> types.InlineKeyboardMarkup:
 def admin_back_keyboard() -> types.InlineKeyboardMarkup:
     """لوحة العودة للمشرف"""
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 رجوع للوحة التحكم", callback_data="admin_panel"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع للوحة التحكم", callback_data="a"))
     return markup
 
 # ================================
@@ -2383,58 +5470,294 @@ def main_menu_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
     pro_status = " ⭐" if is_user_pro(user_id) else ""
     
     buttons = [
-        types.InlineKeyboardButton("📲 احصل على رقم", callback_data="get_number"),
-        types.InlineKeyboardButton("📢 قناة الإثباتات", url=f"https://t.me/{get_setting('proof_channel', PROOF_CHANNEL_DEFAULT).lstrip('@')}"),
-        types.InlineKeyboardButton(f"🪙 نقاطي{pro_status}", callback_data="my_points"),
-        types.InlineKeyboardButton("❓ المساعدة", callback_data="help_info")
+        types.InlineKeyboardButton("📲 احصل على رقم", callback_data="gn"),
+        types.InlineKeyboardButton("📢 قناة الإثباتات", url=f"https://t.me/{settings.current.proof_channel.lstrip('@')}"),
+        types.InlineKeyboardButton(f"🪙 نقاطي{pro_status}", callback_data="mp"),
+        types.InlineKeyboardButton("❓ المساعدة", callback_data="h")
     ]
     
     markup.add(*buttons)
     
     if is_admin(user_id):
-        markup.add(types.InlineKeyboardButton("🎛️ لوحة التحكم", callback_data="admin_panel"))
+        markup.add(types.InlineKeyboardButton("🎛️ لوحة التحكم", callback_data="a"))
     
     return markup
 
 def show_main_menu_in_message(chat_id: int, message_id: int, user):
     """عرض القائمة الرئيسية في رسالة موجودة"""
     markup = main_menu_keyboard(user.id)
-    safe_edit_message("🎛️ <b>القائمة الرئيسية</b>\n\nاختر الخيار المطلوب:", chat_id, message_id, markup)
+    safe_edit_message(MAIN_MENU_TEXT, chat_id, message_id, markup)
 
 # ================================
-# معالجات البوت - البداية والمعلومات
+# بناء الواجهات (مشتركة بين المحرك المتزامن وغير المتزامن)
 # ================================
 
-@bot.message_handler(commands=['start'])
-def handle_start(message):
-    """معالج أمر البدء"""
-    user = message.from_user
-    user_id = user.id
+MAIN_MENU_TEXT = "🎛️ <b>القائمة الرئيسية</b>\n\nاختر الخيار المطلوب:"
+COUNTRIES_TEXT = "🌍 <b>اختر الدولة المطلوبة:</b>"
+
+def back_main_keyboard() -> types.InlineKeyboardMarkup:
+    """لوحة الرجوع للقائمة الرئيسية"""
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="m"))
+    return markup
+
+def build_help_text() -> str:
+    """نص المساعدة بقيم النقاط الحالية"""
+    snapshot = settings.current
+    return HELP_TEXT.format(
+        daily_bonus_points=snapshot.daily_bonus_points,
+        invite_points=snapshot.invite_points,
+        proof_points=snapshot.proof_points
+    )
+
+def build_countries_markup() -> Optional[types.InlineKeyboardMarkup]:
+    """لوحة اختيار الدولة (None إذا لا توجد دول)"""
+    country_buttons = cache_manager.get_country_buttons()
+    if not country_buttons:
+        return None
     
-    # فحص الحظر
-    if is_user_banned(user_id):
-        safe_send(user_id, "❌ <b>تم حظرك من استخدام البوت!</b>\n\nتواصل مع المشرف للمزيد من المعلومات.")
-        return
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for label, country_id in country_buttons:
+        markup.add(types.InlineKeyboardButton(label, callback_data=f"c:{country_id}"))
     
-    # إضافة المستخدم إذا لم يكن موجوداً
-    add_user_if_not_exists(user)
+    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="m"))
+    return markup
+
+def build_join_required_view(missing_channels: List[str], country_id: int) -> Tuple[str, types.InlineKeyboardMarkup]:
+    """رسالة الاشتراك المطلوب في القنوات"""
+    markup = types.InlineKeyboardMarkup()
+    for channel in missing_channels:
+        channel_clean = channel.lstrip('@')
+        markup.add(types.InlineKeyboardButton(f"📢 انضم إلى {channel}", url=f"https://t.me/{channel_clean}"))
     
-    # فحص رابط الدعوة
-    if len(message.text.split()) > 1:
-        try:
-            inviter_id = int(message.text.split()[1])
-            if inviter_id != user_id:
-                set_invited_by(user_id, inviter_id)
-                award_invite_points(inviter_id, user_id)
-        except ValueError:
-            pass
+    markup.add(types.InlineKeyboardButton("✅ تحقق من الاشتراك", callback_data=f"c:{country_id}"))
     
-    # إرسال رسالة الترحيب
-    markup = main_menu_keyboard(user_id)
+    channels_text = '\n'.join(f'• {ch}' for ch in missing_channels)
+    text = f"""🔒 <b>اشتراك مطلوب</b>
+
+📢 يرجى الاشتراك في القنوات التالية أولاً:
+{channels_text}
+
+✅ بعد الاشتراك، اضغط على زر "تحقق من الاشتراك".
+        """
+    return text, markup
+
+def resolve_activation_channel(country_id: int) -> str:
+    """قناة التفعيل للدولة أو القناة العامة"""
+    return get_country_activation_channel(country_id) or settings.current.activation_channel
+
+def build_number_view(country: Dict, num_row: Dict, is_pro: bool, activation_channel: str) -> Tuple[str, types.InlineKeyboardMarkup]:
+    """عرض الرقم مع أزرار التحكم"""
+    number_display = decorate_number(num_row["number"])
+    platform = num_row["platform"] or "Telegram"
     
-    if not safe_send(user_id, WELCOME_TEXT, reply_markup=markup):
-        # إرسال رسالة بسيطة إذا فشل إرسال الرسالة المخصصة
-        safe_send(user_id, "🎉 مرحباً بك في بوت أرقام مجانية!\n\nاستخدم الأزرار للتفاعل.", reply_markup=markup)
+    # التحقق من كون الرقم مميزاً
+    is_premium = num_row.get('is_premium', 0)
+    premium_badge = " 💎" if is_premium else ""
+    
+    text = f"""🏴 <b>{country['name']}</b> {country['flag'] or '🌐'}
+
+📞 <b>الرقم:</b> {number_display}{premium_badge}
+🖥️ <b>المنصة:</b> {platform}
+📢 <b>قناة التفعيل:</b> {activation_channel}
+{'⭐ <b>وضع PRO مفعل</b>' if is_pro else ''}
+
+💡 <i>اضغط على طلب الكود للانتقال إلى قناة التفعيل</i>
+    """
+    
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    
+    if is_pro:
+        # مستخدمو PRO يحصلون على ميزات محسنة
+        buttons = [
+            types.InlineKeyboardButton("🔄 تغيير الرقم", callback_data="cr"),
+            types.InlineKeyboardButton("🔍 بحث PRO", callback_data="sr"),
+            types.InlineKeyboardButton("💎 أرقام مميزة", callback_data="pn"),
+            types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}")
+        ]
+    else:
+        # المستخدمون العاديون
+        buttons = [
+            types.InlineKeyboardButton("🔄 تغيير الرقم", callback_data="cr"),
+            types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}")
+        ]
+    
+    # ترتيب الأزرار
+    for i in range(0, len(buttons), 2):
+        if i + 1 < len(buttons):
+            markup.row(buttons[i], buttons[i + 1])
+        else:
+            markup.row(buttons[i])
+    
+    markup.add(types.InlineKeyboardButton("✅ إثبات سحب", callback_data="sp"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع للدول", callback_data="gn"))
+    
+    return text, markup
+
+def build_points_view(uid: int) -> Tuple[str, types.InlineKeyboardMarkup]:
+    """شاشة نقاط المستخدم"""
+    points = get_user_points(uid)
+    history = get_points_history(uid, 5)
+    invited_count = get_invited_users_count(uid)
+    is_pro = is_user_pro(uid)
+    
+    snapshot = settings.current
+    
+    text = f"""🪙 <b>نقاط الخبرة</b>
+
+💰 <b>رصيدك الحالي:</b> {points} نقطة
+{'⭐ <b>حساب PRO مفعل</b>' if is_pro else '🔒 <b>حساب عادي</b>'}
+👥 <b>عدد المدعوين:</b> {invited_count}
+
+📈 <b>آخر العمليات:</b>
+"""
+    
+    if history:
+        for record in history:
+            sign = "+" if record["points"] > 0 else ""
+            text += f"• {sign}{record['points']} - {record['reason']}\n"
+    else:
+        text += "• لا توجد عمليات سابقة\n"
+    
+    text += f"""
+🎯 <b>كيفية الحصول على النقاط:</b>
+• 🎁 الهدية اليومية: {snapshot.daily_bonus_points} نقاط
+• 👥 دعوة صديق: {snapshot.invite_points} نقاط لكل صديق
+• ✅ إثبات تفعيل: {snapshot.proof_points} نقاط لكل إثبات
+    """
+    
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("🎁 هدية يومية", callback_data="db"),
+        types.InlineKeyboardButton("👥 دعوة أصدقاء", callback_data="inv"),
+        types.InlineKeyboardButton("⭐ ميزات PRO", callback_data="pro")
+    )
+    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="m"))
+    
+    return text, markup
+
+def build_daily_bonus_text(daily_points: int, points: int) -> str:
+    """رسالة استلام الهدية اليومية"""
+    return f"""🎁 <b>تهانينا!</b>
+
+✅ لقد حصلت على <b>{daily_points} نقاط</b> هدية يومية!
+
+🪙 <b>رصيدك الحالي:</b> {points} نقطة
+
+📅 عد غداً للحصول على هدية جديدة!
+            """
+
+def register_start(user, text: Optional[str]):
+    """إضافة المستخدم إذا لم يكن موجوداً ومعالجة رابط الدعوة في أمر /start"""
+    add_user_if_not_exists(user)
+    
+    parts = (text or "").split()
+    if len(parts) > 1:
+        try:
+            inviter_id = int(parts[1])
+            if inviter_id != user.id:
+                set_invited_by(user.id, inviter_id)
+                award_invite_points(inviter_id, user.id)
+        except ValueError:
+            pass
+
+# ================================
+# موجه أزرار Callback
+# ================================
+
+class CallbackRouter:
+    """توجيه callback_data بجدول dict: "رمز:وسيط:..." ← معالج مع تحويل أنواع الوسائط"""
+    
+    SEPARATOR = ":"
+    
+    def __init__(self):
+        self.routes: Dict[str, Tuple[Callable, Tuple[Callable, ...]]] = {}
+        # أسماء الأزرار القديمة (في رسائل أُرسلت قبل الترميز المختصر) ← الرمز الجديد
+        self.aliases: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.stats = {'dispatched': 0, 'legacy': 0, 'unknown': 0}
+    
+    def route(self, code: str, *arg_types: Callable, aliases: Tuple[str, ...] = ()):
+        """تسجيل معالج للرمز: @callback_router.route("c", int, aliases=("country",))"""
+        def decorator(func: Callable) -> Callable:
+            for name in (code, *aliases):
+                if name in self.routes or name in self.aliases:
+                    raise ValueError(f"رمز زر مكرر: {name}")
+            self.routes[code] = (func, arg_types)
+            for alias in aliases:
+                self.aliases[alias] = code
+            return func
+        return decorator
+    
+    def resolve(self, data: Optional[str]) -> Optional[Tuple[str, tuple]]:
+        """(الرمز، الوسائط المحوّلة) أو None لبيانات غير معروفة أو تالفة"""
+        if not data:
+            return None
+        action, *raw_args = data.split(self.SEPARATOR)
+        code = action if action in self.routes else self.aliases.get(action)
+        if code is None:
+            return None
+        arg_types = self.routes[code][1]
+        if len(raw_args) != len(arg_types):
+            return None
+        try:
+            args = tuple(arg_type(raw) for arg_type, raw in zip(arg_types, raw_args))
+        except ValueError:
+            return None
+        if code != action:
+            with self.lock:
+                self.stats['legacy'] += 1
+        return code, args
+    
+    def dispatch(self, cq):
+        """تنفيذ معالج الزر، أو إيقاف مؤشر التحميل فقط لزر بلا معالج"""
+        route = self.resolve(cq.data)
+        with self.lock:
+            self.stats['dispatched' if route else 'unknown'] += 1
+        if route is None:
+            try:
+                bot.answer_callback_query(cq.id)
+            except Exception as e:
+                logger.debug(f"تعذر الرد على زر غير معروف {cq.data!r}: {e}")
+            return
+        handler, _ = self.routes[route[0]]
+        handler(cq, *route[1])
+    
+    def stats_snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.stats, routes=len(self.routes))
+
+callback_router = CallbackRouter()
+
+@bot.callback_query_handler(func=lambda c: True)
+def handle_callback_query(cq):
+    """المعالج الوحيد المسجل لدى TeleBot للأزرار"""
+    callback_router.dispatch(cq)
+
+# ================================
+# معالجات البوت - البداية والمعلومات
+# ================================
+
+@bot.message_handler(commands=['start'])
+def handle_start(message):
+    """معالج أمر البدء"""
+    user = message.from_user
+    user_id = user.id
+    
+    # فحص الحظر
+    if is_user_banned(user_id):
+        safe_send(user_id, "❌ <b>تم حظرك من استخدام البوت!</b>\n\nتواصل مع المشرف للمزيد من المعلومات.")
+        return
+    
+    # إضافة المستخدم ومعالجة رابط الدعوة
+    register_start(user, message.text)
+    
+    # إرسال رسالة الترحيب
+    markup = main_menu_keyboard(user_id)
+    
+    if not safe_send(user_id, WELCOME_TEXT, reply_markup=markup):
+        # إرسال رسالة بسيطة إذا فشل إرسال الرسالة المخصصة
+        safe_send(user_id, "🎉 مرحباً بك في بوت أرقام مجانية!\n\nاستخدم الأزرار للتفاعل.", reply_markup=markup)
     
     insert_log(user_id, "start", f"username={user.username}")
 
@@ -2451,45 +5774,25 @@ def handle_help(message):
     # إضافة المستخدم
     add_user_if_not_exists(message.from_user)
     
-    daily_bonus_points = get_setting("daily_bonus_points", "10")
-    invite_points = get_setting("invite_points", "5")
-    proof_points = get_setting("proof_points", "3")
-    
-    help_text = HELP_TEXT.format(
-        daily_bonus_points=daily_bonus_points,
-        invite_points=invite_points,
-        proof_points=proof_points
-    )
-    
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-    
-    safe_send(user_id, help_text, reply_markup=markup)
+    safe_send(user_id, build_help_text(), reply_markup=back_main_keyboard())
 
 # ================================
 # معالجات Menu الرئيسي
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "help_info")
+@callback_router.route("h", aliases=("help_info",))
 def cb_help_info(cq):
     """عرض المساعدة"""
-    daily_bonus_points = get_setting("daily_bonus_points", "10")
-    invite_points = get_setting("invite_points", "5")
-    proof_points = get_setting("proof_points", "3")
-    
-    help_text = HELP_TEXT.format(
-        daily_bonus_points=daily_bonus_points,
-        invite_points=invite_points,
-        proof_points=proof_points
-    )
-    
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-    
-    safe_edit_message(help_text, cq.message.chat.id, cq.message.message_id, markup)
+    safe_edit_message(build_help_text(), cq.message.chat.id, cq.message.message_id, back_main_keyboard())
     bot.answer_callback_query(cq.id)
 
-@bot.callback_query_handler(func=lambda c: c.data == "back_main")
+def clear_pending_inputs(user_id: int):
+    """مسح حالات الانتظار والتصفية للمستخدم عند العودة للقائمة"""
+    AWAITING_PROOF.pop(user_id, None)
+    AWAITING_NUMBER_PATTERN.pop(user_id, None)
+    AWAITING_PREMIUM_FILTER.pop(user_id, None)
+
+@callback_router.route("m", aliases=("back_main",))
 def cb_back_main(cq):
     """العودة للقائمة الرئيسية"""
     uid = cq.from_user.id
@@ -2500,9 +5803,7 @@ def cb_back_main(cq):
         return
     
     # مسح الحالات المؤقتة
-    AWAITING_PROOF.pop(uid, None)
-    AWAITING_NUMBER_PATTERN.pop(uid, None)
-    AWAITING_PREMIUM_FILTER.pop(uid, None)
+    clear_pending_inputs(uid)
     
     # عرض القائمة الرئيسية في نفس الرسالة
     show_main_menu_in_message(cq.message.chat.id, cq.message.message_id, cq.from_user)
@@ -2512,7 +5813,7 @@ def cb_back_main(cq):
 # معالجات اختيار الدولة والأرقام
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "get_number")
+@callback_router.route("gn", aliases=("get_number",))
 def cb_get_number(cq):
     """اختيار الدولة للحصول على رقم"""
     uid = cq.from_user.id
@@ -2526,37 +5827,19 @@ def cb_get_number(cq):
         bot.answer_callback_query(cq.id, "⚠️ معدل الطلبات مرتفع! انتظر قليلاً", show_alert=True)
         return
     
-    countries = get_countries()
+    markup = build_countries_markup()
     
-    if not countries:
+    if markup is None:
         bot.answer_callback_query(cq.id, "❌ لا توجد دول متاحة حالياً!", show_alert=True)
         return
     
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    
-    for country in countries:
-        emoji = country['flag'] or '🏴'
-        counts = cache_manager.get_country_counts(country['id'])
-        available_count = counts['total_count']
-        premium_count = counts['premium_count']
-        
-        # عرض العدد مع الميزة المميزة
-        count_text = f"({available_count})"
-        if premium_count > 0:
-            count_text += f" 💎{premium_count}"
-        
-        label = f"{emoji} {country['name']} {count_text}"
-        markup.add(types.InlineKeyboardButton(label, callback_data=f"country:{country['id']}"))
-    
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-    
-    if not safe_edit_message("🌍 <b>اختر الدولة المطلوبة:</b>", cq.message.chat.id, cq.message.message_id, markup):
-        safe_send(uid, "🌍 <b>اختر الدولة المطلوبة:</b>", reply_markup=markup)
+    if not safe_edit_message(COUNTRIES_TEXT, cq.message.chat.id, cq.message.message_id, markup):
+        safe_send(uid, COUNTRIES_TEXT, reply_markup=markup)
     
     bot.answer_callback_query(cq.id)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("country:"))
-def cb_country_selected(cq):
+@callback_router.route("c", int, aliases=("country",))
+def cb_country_selected(cq, country_id: int):
     """اختيار الدولة وعرض الرقم"""
     uid = cq.from_user.id
     
@@ -2569,29 +5852,13 @@ def cb_country_selected(cq):
         bot.answer_callback_query(cq.id, "⚠️ معدل الطلبات مرتفع! انتظر قليلاً", show_alert=True)
         return
     
-    country_id = int(cq.data.split(":")[1])
-    
     # فحص القنوات المطلوبة
-    if not user_is_member_of_required_channels(uid):
-        missing_channels = get_user_missing_channels(uid)
-        if missing_channels:
-            markup = types.InlineKeyboardMarkup()
-            for channel in missing_channels:
-                channel_clean = channel.lstrip('@')
-                markup.add(types.InlineKeyboardButton(f"📢 انضم إلى {channel}", url=f"https://t.me/{channel_clean}"))
-            
-            markup.add(types.InlineKeyboardButton("✅ تحقق من الاشتراك", callback_data=f"country:{country_id}"))
-            
-            channels_text = '\n'.join(f'• {ch}' for ch in missing_channels)
-            safe_send(uid, f"""🔒 <b>اشتراك مطلوب</b>
-
-📢 يرجى الاشتراك في القنوات التالية أولاً:
-{channels_text}
-
-✅ بعد الاشتراك، اضغط على زر "تحقق من الاشتراك".
-            """, reply_markup=markup)
-            bot.answer_callback_query(cq.id)
-            return
+    missing_channels = get_user_missing_channels(uid)
+    if missing_channels:
+        text, markup = build_join_required_view(missing_channels, country_id)
+        safe_send(uid, text, reply_markup=markup)
+        bot.answer_callback_query(cq.id)
+        return
     
     # جلب رقم عشوائي
     is_pro = is_user_pro(uid)
@@ -2606,13 +5873,7 @@ def cb_country_selected(cq):
         bot.answer_callback_query(cq.id, "❌ الدولة غير موجودة!", show_alert=True)
         return
     
-    number_display = decorate_number(num_row["number"])
-    platform = num_row["platform"] or "Telegram"
-    
-    # جلب قناة التفعيل
-    activation_channel = get_country_activation_channel(country_id)
-    if not activation_channel:
-        activation_channel = get_setting("activation_channel", ACTIVATION_CHANNEL_DEFAULT)
+    activation_channel = resolve_activation_channel(country_id)
     
     # تحديث حالة التصفح
     BROWSE[uid] = {
@@ -2622,57 +5883,19 @@ def cb_country_selected(cq):
         "timestamp": time.time()
     }
     
-    # التحقق من كون الرقم مميزاً
-    is_premium = num_row.get('is_premium', 0)
-    premium_badge = " 💎" if is_premium else ""
-    
     # عرض الرقم
-    text = f"""🏴 <b>{country['name']}</b> {country['flag'] or '🌐'}
-
-📞 <b>الرقم:</b> {number_display}{premium_badge}
-🖥️ <b>المنصة:</b> {platform}
-📢 <b>قناة التفعيل:</b> {activation_channel}
-{'⭐ <b>وضع PRO مفعل</b>' if is_pro else ''}
-
-💡 <i>اضغط على طلب الكود للانتقال إلى قناة التفعيل</i>
-    """
-    
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    
-    if is_pro:
-        # مستخدمو PRO يحصلون على ميزات محسنة
-        buttons = [
-            types.InlineKeyboardButton("🔄 تغيير الرقم", callback_data="change_random"),
-            types.InlineKeyboardButton("🔍 بحث PRO", callback_data="search_pattern"),
-            types.InlineKeyboardButton("💎 أرقام مميزة", callback_data="premium_numbers"),
-            types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}")
-        ]
-    else:
-        # المستخدمون العاديون
-        buttons = [
-            types.InlineKeyboardButton("🔄 تغيير الرقم", callback_data="change_random"),
-            types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}")
-        ]
-    
-    # ترتيب الأزرار
-    for i in range(0, len(buttons), 2):
-        if i + 1 < len(buttons):
-            markup.row(buttons[i], buttons[i + 1])
-        else:
-            markup.row(buttons[i])
-    
-    markup.add(types.InlineKeyboardButton("✅ إثبات سحب", callback_data="submit_proof"))
-    markup.add(types.InlineKeyboardButton("🔙 رجوع للدول", callback_data="get_number"))
+    text, markup = build_number_view(country, num_row, is_pro, activation_channel)
     
     if not safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup):
         sent = safe_send(uid, text, reply_markup=markup)
         if sent:
-            BROWSE[uid]["last_msg"] = (sent.chat.id, sent.message_id)
+            BROWSE.patch(uid, last_msg=(sent.chat.id, sent.message_id))
     
     bot.answer_callback_query(cq.id)
-    insert_log(uid, "view_number", f"country_id={country_id} number_id={num_row['id']} pro={is_pro} premium={is_premium}")
+    record_country_interest(uid, country_id)
+    insert_log(uid, "view_number", f"country_id={country_id} number_id={num_row['id']} pro={is_pro} premium={num_row.get('is_premium', 0)}")
 
-@bot.callback_query_handler(func=lambda c: c.data == "change_random")
+@callback_router.route("cr", aliases=("change_random",))
 def cb_change_random(cq):
     """تغيير الرقم عشوائياً"""
     uid = cq.from_user.id
@@ -2682,7 +5905,7 @@ def cb_change_random(cq):
         bot.answer_callback_query(cq.id, "❌ تم حظرك من استخدام البوت!", show_alert=True)
         return
     
-    if not check_rate_limit(uid):
+    if not check_rate_limit(uid, "change"):
         bot.answer_callback_query(cq.id, "⚠️ معدل الطلبات مرتفع! انتظر قليلاً", show_alert=True)
         return
     
@@ -2707,55 +5930,12 @@ def cb_change_random(cq):
         bot.answer_callback_query(cq.id, "❌ الدولة غير موجودة!", show_alert=True)
         return
     
-    number_display = decorate_number(num_row["number"])
-    platform = num_row["platform"] or "Telegram"
-    
-    # جلب قناة التفعيل
-    activation_channel = get_country_activation_channel(country_id)
-    if not activation_channel:
-        activation_channel = get_setting("activation_channel", ACTIVATION_CHANNEL_DEFAULT)
+    activation_channel = resolve_activation_channel(country_id)
     
     # تحديث حالة التصفح
-    BROWSE[uid]["last_number_id"] = num_row["id"]
-    BROWSE[uid]["timestamp"] = time.time()
+    BROWSE.patch(uid, last_number_id=num_row["id"], timestamp=time.time())
     
-    # التحقق من كون الرقم مميزاً
-    is_premium = num_row.get('is_premium', 0)
-    premium_badge = " 💎" if is_premium else ""
-    
-    text = f"""🏴 <b>{country['name']}</b> {country['flag'] or '🌐'}
-
-📞 <b>الرقم:</b> {number_display}{premium_badge}
-🖥️ <b>المنصة:</b> {platform}
-📢 <b>قناة التفعيل:</b> {activation_channel}
-{'⭐ <b>وضع PRO مفعل</b>' if is_pro else ''}
-
-💡 <i>اضغط على طلب الكود للانتقال إلى قناة التفعيل</i>
-    """
-    
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    
-    if is_pro:
-        buttons = [
-            types.InlineKeyboardButton("🔄 تغيير الرقم", callback_data="change_random"),
-            types.InlineKeyboardButton("🔍 بحث PRO", callback_data="search_pattern"),
-            types.InlineKeyboardButton("💎 أرقام مميزة", callback_data="premium_numbers"),
-            types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}")
-        ]
-    else:
-        buttons = [
-            types.InlineKeyboardButton("🔄 تغيير الرقم", callback_data="change_random"),
-            types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}")
-        ]
-    
-    for i in range(0, len(buttons), 2):
-        if i + 1 < len(buttons):
-            markup.row(buttons[i], buttons[i + 1])
-        else:
-            markup.row(buttons[i])
-    
-    markup.add(types.InlineKeyboardButton("✅ إثبات سحب", callback_data="submit_proof"))
-    markup.add(types.InlineKeyboardButton("🔙 رجوع للدول", callback_data="get_number"))
+    text, markup = build_number_view(country, num_row, is_pro, activation_channel)
     
     # تحديث الرسالة
     chat_id, message_id = user_state["last_msg"]
@@ -2763,16 +5943,16 @@ def cb_change_random(cq):
         # إذا فشل التحرير، إرسال رسالة جديدة
         sent = safe_send(uid, text, reply_markup=markup)
         if sent:
-            BROWSE[uid]["last_msg"] = (sent.chat.id, sent.message_id)
+            BROWSE.patch(uid, last_msg=(sent.chat.id, sent.message_id))
     
     bot.answer_callback_query(cq.id)
-    insert_log(uid, "change_number", f"country_id={country_id} number_id={num_row['id']} pro={is_pro} premium={is_premium}")
+    insert_log(uid, "change_number", f"country_id={country_id} number_id={num_row['id']} pro={is_pro} premium={num_row.get('is_premium', 0)}")
 
 # ================================
 # معالجات نظام النقاط
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "my_points")
+@callback_router.route("mp", aliases=("my_points",))
 def cb_my_points(cq):
     """عرض نقاط المستخدم"""
     uid = cq.from_user.id
@@ -2782,50 +5962,12 @@ def cb_my_points(cq):
         bot.answer_callback_query(cq.id, "❌ تم حظرك من استخدام البوت!", show_alert=True)
         return
     
-    points = get_user_points(uid)
-    history = get_points_history(uid, 5)
-    invited_count = get_invited_users_count(uid)
-    is_pro = is_user_pro(uid)
-    
-    daily_bonus_points = get_setting("daily_bonus_points", "10")
-    invite_points = get_setting("invite_points", "5")
-    proof_points = get_setting("proof_points", "3")
-    
-    text = f"""🪙 <b>نقاط الخبرة</b>
-
-💰 <b>رصيدك الحالي:</b> {points} نقطة
-{'⭐ <b>حساب PRO مفعل</b>' if is_pro else '🔒 <b>حساب عادي</b>'}
-👥 <b>عدد المدعوين:</b> {invited_count}
-
-📈 <b>آخر العمليات:</b>
-"""
-    
-    if history:
-        for record in history:
-            sign = "+" if record["points"] > 0 else ""
-            text += f"• {sign}{record['points']} - {record['reason']}\n"
-    else:
-        text += "• لا توجد عمليات سابقة\n"
-    
-    text += f"""
-🎯 <b>كيفية الحصول على النقاط:</b>
-• 🎁 الهدية اليومية: {daily_bonus_points} نقاط
-• 👥 دعوة صديق: {invite_points} نقاط لكل صديق
-• ✅ إثبات تفعيل: {proof_points} نقاط لكل إثبات
-    """
-    
-    markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton("🎁 هدية يومية", callback_data="daily_bonus"),
-        types.InlineKeyboardButton("👥 دعوة أصدقاء", callback_data="invite_friends"),
-        types.InlineKeyboardButton("⭐ ميزات PRO", callback_data="pro_features")
-    )
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    text, markup = build_points_view(uid)
     
     safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup)
     bot.answer_callback_query(cq.id)
 
-@bot.callback_query_handler(func=lambda c: c.data == "daily_bonus")
+@callback_router.route("db", aliases=("daily_bonus",))
 def cb_daily_bonus(cq):
     """استلام المكافأة اليومية"""
     uid = cq.from_user.id
@@ -2837,23 +5979,16 @@ def cb_daily_bonus(cq):
     
     if can_claim_daily_bonus(uid):
         if claim_daily_bonus(uid):
-            daily_points = int(get_setting("daily_bonus_points", "10"))
+            daily_points = settings.current.daily_bonus_points
             points = get_user_points(uid)
             bot.answer_callback_query(cq.id, f"🎁 تم استلام الهدية اليومية بنجاح! +{daily_points} نقاط")
-            safe_send(uid, f"""🎁 <b>تهانينا!</b>
-
-✅ لقد حصلت على <b>{daily_points} نقاط</b> هدية يومية!
-
-🪙 <b>رصيدك الحالي:</b> {points} نقطة
-
-📅 عد غداً للحصول على هدية جديدة!
-            """)
+            safe_send(uid, build_daily_bonus_text(daily_points, points))
         else:
             bot.answer_callback_query(cq.id, "❌ خطأ في استلام الهدية!")
     else:
         bot.answer_callback_query(cq.id, "❌ لقد استلمت الهدية اليومية مسبقاً!")
 
-@bot.callback_query_handler(func=lambda c: c.data == "invite_friends")
+@callback_router.route("inv", aliases=("invite_friends",))
 def cb_invite_friends(cq):
     """دعوة الأصدقاء"""
     uid = cq.from_user.id
@@ -2866,7 +6001,7 @@ def cb_invite_friends(cq):
     try:
         invited_users = get_invited_users(uid)
         points = get_user_points(uid)
-        invite_points = int(get_setting("invite_points", "5"))
+        invite_points = settings.current.invite_points
         bot_username = get_bot_username()
         invite_link = f"https://t.me/{bot_username}?start={uid}"
         
@@ -2894,7 +6029,7 @@ def cb_invite_friends(cq):
         markup = types.InlineKeyboardMarkup()
         share_text = "انضم إلى بوت أرقام مجانية للحصول على أرقام تفعيل مجانية! 🎉"
         markup.add(types.InlineKeyboardButton("📤 مشاركة الرابط", url=f"https://t.me/share/url?url={invite_link}&text={share_text}"))
-        markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="my_points"))
+        markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="mp"))
         
         safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup)
         bot.answer_callback_query(cq.id)
@@ -2903,7 +6038,7 @@ def cb_invite_friends(cq):
         logger.error(f"خطأ في عرض دعوة الأصدقاء: {e}")
         bot.answer_callback_query(cq.id, "❌ خطأ في تحميل البيانات!")
 
-@bot.callback_query_handler(func=lambda c: c.data == "pro_features")
+@callback_router.route("pro", aliases=("pro_features",))
 def cb_pro_features(cq):
     """ميزات PRO"""
     uid = cq.from_user.id
@@ -2913,7 +6048,7 @@ def cb_pro_features(cq):
         return
     
     is_pro = is_user_pro(uid)
-    pro_points_cost = int(get_setting("pro_points_cost", "100"))
+    pro_points_cost = settings.current.pro_points_cost
     user_points = get_user_points(uid)
     pro_info = get_user_pro_info(uid)
     
@@ -2950,16 +6085,16 @@ def cb_pro_features(cq):
         markup.add(types.InlineKeyboardButton("✅ أنت مشترك PRO", callback_data="already_pro"))
     else:
         if user_points >= pro_points_cost:
-            markup.add(types.InlineKeyboardButton("🔄 اشتراك بـ النقاط", callback_data="buy_pro_points"))
+            markup.add(types.InlineKeyboardButton("🔄 اشتراك بـ النقاط", callback_data="bp"))
         else:
-            markup.add(types.InlineKeyboardButton("❌ نقاط غير كافية", callback_data="not_enough_points"))
+            markup.add(types.InlineKeyboardButton("❌ نقاط غير كافية", callback_data="np"))
     
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="my_points"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="mp"))
     
     safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup)
     bot.answer_callback_query(cq.id)
 
-@bot.callback_query_handler(func=lambda c: c.data == "buy_pro_points")
+@callback_router.route("bp", aliases=("buy_pro_points",))
 def cb_buy_pro_points(cq):
     """شراء PRO بالنقاط"""
     uid = cq.from_user.id
@@ -2983,11 +6118,11 @@ def cb_buy_pro_points(cq):
     else:
         bot.answer_callback_query(cq.id, "❌ نقاط غير كافية لشراء PRO!", show_alert=True)
 
-@bot.callback_query_handler(func=lambda c: c.data == "not_enough_points")
+@callback_router.route("np", aliases=("not_enough_points",))
 def cb_not_enough_points(cq):
     """عرض رسالة عدم كفاية النقاط"""
     uid = cq.from_user.id
-    pro_cost = int(get_setting("pro_points_cost", "100"))
+    pro_cost = settings.current.pro_points_cost
     
     bot.answer_callback_query(cq.id, 
         f"❌ تحتاج {pro_cost} نقطة على الأقل لشراء PRO!\n\nجرب استلام المكافأة اليومية أو دعوة أصدقاء لكسب المزيد من النقاط.",
@@ -2997,7 +6132,7 @@ def cb_not_enough_points(cq):
 # معالجات إثبات السحب
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "submit_proof")
+@callback_router.route("sp", aliases=("submit_proof",))
 def cb_submit_proof(cq):
     """بدء عملية إرسال إثبات"""
     uid = cq.from_user.id
@@ -3047,7 +6182,7 @@ def cb_submit_proof(cq):
     
     bot.answer_callback_query(cq.id)
 
-@bot.message_handler(func=lambda m: m.from_user.id in AWAITING_PROOF)
+@bot.message_handler(func=lambda m: not is_command_message(m) and m.from_user.id in AWAITING_PROOF)
 def handle_proof_code(message):
     """معالج إرسال رمز الإثبات"""
     uid = message.from_user.id
@@ -3057,6 +6192,10 @@ def handle_proof_code(message):
         safe_send(uid, "❌ <b>انتهت جلسة إرسال الإثبات!</b>")
         return
     
+    if not check_rate_limit(uid, "proof"):
+        safe_send(uid, "⚠️ <b>محاولات إثبات كثيرة!</b>\n\nانتظر بضع دقائق ثم أعد إرسال الرمز.")
+        return
+    
     code = validate_proof_code(message.text)
     
     if not code:
@@ -3077,6 +6216,11 @@ def handle_proof_code(message):
         AWAITING_PROOF.pop(uid, None)
         return
     
+    proof_channel = settings.current.proof_channel
+    proof_points = settings.current.proof_points
+    proof_args = (message.from_user, proof_data["number"], proof_data["platform"], code,
+                  proof_data["country_name"], proof_data["country_flag"])
+    
     cur = conn.cursor()
     try:
         cur.execute("""
@@ -3084,19 +6228,22 @@ def handle_proof_code(message):
             VALUES (?, ?, ?, ?, ?)
         """, (uid, proof_data["number"], proof_data["platform"], code, proof_data["country_name"]))
         
-        # إضافة نقاط للمستخدم
-        proof_points = int(get_setting("proof_points", "3"))
-        add_points(uid, proof_points, "proof_submission")
+        # منشور القناة يُكتب في نفس المعاملة وينشره proof_publisher في الخلفية
+        cur.execute("""
+            INSERT INTO proof_outbox (proof_id, channel, message, summary)
+            VALUES (?, ?, ?, ?)
+        """, (cur.lastrowid, proof_channel, format_proof_message(*proof_args), format_proof_summary(*proof_args)))
+        outbox_id = cur.lastrowid
         
-        # تحديث عدد الإثباتات
+        # تحديث عدد الإثباتات، المكافأة، واستخدام الرقم - كلها مع الإثبات أو لا شيء
         cur.execute("UPDATE users SET proofs_submitted = proofs_submitted + 1 WHERE id = ?", (uid,))
-        
-        # تحديد الرقم كمستخدم
-        mark_number_used(proof_data.get("number_id"))
+        write_points(cur, uid, proof_points, "proof_submission")
+        write_number_used(cur, proof_data.get("number_id"))
         
         conn.commit()
         
     except Exception as e:
+        conn.rollback()
         logger.error(f"❌ خطأ في حفظ الإثبات: {e}")
         safe_send(uid, "❌ <b>خطأ في حفظ الإثبات!</b>")
         AWAITING_PROOF.pop(uid, None)
@@ -3104,22 +6251,9 @@ def handle_proof_code(message):
     finally:
         conn.close()
     
-    # إرسال الإثبات لقناة الإثباتات
-    proof_channel = get_setting("proof_channel", PROOF_CHANNEL_DEFAULT)
-    user = message.from_user
-    
-    try:
-        proof_message = format_proof_message(
-            user, 
-            proof_data["number"], 
-            proof_data["platform"], 
-            code, 
-            proof_data["country_name"], 
-            proof_data["country_flag"]
-        )
-        safe_send(proof_channel, proof_message)
-    except Exception as e:
-        logger.error(f"خطأ في إرسال الإثبات للقناة: {e}")
+    # الأحداث بعد الحفظ فقط
+    event_bus.publish(ProofSubmitted(uid, outbox_id))
+    event_bus.publish(UserPointsChanged(uid, proof_points))
     
     # إشعار المستخدم
     safe_send(uid, f"""✅ <b>تم إرسال الإثبات بنجاح!</b>
@@ -3131,7 +6265,7 @@ def handle_proof_code(message):
 🔢 <b>الكود:</b> <code>{code}</code>
 🪙 <b>المكافأة:</b> +{proof_points} نقاط
 
-📢 <b>تم نشر إثباتك في قناة الإثباتات:</b> {proof_channel}
+📢 <b>سيُنشر إثباتك في قناة الإثباتات:</b> {proof_channel}
 
 🚀 <b>يمكنك الآن الحصول على رقم جديد!</b>
     """)
@@ -3139,11 +6273,149 @@ def handle_proof_code(message):
     AWAITING_PROOF.pop(uid, None)
     insert_log(uid, "submit_proof", f"number={proof_data['number']} code={code} country={proof_data['country_name']}")
 
+# ================================
+# ناشر صندوق الإثباتات الصادر (Outbox)
+# ================================
+
+class ProofOutboxPublisher:
+    """ينشر منشورات proof_outbox في القناة خارج مسار طلب المستخدم، مع إعادة المحاولة والدمج عند الذروة"""
+    
+    BATCH_LIMIT = 100
+    MAX_BACKOFF = 900
+    
+    def __init__(self, digest_threshold: int, digest_max: int, max_attempts: int):
+        self.digest_threshold = max(2, digest_threshold)
+        self.digest_max = max(1, digest_max)
+        self.max_attempts = max(1, max_attempts)
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {'sent': 0, 'posts': 0, 'digests': 0, 'retries': 0, 'failed': 0}
+    
+    def subscribe_to(self, bus: EventBus):
+        bus.subscribe(ProofSubmitted, lambda event: self.wakeup.set())
+    
+    def run(self):
+        """حلقة النشر: تستيقظ عند إثبات جديد أو عند حلول موعد إعادة المحاولة"""
+        while True:
+            # المسح قبل القراءة: أي إثبات يُكتب بعدها سيوقظ الحلقة مجدداً
+            self.wakeup.clear()
+            if not process_coordinator.is_leader:
+                # عملية تابعة: المنشورات تبقى في proof_outbox حتى ينشرها القائد
+                self.wakeup.wait(process_coordinator.interval)
+                continue
+            try:
+                delay = self.publish_due()
+            except Exception as e:
+                logger.error(f"❌ خطأ في ناشر الإثباتات: {e}")
+                delay = 30
+            self.wakeup.wait(delay)
+    
+    def publish_due(self) -> float:
+        """نشر المستحق الآن وإرجاع الثواني حتى الموعد التالي"""
+        conn = db_connect()
+        if conn is None:
+            return 30
+        
+        cur = conn.cursor()
+        try:
+            now = time.time()
+            cur.execute("""
+                SELECT id, channel, message, summary, attempts FROM proof_outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY id LIMIT ?
+            """, (now, self.BATCH_LIMIT))
+            by_channel: Dict[str, List[sqlite3.Row]] = defaultdict(list)
+            for row in cur.fetchall():
+                by_channel[row['channel']].append(row)
+            
+            for channel, rows in by_channel.items():
+                # تراكم الإثباتات (ذروة أو تعطل سابق): منشور مدمج بدل منشور لكل إثبات
+                group_size = self.digest_max if len(rows) >= self.digest_threshold else 1
+                for start in range(0, len(rows), group_size):
+                    self.publish_group(cur, channel, rows[start:start + group_size])
+                    conn.commit()
+            
+            cur.execute("SELECT MIN(next_attempt_at) FROM proof_outbox WHERE status = 'pending'")
+            next_due = cur.fetchone()[0]
+            if next_due is None:
+                return 60
+            return min(60, max(0.5, next_due - time.time()))
+        finally:
+            conn.close()
+    
+    def publish_group(self, cur, channel: str, rows: List[sqlite3.Row]):
+        if len(rows) == 1:
+            text = rows[0]['message']
+        else:
+            text = f"✅ <b>إثباتات تفعيل جديدة ({len(rows)})</b>\n\n" + '\n'.join(row['summary'] for row in rows)
+        
+        error = self.deliver(channel, text)
+        ids = [(row['id'],) for row in rows]
+        if error is None:
+            cur.executemany("UPDATE proof_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP WHERE id = ?", ids)
+            with self.lock:
+                self.stats['sent'] += len(rows)
+                self.stats['posts'] += 1
+                self.stats['digests'] += len(rows) > 1
+            return
+        
+        error_text, retry_after = error
+        for row in rows:
+            attempts = row['attempts'] + 1
+            if attempts >= self.max_attempts:
+                cur.execute("UPDATE proof_outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                           (attempts, error_text, row['id']))
+                logger.error(f"❌ تعذر نشر الإثبات {row['id']} في {channel} بعد {attempts} محاولات: {error_text}")
+                with self.lock:
+                    self.stats['failed'] += 1
+                continue
+            backoff = retry_after or min(self.MAX_BACKOFF, 5 * 2 ** attempts) * random.uniform(0.8, 1.2)
+            cur.execute("""
+                UPDATE proof_outbox SET attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?
+            """, (attempts, error_text, time.time() + backoff, row['id']))
+            with self.lock:
+                self.stats['retries'] += 1
+    
+    @staticmethod
+    def deliver(channel: str, text: str) -> Optional[Tuple[str, Optional[float]]]:
+        """إرسال منشور للقناة: None عند النجاح، أو (الخطأ، retry_after)"""
+        try:
+            with outbound_lane(LANE_PROOF):
+                bot.send_message(channel, text)
+            return None
+        except CircuitOpenError as e:
+            return str(e), e.retry_in
+        except telebot.apihelper.ApiTelegramException as e:
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after')
+            return f"{e.error_code}: {e.description}", retry_after
+        except Exception as e:
+            return str(e), None
+    
+    def stats_snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            snapshot = dict(self.stats)
+        snapshot['pending'] = 0
+        conn = db_connect()
+        if conn is None:
+            return snapshot
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM proof_outbox WHERE status = 'pending'")
+            snapshot['pending'] = cur.fetchone()[0]
+        except Exception as e:
+            logger.error(f"خطأ في جلب حالة صندوق الإثباتات: {e}")
+        finally:
+            conn.close()
+        return snapshot
+
+proof_publisher = ProofOutboxPublisher(PROOF_DIGEST_THRESHOLD, PROOF_DIGEST_MAX, PROOF_OUTBOX_MAX_ATTEMPTS)
+proof_publisher.subscribe_to(event_bus)
+
 # ================================
 # معالجات ميزات PRO
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "search_pattern")
+@callback_router.route("sr", aliases=("search_pattern",))
 def cb_search_pattern(cq):
     """البحث بنمط معين (ميزة PRO)"""
     uid = cq.from_user.id
@@ -3190,7 +6462,7 @@ def cb_search_pattern(cq):
     
     bot.answer_callback_query(cq.id)
 
-@bot.message_handler(func=lambda m: m.from_user.id in AWAITING_NUMBER_PATTERN)
+@bot.message_handler(func=lambda m: not is_command_message(m) and m.from_user.id in AWAITING_NUMBER_PATTERN)
 def handle_number_pattern(message):
     """معالج البحث بالنمط"""
     uid = message.from_user.id
@@ -3200,6 +6472,10 @@ def handle_number_pattern(message):
         safe_send(uid, "❌ <b>انتهت جلسة البحث!</b>")
         return
     
+    if not check_rate_limit(uid, "search"):
+        safe_send(uid, "⚠️ <b>عمليات بحث كثيرة!</b>\n\nانتظر قليلاً ثم أعد إرسال النمط.")
+        return
+    
     pattern = message.text.strip()
     
     if not pattern or len(pattern) < 2:
@@ -3245,14 +6521,14 @@ def handle_number_pattern(message):
         text += f"\n📝 <i>عرض أول 10 نتائج من {len(matching_numbers)}</i>"
     
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔄 بحث جديد", callback_data="search_pattern"))
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data=f"country:{country_id}"))
+    markup.add(types.InlineKeyboardButton("🔄 بحث جديد", callback_data="sr"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data=f"c:{country_id}"))
     
     safe_send(uid, text, reply_markup=markup)
     AWAITING_NUMBER_PATTERN.pop(uid, None)
     insert_log(uid, "pattern_search", f"country_id={country_id} pattern={pattern} results={len(matching_numbers)}")
 
-@bot.callback_query_handler(func=lambda c: c.data == "premium_numbers")
+@callback_router.route("pn", aliases=("premium_numbers",))
 def cb_premium_numbers(cq):
     """الأرقام المميزة (ميزة PRO)"""
     uid = cq.from_user.id
@@ -3315,15 +6591,15 @@ def cb_premium_numbers(cq):
     for p_type in grouped.keys():
         emoji = get_premium_type_emoji(p_type)
         count = len(grouped[p_type])
-        markup.add(types.InlineKeyboardButton(f"{emoji} {p_type} ({count})", callback_data=f"premium_type:{country_id}:{p_type}"))
+        markup.add(types.InlineKeyboardButton(f"{emoji} {p_type} ({count})", callback_data=f"pm:{country_id}:{p_type}"))
     
-    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data=f"country:{country_id}"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع", callback_data=f"c:{country_id}"))
     
     safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup)
     bot.answer_callback_query(cq.id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("premium_type:"))
-def cb_premium_type_selected(cq):
+@callback_router.route("pm", int, str, aliases=("premium_type",))
+def cb_premium_type_selected(cq, country_id: int, premium_type: str):
     """اختيار نوع الرقم المميز"""
     uid = cq.from_user.id
     
@@ -3337,10 +6613,6 @@ def cb_premium_type_selected(cq):
         bot.answer_callback_query(cq.id, "❌ هذه الميزة متاحة فقط لمشتركي PRO!", show_alert=True)
         return
     
-    parts = cq.data.split(":")
-    country_id = int(parts[1])
-    premium_type = parts[2]
-    
     # جلب الأرقام من النوع المحدد
     premium_numbers = get_premium_numbers(country_id, premium_type)
     
@@ -3383,7 +6655,7 @@ def show_premium_number(uid: int, chat_id: int, message_id: int, index: int):
     # جلب قناة التفعيل
     activation_channel = get_country_activation_channel(filter_data["country_id"])
     if not activation_channel:
-        activation_channel = get_setting("activation_channel", ACTIVATION_CHANNEL_DEFAULT)
+        activation_channel = settings.current.activation_channel
     
     text = f"""💎 <b>رقم مميز - {premium_type}</b>
 
@@ -3402,9 +6674,9 @@ def show_premium_number(uid: int, chat_id: int, message_id: int, index: int):
     nav_buttons = []
     if len(numbers) > 1:
         if index > 0:
-            nav_buttons.append(types.InlineKeyboardButton("◀️ السابق", callback_data=f"premium_nav:{index-1}"))
+            nav_buttons.append(types.InlineKeyboardButton("◀️ السابق", callback_data=f"pv:{index-1}"))
         if index < len(numbers) - 1:
-            nav_buttons.append(types.InlineKeyboardButton("التالي ▶️", callback_data=f"premium_nav:{index+1}"))
+            nav_buttons.append(types.InlineKeyboardButton("التالي ▶️", callback_data=f"pv:{index+1}"))
     
     if nav_buttons:
         markup.row(*nav_buttons)
@@ -3412,15 +6684,14 @@ def show_premium_number(uid: int, chat_id: int, message_id: int, index: int):
     # أزرار الإجراءات
     action_buttons = [
         types.InlineKeyboardButton("📩 طلب الكود", url=f"https://t.me/{activation_channel.lstrip('@')}"),
-        types.InlineKeyboardButton("✅ إثبات سحب", callback_data="submit_proof_premium")
+        types.InlineKeyboardButton("✅ إثبات سحب", callback_data="spp")
     ]
     markup.row(*action_buttons)
     
-    markup.add(types.InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="premium_numbers"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="pn"))
     
     # تحديث المؤشر الحالي
-    filter_data["current_index"] = index
-    filter_data["current_number_id"] = num['id']
+    AWAITING_PREMIUM_FILTER.patch(uid, current_index=index, current_number_id=num['id'])
     
     # تحديث حالة التصفح مع الرقم المميز
     BROWSE[uid] = {
@@ -3433,16 +6704,15 @@ def show_premium_number(uid: int, chat_id: int, message_id: int, index: int):
     
     safe_edit_message(text, chat_id, message_id, markup)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("premium_nav:"))
-def cb_premium_nav(cq):
+@callback_router.route("pv", int, aliases=("premium_nav",))
+def cb_premium_nav(cq, index: int):
     """التنقل بين الأرقام المميزة"""
     uid = cq.from_user.id
-    index = int(cq.data.split(":")[1])
     
     show_premium_number(uid, cq.message.chat.id, cq.message.message_id, index)
     bot.answer_callback_query(cq.id)
 
-@bot.callback_query_handler(func=lambda c: c.data == "submit_proof_premium")
+@callback_router.route("spp", aliases=("submit_proof_premium",))
 def cb_submit_proof_premium(cq):
     """إرسال إثبات من الأرقام المميزة"""
     uid = cq.from_user.id
@@ -3496,7 +6766,7 @@ def cb_submit_proof_premium(cq):
 # لوحة التحكم الإدارية - المعالجات
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "admin_panel")
+@callback_router.route("a", aliases=("admin_panel",))
 def cb_admin_panel(cq):
     """عرض لوحة التحكم الإدارية"""
     uid = cq.from_user.id
@@ -3552,7 +6822,7 @@ def cb_admin_panel(cq):
 # معالجات الإحصائيات والمعلومات
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "adm_stats")
+@callback_router.route("as", aliases=("adm_stats",))
 def cb_admin_stats(cq):
     """عرض الإحصائيات المفصلة"""
     if not is_admin(cq.from_user.id):
@@ -3648,6 +6918,164 @@ def cb_admin_stats(cq):
     finally:
         conn.close()
 
+def build_perf_text() -> str:
+    """نص شاشة الأداء: حالة أجزاء موزع التحديثات"""
+    shard_stats = update_dispatcher.stats()
+    total_depth = sum(stats['depth'] for stats in shard_stats)
+    total_processed = sum(stats['processed'] for stats in shard_stats)
+    
+    text = f"""⚡ <b>أداء البوت</b>
+
+📥 <b>موزع التحديثات:</b> {len(shard_stats)} جزء
+• 📦 في الانتظار: {total_depth}
+• ✅ تمت معالجتها: {total_processed}
+
+"""
+    for stats in shard_stats:
+        text += (f"• #{stats['shard']}: طابور {stats['depth']} | {stats['processed']} تحديث | "
+                 f"انتظار {stats['avg_wait'] * 1000:.0f}ms | تنفيذ {stats['avg_run'] * 1000:.0f}ms "
+                 f"(أقصى {stats['max_run'] * 1000:.0f}ms)")
+        if stats['errors']:
+            text += f" | ❌ {stats['errors']}"
+        if stats['dropped']:
+            text += f" | 🚧 مرفوض لامتلاء الطابور {stats['dropped']}"
+        text += "\n"
+    
+    text += "\n📤 <b>الإرسال (حسب الأولوية):</b>\n"
+    for lane, stats in outbound_scheduler.stats_snapshot().items():
+        text += (f"• {LANE_NAMES[lane]}: {stats['sent']} طلب | منتظر {stats['waiting']} | "
+                 f"انتظار {stats['avg_wait'] * 1000:.0f}ms (أقصى {stats['max_wait'] * 1000:.0f}ms) | 429: {stats['retry_after']}\n")
+    
+    transport = telegram_transport.stats_snapshot()
+    pools = transport['pools']
+    text += (f"\n🔌 <b>النقل ({transport['backend']}):</b> polling {pools['polling']} | "
+             f"تفاعلي {pools['interactive']} | جماعي {pools['bulk']}\n")
+    busiest = sorted(transport['endpoints'].items(), key=lambda item: item[1]['calls'], reverse=True)[:6]
+    for method_name, stats in busiest:
+        text += (f"• {method_name}: {stats['calls']} | متوسط {stats['avg'] * 1000:.0f}ms "
+                 f"(أقصى {stats['max'] * 1000:.0f}ms)")
+        if stats['errors']:
+            text += f" | ❌ {stats['errors']}"
+        text += "\n"
+    
+    circuits = telegram_resilience.stats_snapshot()
+    text += (f"\n🛡️ <b>قواطع الدائرة:</b> طرق مفتوحة {', '.join(circuits['open_endpoints']) or 'لا يوجد'} | "
+             f"محادثات مفتوحة {circuits['open_chats']} | مرفوضة محلياً {circuits['short_circuited']} | "
+             f"إعادة محاولة {circuits['retries']}\n")
+    
+    jobs = job_scheduler.stats_snapshot()
+    text += (f"\n🗓️ <b>المهام الدورية:</b> {len(jobs)} مهمة | قيد التشغيل {sum(job['running'] for job in jobs)} | "
+             f"فشل {sum(job['failures'] for job in jobs)}\n")
+    expiry = pro_expiry_queue.stats_snapshot()
+    next_expiry = f"{expiry['next_in'] / 60:.0f} دقيقة" if expiry['next_in'] is not None else "لا يوجد"
+    text += (f"⭐ <b>انتهاء PRO:</b> قادم {expiry['pending']} | الأقرب بعد {next_expiry} | "
+             f"منتهٍ {expiry['expired']} في {expiry['batches']} دفعة\n")
+    
+    callbacks = callback_router.stats_snapshot()
+    text += (f"\n🔘 <b>موجه الأزرار:</b> {callbacks['routes']} مسار | موجهة {callbacks['dispatched']} | "
+             f"أسماء قديمة {callbacks['legacy']} | غير معروفة {callbacks['unknown']}\n")
+    
+    limits = rate_limiter.stats_snapshot()
+    text += (f"\n🚦 <b>حدود المعدل (GCRA - {limits['backend']}):</b> مسموح {limits['allowed']} | "
+             f"مرفوض {limits['denied']} | مفاتيح {limits['keys']}\n")
+    text += (f"🗂️ <b>الجلسات:</b> تصفح {len(BROWSE)} | إثبات {len(AWAITING_PROOF)} | "
+             f"بحث {len(AWAITING_NUMBER_PATTERN)} | مميزة {len(AWAITING_PREMIUM_FILTER)}\n")
+    coordinator = process_coordinator.stats_snapshot()
+    if coordinator['shared']:
+        text += (f"👑 <b>العمليات:</b> {'قائدة' if coordinator['leader'] else 'تابعة'} ({coordinator['owner']}) | "
+                 f"انتخابات {coordinator['elections']} | أجيال مرفوعة {coordinator['bumps']} | "
+                 f"إبطالات {coordinator['invalidations']}\n")
+    
+    render = render_cache.stats_snapshot()
+    text += (f"\n🖼️ <b>ذاكرة العرض:</b> تعديلات {render['edits']} | متخطاة محلياً {render['skipped']} | "
+             f"not modified {render['not_modified']} | رسائل {render['entries']}\n")
+    
+    outbox = proof_publisher.stats_snapshot()
+    text += (f"\n🧾 <b>صندوق الإثباتات:</b> معلق {outbox['pending']} | منشور {outbox['sent']} "
+             f"(في {outbox['posts']} منشور، {outbox['digests']} مدمج) | إعادة {outbox['retries']} | فشل {outbox['failed']}\n")
+    
+    if BOT_ENGINE != "async" and BOT_MODE != "webhook":
+        polling = update_poller.stats_snapshot()
+        text += f"""
+📡 <b>الاستقبال (getUpdates):</b>
+• 🔁 دورات: {polling['polls']} | دفعات: {polling['batches']} | تحديثات: {polling['updates']}
+• 📦 متوسط الدفعة: {polling['avg_batch']:.1f} (أقصى {polling['max_batch']}) | اكتمال {polling['avg_drain'] * 1000:.0f}ms
+• 👥 مستخدمون محملون مسبقاً: {polling['prefetched']} | ❌ أخطاء: {polling['errors']} | offset: {polling['offset']}
+"""
+    
+    if BOT_MODE == "webhook":
+        with WEBHOOK_STATS_LOCK:
+            webhook = dict(WEBHOOK_STATS)
+        avg_ingest = webhook['total_ingest'] / (webhook['received'] or 1)
+        text += f"""
+🌐 <b>Webhook:</b>
+• ✅ مستلمة: {webhook['received']} (متوسط الاستلام {avg_ingest * 1000:.1f}ms)
+• 🚫 مرفوضة: {webhook['rejected']} | ⚠️ غير صالحة: {webhook['invalid']} | 🚧 503 للازدحام: {webhook['overloaded']}
+"""
+    
+    return text
+
+@callback_router.route("ap", aliases=("adm_perf",))
+def cb_admin_perf(cq):
+    """عرض مؤشرات الأداء"""
+    if not is_admin(cq.from_user.id):
+        bot.answer_callback_query(cq.id, "❌ صلاحية غير كافية!", show_alert=True)
+        return
+    
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 تحديث", callback_data="ap"))
+    markup.add(types.InlineKeyboardButton("🔙 رجوع للوحة التحكم", callback_data="a"))
+    
+    safe_edit_message(build_perf_text(), cq.message.chat.id, cq.message.message_id, markup)
+    bot.answer_callback_query(cq.id)
+
+def build_jobs_view() -> Tuple[str, types.InlineKeyboardMarkup]:
+    """لوحة المهام الدورية مع أزرار التشغيل اليدوي"""
+    text = "🗓️ <b>المهام الدورية والصيانة</b>\n\n"
+    markup = types.InlineKeyboardMarkup()
+    for job in job_scheduler.stats_snapshot():
+        last_run = datetime.fromtimestamp(job['last_run']).strftime('%H:%M:%S') if job['last_run'] else "لم تعمل بعد"
+        status = "⏳ قيد التشغيل" if job['running'] else f"بعد {job['next_in'] / 60:.1f} دقيقة"
+        if job['leader_only'] and not process_coordinator.is_leader:
+            status = "👑 تعمل في العملية القائدة"
+        text += (f"{job['title']}: كل {job['interval'] / 60:.0f} دقيقة | {status}\n"
+                 f"   آخر تشغيل {last_run} ({job['last_duration'] * 1000:.0f}ms) | مرات {job['runs']} | فشل {job['failures']}\n")
+        if job['last_error']:
+            text += f"   ❌ {html.escape(job['last_error'][:100])}\n"
+        markup.add(types.InlineKeyboardButton(f"▶️ {job['title']}", callback_data=f"jr:{job['name']}"))
+    markup.row(
+        types.InlineKeyboardButton("🔄 تحديث", callback_data="jb"),
+        types.InlineKeyboardButton("🔙 رجوع للوحة التحكم", callback_data="a")
+    )
+    return text, markup
+
+@callback_router.route("jb", aliases=("adm_cleanup",))
+def cb_admin_jobs(cq):
+    """عرض المهام الدورية"""
+    if not is_admin(cq.from_user.id):
+        bot.answer_callback_query(cq.id, "❌ صلاحية غير كافية!", show_alert=True)
+        return
+    
+    text, markup = build_jobs_view()
+    safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup)
+    bot.answer_callback_query(cq.id)
+
+@callback_router.route("jr", str)
+def cb_admin_run_job(cq, name: str):
+    """تشغيل مهمة دورية يدوياً"""
+    if not is_admin(cq.from_user.id):
+        bot.answer_callback_query(cq.id, "❌ صلاحية غير كافية!", show_alert=True)
+        return
+    
+    if job_scheduler.trigger(name):
+        bot.answer_callback_query(cq.id, "✅ تمت جدولة المهمة للتشغيل الآن")
+        insert_log(cq.from_user.id, "admin_run_job", name)
+    else:
+        bot.answer_callback_query(cq.id, "⏳ المهمة قيد التشغيل أو غير موجودة", show_alert=True)
+    
+    text, markup = build_jobs_view()
+    safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup)
+
 # ================================
 # وظائف مساعدة للمستخدمين
 # ================================
@@ -3687,24 +7115,152 @@ def get_invited_users(user_id: int) -> List[Dict]:
         conn.close()
 
 # ================================
-# نظام التنظيف والصيانة
+# مجدول المهام الدورية (Job Scheduler)
 # ================================
 
-def cleanup_worker():
-    """خيط عمل التنظيف التلقائي"""
-    while True:
+@dataclass
+class Job:
+    """مهمة دورية مع إحصائيات تشغيلها"""
+    name: str
+    title: str
+    func: Callable[[], Any]
+    interval: float
+    next_run: float = 0.0
+    token: int = 0        # يُبطل مدخلات الكومة القديمة عند إعادة الجدولة
+    running: bool = False
+    runs: int = 0
+    failures: int = 0
+    last_run: Optional[float] = None
+    last_duration: float = 0.0
+    last_error: str = ""
+    leader_only: bool = False  # مع عدة عمليات: تعمل في القائد فقط
+    requested_gap: Optional[float] = None  # طلب مدمج وصل أثناء التشغيل (يُعاد بعده)
+
+class JobScheduler:
+    """كومة صغرى لمواعيد المهام تُنفذ على مجمع خيوط محدود
+    
+    الموعد التالي يُحسب بعد انتهاء التشغيل (لا تداخل لنفس المهمة)
+    مع تذبذب عشوائي حتى لا تستيقظ مهام الصيانة معاً.
+    """
+    
+    def __init__(self, workers: int = 2, jitter: float = 0.1):
+        self.jitter = max(0.0, jitter)
+        self.jobs: Dict[str, Job] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job")
+    
+    def _jittered(self, seconds: float) -> float:
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+    
+    def _push(self, job: Job, when: float):
+        job.token += 1
+        job.next_run = when
+        heapq.heappush(self._heap, (when, job.token, job.name))
+        self._cond.notify()
+    
+    def add(self, name: str, title: str, func: Callable[[], Any], interval: float, first_delay: Optional[float] = None,
+            leader_only: bool = False):
+        """تسجيل مهمة (first_delay الافتراضي: جزء عشوائي من الفترة لتوزيع البدايات)"""
+        delay = first_delay if first_delay is not None else random.uniform(0, interval)
+        with self._cond:
+            job = self.jobs[name] = Job(name, title, func, interval, leader_only=leader_only)
+            self._push(job, time.time() + self._jittered(delay))
+    
+    def trigger(self, name: str) -> bool:
+        """تشغيل مهمة فوراً (False إن كانت غير موجودة أو قيد التشغيل)"""
+        with self._cond:
+            job = self.jobs.get(name)
+            if job is None or job.running:
+                return False
+            self._push(job, time.time())
+            return True
+    
+    def request(self, name: str, min_gap: float) -> bool:
+        """طلب تشغيل مدمج لا يُفقد: يعمل مرة عند max(الآن، آخر تشغيل + min_gap)
+        
+        الطلبات المتقاربة تندمج في تشغيل واحد، والطلب أثناء التشغيل يعيد المهمة بعد انتهائها.
+        """
+        with self._cond:
+            job = self.jobs.get(name)
+            if job is None:
+                return False
+            if job.running:
+                job.requested_gap = min(min_gap, job.requested_gap if job.requested_gap is not None else min_gap)
+                return True
+            when = max(time.time(), (job.last_run or 0.0) + min_gap)
+            if when < job.next_run:
+                self._push(job, when)
+            return True
+    
+    def run(self):
+        """حلقة المجدول: انتظار أقرب موعد ثم تسليم المهمة للمجمع"""
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, token, name = heapq.heappop(self._heap)
+                job = self.jobs[name]
+                if token != job.token or job.running:
+                    continue
+                if job.leader_only and not process_coordinator.is_leader:
+                    # عملية تابعة: المهمة تعمل في القائد، ويُعاد الفحص في موعدها التالي
+                    self._push(job, time.time() + self._jittered(job.interval))
+                    continue
+                job.running = True
+            self._pool.submit(self._execute, job)
+    
+    def _execute(self, job: Job):
+        started = time.time()
+        error = ""
         try:
-            cleanup_old_data()
-            cleanup_rate_limiter()
-            time.sleep(3600)  # كل ساعة
+            job.func()
         except Exception as e:
-            logger.error(f"❌ خطأ في خيط التنظيف: {e}")
-            time.sleep(300)
+            error = str(e)
+            logger.error(f"❌ خطأ في المهمة الدورية {job.name}: {e}")
+        duration = time.time() - started
+        with self._cond:
+            job.running = False
+            job.runs += 1
+            job.last_run = started
+            job.last_duration = duration
+            if error:
+                job.failures += 1
+                job.last_error = error
+            next_run = time.time() + self._jittered(job.interval)
+            if job.requested_gap is not None:
+                next_run = min(next_run, max(time.time(), started + job.requested_gap))
+                job.requested_gap = None
+            self._push(job, next_run)
+    
+    def stats_snapshot(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return [
+                {'name': job.name, 'title': job.title, 'interval': job.interval, 'running': job.running,
+                 'next_in': max(0.0, job.next_run - time.time()), 'runs': job.runs, 'failures': job.failures,
+                 'last_run': job.last_run, 'last_duration': job.last_duration, 'last_error': job.last_error,
+                 'leader_only': job.leader_only}
+                for job in sorted(self.jobs.values(), key=lambda item: item.next_run)
+            ]
+
+# إنشاء مجدول المهام
+job_scheduler = JobScheduler(JOB_WORKERS, JOB_JITTER)
+
+# ================================
+# نظام التنظيف والصيانة
+# ================================
+
+def purge_runtime_state():
+    """تنظيف الذاكرة المؤقتة والدلاء والقواطع غير النشطة (مهمة دورية)"""
+    membership_cache.purge_expired()
+    state_backend.purge()
+    outbound_scheduler.purge()
+    telegram_resilience.purge()
 
 def cleanup_old_data():
     """تنظيف البيانات القديمة"""
     try:
-        auto_cleanup_days = int(get_setting("auto_cleanup_days", "30"))
+        auto_cleanup_days = settings.current.auto_cleanup_days
         cutoff_date = (datetime.now() - timedelta(days=auto_cleanup_days)).strftime('%Y-%m-%d %H:%M:%S')
         
         conn = db_connect()
@@ -3725,6 +7281,12 @@ def cleanup_old_data():
         cur.execute("DELETE FROM number_patterns WHERE searched_at < ?", (cutoff_date,))
         patterns_deleted = cur.rowcount
         
+        # منشورات الإثباتات المسلّمة
+        cur.execute("DELETE FROM proof_outbox WHERE status = 'sent' AND created_at < ?", (cutoff_date,))
+        
+        # لقطات جمهور الإذاعات المنتهية لم تعد لازمة للاستئناف
+        cur.execute("UPDATE broadcast_progress SET audience_snapshot = NULL WHERE status != 'running' AND audience_snapshot IS NOT NULL")
+        
         conn.commit()
         conn.close()
         
@@ -3734,11 +7296,239 @@ def cleanup_old_data():
     except Exception as e:
         logger.error(f"❌ خطأ في تنظيف البيانات: {e}")
 
+# ================================
+# تتبع عضوية القنوات (chat_member)
+# ================================
+
+@bot.chat_member_handler()
+def handle_chat_member_update(update):
+    """تسجيل انضمام/مغادرة المستخدمين للقنوات الإجبارية"""
+    channel = match_required_channel(update.chat)
+    if not channel:
+        return
+    
+    member = update.new_chat_member
+    status = member.status
+    is_member = status in ['member', 'administrator', 'creator'] or (
+        status == 'restricted' and bool(getattr(member, 'is_member', False))
+    )
+    
+    membership_store.record(channel, member.user.id, is_member, status)
+    logger.info(f"👥 تحديث عضوية {member.user.id} في {channel}: {status}")
+
 # ================================
 # إدارة حالات المشرف
 # ================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "adm_help")
+SEGMENT_HELP_TEXT = """🎯 <b>شرائح الجمهور</b>
+
+<b>الاستخدام:</b> <code>/segment تعبير</code>
+
+<b>الشرائح:</b>
+• <code>all</code> - جميع المستخدمين
+• <code>pro</code> - مشتركو PRO
+• <code>points</code> - لديهم نقاط
+• <code>reachable</code> - لم يحظروا البوت
+• <code>banned</code> - المحظورون
+• <code>active:N</code> - نشطون خلال N يوم
+• <code>invited:K</code> - دعوا K مستخدمين أو أكثر
+• <code>country:ID</code> - اهتموا بالدولة ID
+
+<b>العمليات:</b> <code>&amp;</code> و، <code>|</code> أو، <code>-</code> باستثناء، <code>!</code> نفي، <code>( )</code>
+<b>مثال:</b> <code>/segment pro &amp; active:7 - country:3</code>
+"""
+
+@bot.message_handler(commands=['segment'])
+def handle_segment_preview(message):
+    """معاينة حجم شريحة جمهور (للمشرف)"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        safe_send(message.chat.id, SEGMENT_HELP_TEXT)
+        return
+    
+    expression = parts[1]
+    started = time.time()
+    try:
+        selected, ids = segment_index.select(expression)
+        audience, _ = segment_index.audience(expression)
+    except SegmentExpressionError as e:
+        safe_send(message.chat.id, f"❌ <b>تعبير غير صالح:</b> {html.escape(str(e))}")
+        return
+    elapsed = (time.time() - started) * 1000
+    
+    sample = next(segment_index.iter_batches(audience, ids, 0, 10), [])
+    sample_text = '\n'.join(f"• <code>{user_id}</code>" for user_id in sample) or "• لا يوجد"
+    
+    safe_send(message.chat.id, f"""🎯 <b>معاينة الشريحة</b>
+
+🧮 <b>التعبير:</b> <code>{html.escape(expression)}</code>
+👥 <b>المطابقون:</b> {segment_index.count(selected)}
+📢 <b>قابلون للإذاعة:</b> {segment_index.count(audience)}
+⏱️ <b>زمن الحساب:</b> {elapsed:.1f}ms
+
+🔎 <b>عينة:</b>
+{sample_text}
+""")
+
+SCHEDULE_HELP_TEXT = """🗓️ <b>جدولة الإذاعات</b>
+
+<b>الاستخدام:</b> <code>/schedule رقم_الإعلان [خيارات] [تعبير الجمهور]</code>
+
+<b>الخيارات:</b>
+• <code>at=2025-01-31T03:00</code> أو <code>at=03:00</code> - موعد البدء (الافتراضي الآن)
+• <code>window=2-6</code> - نافذة الإرسال المفضلة بالساعات، يُوزَّع الإرسال عليها
+• <code>every=12</code> - تكرار كل 12 ساعة، أو <code>every=default</code> لفاصل الإعدادات
+
+<b>الإدارة:</b> <code>/schedule list</code> • <code>/schedule cancel رقم</code>
+<b>مثال:</b> <code>/schedule 3 window=2-6 every=default pro | active:7</code>
+"""
+
+SCHEDULE_OPTION_RE = re.compile(r"^(at|window|every)=(\S+)$", re.IGNORECASE)
+
+def parse_schedule_options(tokens: List[str]) -> Tuple[Dict[str, Any], str]:
+    """تحليل خيارات /schedule: (الخيارات، تعبير الجمهور) - ValueError عند خيار غير صالح"""
+    options: Dict[str, Any] = {'run_at': None, 'window': None, 'interval_hours': 0}
+    index = 0
+    while index < len(tokens):
+        match = SCHEDULE_OPTION_RE.match(tokens[index])
+        if not match:
+            break
+        key, value = match.group(1).lower(), match.group(2)
+        if key == 'at':
+            if 'T' in value:
+                options['run_at'] = datetime.strptime(value, '%Y-%m-%dT%H:%M')
+            else:
+                clock = datetime.strptime(value, '%H:%M')
+                run_at = datetime.now().replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+                options['run_at'] = run_at if run_at > datetime.now() else run_at + timedelta(days=1)
+        elif key == 'window':
+            start_hour, end_hour = (int(part) for part in value.split('-', 1))
+            if not (0 <= start_hour < 24 and 0 <= end_hour < 24) or start_hour == end_hour:
+                raise ValueError("نافذة غير صالحة")
+            options['window'] = (start_hour, end_hour)
+        else:
+            hours = settings.current.broadcast_interval if value.lower() == 'default' else int(value)
+            if hours <= 0:
+                raise ValueError("فاصل التكرار يجب أن يكون موجباً")
+            options['interval_hours'] = hours
+        index += 1
+    return options, ' '.join(tokens[index:]) or 'all'
+
+def format_schedule_window(schedule) -> str:
+    if schedule['window_start'] is None:
+        return "فوري"
+    return f"{schedule['window_start']:02d}:00-{schedule['window_end']:02d}:00"
+
+@bot.message_handler(commands=['schedule'])
+def handle_schedule_broadcast(message):
+    """جدولة إذاعة إعلان لمرة واحدة أو بشكل متكرر (للمشرف)"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    tokens = message.text.split()[1:]
+    if not tokens:
+        safe_send(message.chat.id, SCHEDULE_HELP_TEXT)
+        return
+    
+    if tokens[0] == 'list':
+        lines = []
+        for item in get_scheduled_broadcasts():
+            repeat = f" 🔁 كل {item['interval_hours']} ساعة" if item['interval_hours'] else ""
+            lines.append(f"• <b>#{item['id']}</b> {html.escape(item['title'] or str(item['ad_id']))}\n"
+                         f"  ⏰ {item['run_at']} | 🪟 {format_schedule_window(item)} | "
+                         f"👥 {item['audience_count']}{repeat}")
+        safe_send(message.chat.id, "🗓️ <b>الإذاعات المجدولة:</b>\n\n" + ('\n'.join(lines) or "لا يوجد"))
+        return
+    
+    if tokens[0] == 'cancel':
+        if len(tokens) < 2 or not tokens[1].isdigit():
+            safe_send(message.chat.id, SCHEDULE_HELP_TEXT)
+        elif cancel_scheduled_broadcast(int(tokens[1])):
+            safe_send(message.chat.id, f"✅ تم إلغاء الجدولة #{tokens[1]}")
+        else:
+            safe_send(message.chat.id, f"❌ لا توجد جدولة نشطة بالرقم #{tokens[1]}")
+        return
+    
+    if not tokens[0].isdigit():
+        safe_send(message.chat.id, SCHEDULE_HELP_TEXT)
+        return
+    
+    try:
+        options, expression = parse_schedule_options(tokens[1:])
+        segment_index.select(expression)
+    except (ValueError, SegmentExpressionError) as e:
+        safe_send(message.chat.id, f"❌ <b>خيارات غير صالحة:</b> {html.escape(str(e))}")
+        return
+    
+    schedule_id = schedule_broadcast(int(tokens[0]), expression, created_by=message.from_user.id, **options)
+    if not schedule_id:
+        safe_send(message.chat.id, "❌ تعذرت الجدولة - تأكد من أن الإعلان موجود ومفعل")
+        return
+    
+    schedule = next((item for item in get_scheduled_broadcasts(100) if item['id'] == schedule_id), None)
+    if not schedule:
+        return
+    repeat = f"كل {schedule['interval_hours']} ساعة" if schedule['interval_hours'] else "مرة واحدة"
+    safe_send(message.chat.id, f"""✅ <b>تمت جدولة الإذاعة #{schedule_id}</b>
+
+🪧 <b>الإعلان:</b> {html.escape(schedule['title'] or str(schedule['ad_id']))}
+🎯 <b>الجمهور:</b> <code>{html.escape(expression)}</code> ({schedule['audience_count']} مستخدم)
+⏰ <b>الموعد:</b> {schedule['run_at']}
+🪟 <b>النافذة:</b> {format_schedule_window(schedule)}
+🔁 <b>التكرار:</b> {repeat}
+""")
+
+AD_FROM_MESSAGE_HELP = """🪧 <b>إنشاء إعلان من رسالة</b>
+
+أرسل المنشور (نص، صورة، فيديو، GIF أو ملف) إلى البوت، ثم رد عليه بـ:
+<code>/ad عنوان الإعلان</code>
+
+يُنسخ المنشور كما هو لكل مستخدم عبر copyMessage دون إعادة رفع الوسائط.
+"""
+
+def message_media_file_id(message) -> Tuple[Optional[str], Optional[str]]:
+    """(نوع الوسائط، file_id) لرسالة إن كانت من الأنواع المدعومة في الإعلانات"""
+    if message.content_type == 'photo' and message.photo:
+        return 'photo', message.photo[-1].file_id
+    media = getattr(message, message.content_type, None) if message.content_type in AD_MEDIA_SENDERS else None
+    if media is not None:
+        return message.content_type, media.file_id
+    return None, None
+
+@bot.message_handler(commands=['ad'])
+def handle_ad_from_message(message):
+    """إنشاء إعلان يشير إلى رسالة مصدر (للمشرف)"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    source = message.reply_to_message
+    if source is None:
+        safe_send(message.chat.id, AD_FROM_MESSAGE_HELP)
+        return
+    
+    content = source.text or source.caption or ''
+    parts = message.text.split(maxsplit=1)
+    title = parts[1].strip() if len(parts) > 1 else (content.split('\n', 1)[0][:50] or "إعلان وسائط")
+    media_type, file_id = message_media_file_id(source)
+    
+    ad_id = create_advertisement(title, content, message.from_user.id, media_type=media_type, file_id=file_id,
+                                 source_chat_id=source.chat.id, source_message_id=source.message_id)
+    if not ad_id:
+        safe_send(message.chat.id, "❌ تعذر إنشاء الإعلان")
+        return
+    
+    safe_send(message.chat.id, f"""✅ <b>تم إنشاء الإعلان #{ad_id}</b>
+
+📝 <b>العنوان:</b> {html.escape(title)}
+🖼️ <b>النوع:</b> {media_type or 'نص'}
+
+🗓️ للجدولة: <code>/schedule {ad_id} window=2-6</code>
+""")
+
+@callback_router.route("ah", aliases=("adm_help",))
 def cb_admin_help(cq):
     """مساعدة المشرف"""
     if not is_admin(cq.from_user.id):
@@ -3754,45 +7544,779 @@ def cb_admin_help(cq):
 # ================================
 
 def cleanup_user_states():
-    """تنظيف الحالات المؤقتة للمستخدمين"""
-    now = time.time()
-    expired_users = []
+    """تنظيف الحالات المؤقتة للمستخدمين (المنتهية فقط - بلا مسح كامل)"""
+    expired = state_backend.expire()
+    if any(expired.values()):
+        logger.info(f"🧹 تم تنظيف الحالات المؤقتة: {expired['browse']} تصفح، {expired['proof']} إثبات، "
+                    f"{expired['pattern']} بحث، {expired['premium']} أرقام مميزة")
+
+# تسجيل المهام الدورية (البدايات موزعة حتى لا تتزامن الصيانة مع الإقلاع)
+# المهام التي تكتب حالة مشتركة أو ترسل للمستخدمين تعمل في القائد فقط؛ التخزين المحلي لكل عملية
+job_scheduler.add("sessions", "🧹 جلسات المستخدمين", cleanup_user_states, 60, leader_only=True)
+job_scheduler.add("broadcasts", "📅 الإذاعات المجدولة", run_due_schedules, BROADCAST_SCHEDULER_INTERVAL, first_delay=10, leader_only=True)
+# الإذاعات الجارية (بعد إعادة التشغيل، أو بدأها مشرف في عملية تابعة) تُشغل في القائد
+job_scheduler.add("resume", "🔁 الإذاعات الجارية", resume_broadcasts, 30, first_delay=0, leader_only=True)
+job_scheduler.add("pro_expiry", "⭐ انتهاء PRO", pro_expiry_queue.expire_due, PRO_EXPIRY_TICK, first_delay=5, leader_only=True)
+job_scheduler.add("purge", "🗑️ الذاكرة المؤقتة", purge_runtime_state, 3600)
+job_scheduler.add("cleanup", "🗄️ البيانات القديمة", cleanup_old_data, 3600, leader_only=True)
+# شبكة أمان للتحديث التدريجي للشرائح
+job_scheduler.add("segments", "🎯 فهرس الشرائح", segment_index.rebuild, 3600)
+
+# ================================
+# المزامنة بين العمليات (STATE_BACKEND=sqlite)
+# ================================
+
+def reload_user_sets():
+    """إعادة تحميل المحظورين وغير القابلين للوصول ومشتركي PRO بعد تغييرها في عملية أخرى"""
+    cache_manager.load_banned_users()
+    cache_manager.load_unreachable_users()
+    cache_manager.load_pro_users()
+    cache_manager.invalidate_user_cache()
+    pro_expiry_queue.load()
+
+# نطاق لكل مجموعة تخزين محلي: الأحداث التي تغيره، وإبطاله عند تغييره من عملية أخرى
+process_coordinator.watch(event_bus, "settings", SettingChanged)
+process_coordinator.on_change("settings", settings.reload)
+process_coordinator.watch(event_bus, "countries", NumberAdded, NumbersDeleted, CountryChanged)
+process_coordinator.on_change("countries", cache_manager.invalidate_country_cache)
+process_coordinator.watch(event_bus, "channels", ChannelsChanged)
+process_coordinator.on_change("channels", lambda: setattr(cache_manager, 'required_channels_cache', None))
+process_coordinator.watch(event_bus, "users", UserBanChanged, UserReachabilityChanged, UserProChanged, ProExpired)
+process_coordinator.on_change("users", reload_user_sets)
+process_coordinator.watch(event_bus, "points", UserRegistered, UserPointsChanged, UserInvited)
+process_coordinator.on_change("points", cache_manager.invalidate_user_cache)
+process_coordinator.watch(event_bus, "membership", MembershipChanged)
+process_coordinator.on_change("membership", membership_store.refresh)
+# الفهرس يُعاد بناؤه بدل تحديث كل مستخدم (لا نعرف من تغير): الطلبات تندمج في تشغيل كل دقيقة على الأكثر
+for scope in ("users", "points"):
+    process_coordinator.on_change(scope, lambda: job_scheduler.request("segments", 60))
+# إثباتات العمليات التابعة تُنشر من القائد
+process_coordinator.watch(event_bus, "proofs", ProofSubmitted)
+process_coordinator.on_change("proofs", proof_publisher.wakeup.set)
+process_coordinator.on_leadership(lambda: job_scheduler.trigger("resume"))
+process_coordinator.on_leadership(proof_publisher.wakeup.set)
+
+# ================================
+# تسخين التخزين المؤقت عند التشغيل
+# ================================
+
+def warm_up_caches():
+    """تحميل الإعدادات والدول مع الأعداد والمحظورين ومشتركي PRO قبل بدء الاستقبال"""
+    started = time.time()
+    try:
+        settings.reload()
+        countries_count = len(cache_manager.get_country_buttons())
+        banned_count = cache_manager.load_banned_users()
+        cache_manager.load_unreachable_users()
+        pro_count = cache_manager.load_pro_users()
+        
+        members_count = membership_store.load()
+        segment_index.rebuild()
+        
+        logger.info(f"🔥 تم تسخين التخزين المؤقت خلال {time.time() - started:.2f} ثانية: "
+                    f"{countries_count} دولة، {banned_count} محظور، {pro_count} مشترك PRO، {members_count} عضوية")
+    except Exception as e:
+        logger.error(f"❌ خطأ في تسخين التخزين المؤقت: {e}")
+
+def save_cache_snapshot():
+    """حفظ لقطة التخزين المؤقت عند الإيقاف إذا كانت مفعلة"""
+    if CACHE_SNAPSHOT_PATH:
+        cache_manager.dump_snapshot(CACHE_SNAPSHOT_PATH)
+
+# ================================
+# المحرك غير المتزامن (AsyncTeleBot)
+# ================================
+
+# منفذ محدود لعمليات SQLite حتى لا تحجب حلقة الأحداث
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+# منفذ الإرسال: الطلبات تمر عبر bot المتزامن ومنه على OutboundScheduler والقواطع ومجمع الاتصالات
+OUTBOUND_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_OUTBOUND_WORKERS, thread_name_prefix="outbound")
+# منفذ المعالجات المتزامنة: ترسل وتنتظر الشبكة، فلا تحجز منفذ قاعدة البيانات عن المعالجات المنقولة
+FALLBACK_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_FALLBACK_WORKERS, thread_name_prefix="sync-handler")
+# قفل لكل مستخدم: تحديثات المستخدم الواحد تُعالج بالترتيب كما في أجزاء ShardedDispatcher
+ASYNC_USER_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+async_bot = None
+
+async def run_db(func: Callable, *args, **kwargs):
+    """تشغيل دالة متزامنة (قاعدة البيانات/المنطق المشترك) في المنفذ المحدود"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def run_sync_handler(func: Callable, *args, **kwargs):
+    """تشغيل معالج TeleBot متزامن (قاعدة بيانات + إرسال) في منفذ المعالجات"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(FALLBACK_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def run_outbound(func: Callable, *args, **kwargs):
+    """تشغيل طلب Telegram متزامن في منفذ الإرسال (نفس الجدولة والقواطع للمحركين)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(OUTBOUND_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+def async_user_lock(user_id: int) -> asyncio.Lock:
+    """قفل المستخدم (يُحذف تلقائياً عند انتهاء آخر معالج يحمله)"""
+    lock = ASYNC_USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = ASYNC_USER_LOCKS[user_id] = asyncio.Lock()
+    return lock
+
+def per_user(handler: Callable) -> Callable:
+    """تغليف معالج غير متزامن ليعمل بالترتيب لكل مستخدم، بما في ذلك التمرير للمعالجات المتزامنة"""
+    @functools.wraps(handler)
+    async def wrapper(update):
+        user = getattr(update, 'from_user', None)
+        if user is None:
+            return await handler(update)
+        async with async_user_lock(user.id):
+            return await handler(update)
+    return wrapper
+
+async def async_safe_send(user_id: int, text: str, reply_markup: Optional[types.InlineKeyboardMarkup] = None) -> Optional[types.Message]:
+    """إرسال رسالة آمن (غير متزامن)"""
+    return await run_outbound(safe_send, user_id, text, reply_markup=reply_markup)
+
+async def async_safe_edit_message(text: str, chat_id: int, message_id: int, reply_markup: Optional[types.InlineKeyboardMarkup] = None) -> bool:
+    """تحرير رسالة آمن (غير متزامن، يشارك ذاكرة العرض مع المحرك المتزامن)"""
+    return await run_outbound(safe_edit_message, text, chat_id, message_id, reply_markup)
+
+def answer_callback(cq, text: Optional[str] = None, show_alert: bool = False):
+    """الرد على الزر دون إيقاف المعالج عند الفشل"""
+    try:
+        bot.answer_callback_query(cq.id, text, show_alert=show_alert)
+    except Exception as e:
+        logger.warning(f"تعذر الرد على الزر {cq.id}: {e}")
+
+async def async_answer(cq, text: Optional[str] = None, show_alert: bool = False):
+    """الرد على الزر (غير متزامن)"""
+    await run_outbound(answer_callback, cq, text, show_alert)
+
+async def async_get_user_missing_channels(user_id: int) -> List[str]:
+    """نسخة غير متزامنة من get_user_missing_channels تفحص القنوات المجهولة معاً"""
+    required_channels, missing, unknown = await run_db(lookup_known_membership, user_id)
+    if not required_channels:
+        return []
     
-    # تنظيف حالة التصفح
-    for uid, state in BROWSE.items():
-        if now - state.get("timestamp", 0) > 3600:  # ساعة واحدة
-            expired_users.append(uid)
+    if unknown:
+        results = await asyncio.gather(*(run_outbound(probe_channel_membership, user_id, ch) for ch in unknown))
+        await run_db(apply_membership_probes, user_id, unknown, list(results), missing)
     
-    for uid in expired_users:
-        BROWSE.pop(uid, None)
+    return [channel for channel in required_channels if channel in missing]
+
+async def async_reject_user(cq, rate_action: Optional[str] = None) -> bool:
+    """رفض الزر للمحظورين أو عند تجاوز المعدل (True = تم الرفض)"""
+    uid = cq.from_user.id
+    if await run_db(is_user_banned, uid):
+        await async_answer(cq, "❌ تم حظرك من استخدام البوت!", show_alert=True)
+        return True
+    if rate_action and not await run_db(check_rate_limit, uid, rate_action):
+        await async_answer(cq, "⚠️ معدل الطلبات مرتفع! انتظر قليلاً", show_alert=True)
+        return True
+    return False
+
+async def ahandle_start(message):
+    """معالج أمر البدء (غير متزامن)"""
+    user = message.from_user
+    user_id = user.id
     
-    # تنظيف حالات الإثبات
-    expired_proofs = [uid for uid, data in AWAITING_PROOF.items() if now - data.get("timestamp", 0) > 1800]  # 30 دقيقة
-    for uid in expired_proofs:
-        AWAITING_PROOF.pop(uid, None)
+    if await run_db(is_user_banned, user_id):
+        await async_safe_send(user_id, "❌ <b>تم حظرك من استخدام البوت!</b>\n\nتواصل مع المشرف للمزيد من المعلومات.")
+        return
     
-    # تنظيف حالات البحث
-    expired_patterns = [uid for uid, data in AWAITING_NUMBER_PATTERN.items() if now - data.get("timestamp", 0) > 900]  # 15 دقيقة
-    for uid in expired_patterns:
-        AWAITING_NUMBER_PATTERN.pop(uid, None)
+    await run_db(register_start, user, message.text)
+    markup = await run_db(main_menu_keyboard, user_id)
     
-    # تنظيف حالات الأرقام المميزة
-    expired_premium = [uid for uid, data in AWAITING_PREMIUM_FILTER.items() if now - data.get("timestamp", 0) > 1800]  # 30 دقيقة
-    for uid in expired_premium:
-        AWAITING_PREMIUM_FILTER.pop(uid, None)
+    if not await async_safe_send(user_id, WELCOME_TEXT, reply_markup=markup):
+        await async_safe_send(user_id, "🎉 مرحباً بك في بوت أرقام مجانية!\n\nاستخدم الأزرار للتفاعل.", reply_markup=markup)
     
-    if any([expired_users, expired_proofs, expired_patterns, expired_premium]):
-        logger.info(f"🧹 تم تنظيف الحالات المؤقتة: {len(expired_users)} تصفح، {len(expired_proofs)} إثبات، {len(expired_patterns)} بحث، {len(expired_premium)} أرقام مميزة")
+    await run_db(insert_log, user_id, "start", f"username={user.username}")
 
-def user_states_cleanup_worker():
-    """خيط عمل تنظيف الحالات المؤقتة"""
-    while True:
+async def ahandle_help(message):
+    """معالج أمر المساعدة (غير متزامن)"""
+    user_id = message.from_user.id
+    
+    if await run_db(is_user_banned, user_id):
+        await async_safe_send(user_id, "❌ تم حظرك من استخدام البوت!")
+        return
+    
+    await run_db(add_user_if_not_exists, message.from_user)
+    await async_safe_send(user_id, build_help_text(), reply_markup=back_main_keyboard())
+
+async def acb_help_info(cq):
+    """عرض المساعدة (غير متزامن)"""
+    await asyncio.gather(
+        async_safe_edit_message(build_help_text(), cq.message.chat.id, cq.message.message_id, back_main_keyboard()),
+        async_answer(cq)
+    )
+
+async def acb_back_main(cq):
+    """العودة للقائمة الرئيسية (غير متزامن)"""
+    uid = cq.from_user.id
+    if await async_reject_user(cq):
+        return
+    
+    await run_db(clear_pending_inputs, uid)
+    
+    markup = await run_db(main_menu_keyboard, uid)
+    await asyncio.gather(
+        async_safe_edit_message(MAIN_MENU_TEXT, cq.message.chat.id, cq.message.message_id, markup),
+        async_answer(cq)
+    )
+
+async def acb_get_number(cq):
+    """اختيار الدولة (غير متزامن)"""
+    uid = cq.from_user.id
+    if await async_reject_user(cq, rate_action="number"):
+        return
+    
+    markup = await run_db(build_countries_markup)
+    if markup is None:
+        await async_answer(cq, "❌ لا توجد دول متاحة حالياً!", show_alert=True)
+        return
+    
+    answered = asyncio.ensure_future(async_answer(cq))
+    if not await async_safe_edit_message(COUNTRIES_TEXT, cq.message.chat.id, cq.message.message_id, markup):
+        await async_safe_send(uid, COUNTRIES_TEXT, reply_markup=markup)
+    await answered
+
+async def async_show_number(cq, country_id: int, chat_id: int, message_id: int, new_session: bool) -> Optional[Tuple[Dict, bool]]:
+    """جلب رقم عشوائي وعرضه في الرسالة ((الرقم، PRO) أو None)"""
+    uid = cq.from_user.id
+    is_pro = await run_db(is_user_pro, uid)
+    num_row = await run_db(get_random_number_for_country, country_id, prefer_premium=is_pro)
+    if not num_row:
+        await async_answer(cq, "❌ لا توجد أرقام متاحة لهذه الدولة!", show_alert=True)
+        return None
+    
+    country = await run_db(get_country_by_id, country_id)
+    if not country:
+        await async_answer(cq, "❌ الدولة غير موجودة!", show_alert=True)
+        return None
+    
+    activation_channel = await run_db(resolve_activation_channel, country_id)
+    text, markup = build_number_view(country, num_row, is_pro, activation_channel)
+    
+    # تحديث حالة التصفح (مخزن الحالة قد يكون SQLite فيمر عبر المنفذ)
+    if new_session or not await run_db(BROWSE.patch, uid, last_number_id=num_row["id"], timestamp=time.time()):
+        await run_db(BROWSE.update, {uid: {"country_id": country_id, "last_msg": (chat_id, message_id),
+                                           "last_number_id": num_row["id"], "timestamp": time.time()}})
+    
+    answered = asyncio.ensure_future(async_answer(cq))
+    if not await async_safe_edit_message(text, chat_id, message_id, markup):
+        sent = await async_safe_send(uid, text, reply_markup=markup)
+        if sent:
+            await run_db(BROWSE.patch, uid, last_msg=(sent.chat.id, sent.message_id))
+    await answered
+    return num_row, is_pro
+
+async def acb_country_selected(cq, country_id: int):
+    """اختيار الدولة وعرض الرقم (غير متزامن)"""
+    uid = cq.from_user.id
+    if await async_reject_user(cq, rate_action="number"):
+        return
+    
+    missing_channels = await async_get_user_missing_channels(uid)
+    if missing_channels:
+        text, markup = build_join_required_view(missing_channels, country_id)
+        await asyncio.gather(async_safe_send(uid, text, reply_markup=markup), async_answer(cq))
+        return
+    
+    shown = await async_show_number(cq, country_id, cq.message.chat.id, cq.message.message_id, new_session=True)
+    if shown:
+        num_row, is_pro = shown
+        await run_db(record_country_interest, uid, country_id)
+        await run_db(insert_log, uid, "view_number", f"country_id={country_id} number_id={num_row['id']} pro={is_pro} premium={num_row.get('is_premium', 0)}")
+
+async def acb_change_random(cq):
+    """تغيير الرقم عشوائياً (غير متزامن)"""
+    uid = cq.from_user.id
+    if await async_reject_user(cq, rate_action="change"):
+        return
+    
+    user_state = await run_db(BROWSE.get, uid)
+    if not user_state:
+        await async_answer(cq, "❌ جلسة منتهية! اختر الدولة مرة أخرى.", show_alert=True)
+        return
+    
+    country_id = user_state["country_id"]
+    chat_id, message_id = user_state["last_msg"]
+    shown = await async_show_number(cq, country_id, chat_id, message_id, new_session=False)
+    if shown:
+        num_row, is_pro = shown
+        await run_db(insert_log, uid, "change_number", f"country_id={country_id} number_id={num_row['id']} pro={is_pro} premium={num_row.get('is_premium', 0)}")
+
+async def acb_my_points(cq):
+    """عرض نقاط المستخدم (غير متزامن)"""
+    if await async_reject_user(cq):
+        return
+    
+    text, markup = await run_db(build_points_view, cq.from_user.id)
+    await asyncio.gather(
+        async_safe_edit_message(text, cq.message.chat.id, cq.message.message_id, markup),
+        async_answer(cq)
+    )
+
+async def acb_daily_bonus(cq):
+    """استلام المكافأة اليومية (غير متزامن)"""
+    uid = cq.from_user.id
+    if await async_reject_user(cq):
+        return
+    
+    if not await run_db(can_claim_daily_bonus, uid):
+        await async_answer(cq, "❌ لقد استلمت الهدية اليومية مسبقاً!")
+        return
+    
+    if await run_db(claim_daily_bonus, uid):
+        daily_points = settings.current.daily_bonus_points
+        points = await run_db(get_user_points, uid)
+        await asyncio.gather(
+            async_answer(cq, f"🎁 تم استلام الهدية اليومية بنجاح! +{daily_points} نقاط"),
+            async_safe_send(uid, build_daily_bonus_text(daily_points, points))
+        )
+    else:
+        await async_answer(cq, "❌ خطأ في استلام الهدية!")
+
+async def afallback_message(message):
+    """تمرير الرسائل غير المنقولة لمعالجات TeleBot المتزامنة في المنفذ"""
+    await run_sync_handler(bot.process_new_messages, [message])
+
+# الأزرار المنقولة للمحرك غير المتزامن (حسب رمز موجه الأزرار)
+ASYNC_CALLBACK_ROUTES = {
+    "h": acb_help_info,
+    "m": acb_back_main,
+    "gn": acb_get_number,
+    "c": acb_country_selected,
+    "cr": acb_change_random,
+    "mp": acb_my_points,
+    "db": acb_daily_bonus,
+}
+
+async def adispatch_callback(cq):
+    """توجيه الأزرار بنفس جدول المحرك المتزامن، وتمرير غير المنقولة (لوحة التحكم وغيرها) لمعالجاتها المتزامنة"""
+    route = callback_router.resolve(cq.data)
+    handler = ASYNC_CALLBACK_ROUTES.get(route[0]) if route else None
+    if handler is None:
+        await run_sync_handler(callback_router.dispatch, cq)
+        return
+    await handler(cq, *route[1])
+
+async def afallback_chat_member(update):
+    """تحديثات العضوية تمر على نفس معالج المحرك المتزامن"""
+    await run_db(handle_chat_member_update, update)
+
+def create_async_bot():
+    """إنشاء AsyncTeleBot وتسجيل المعالجات (المنقولة أولاً ثم التمرير للمتزامنة)"""
+    global async_bot
+    try:
+        from telebot.async_telebot import AsyncTeleBot
+    except ImportError as e:
+        raise RuntimeError(f"المحرك غير المتزامن يتطلب aiohttp: {e}")
+    
+    class ReachabilityAsyncTeleBot(AsyncTeleBot):
+        """إعادة تفعيل المستخدمين غير القابلين للوصول عند تفاعلهم"""
+        
+        async def process_new_updates(self, updates):
+            for update in updates:
+                user_id = interaction_user_id(update)
+                if user_id is None:
+                    continue
+                segment_index.touch(user_id)
+                if is_user_marked_unreachable(user_id):
+                    await run_db(mark_user_reachable, user_id)
+            await super().process_new_updates(updates)
+    
+    async_bot = ReachabilityAsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+    
+    async_bot.register_message_handler(per_user(ahandle_start), commands=['start'])
+    async_bot.register_message_handler(per_user(ahandle_help), commands=['help'])
+    async_bot.register_message_handler(per_user(afallback_message), func=lambda m: True, content_types=telebot.util.content_type_media)
+    async_bot.register_callback_query_handler(per_user(adispatch_callback), func=lambda c: True)
+    async_bot.register_chat_member_handler(per_user(afallback_chat_member))
+    return async_bot
+
+async def serve_async_webhook():
+    """استقبال Webhook للمحرك غير المتزامن: الخادم في خيط والمعالجة في حلقة الأحداث"""
+    loop = asyncio.get_running_loop()
+    # حد التحديثات الجارية: يُحجز في خيط HTTP ويُحرر بعد انتهاء معالجاتها في الحلقة
+    inflight = threading.BoundedSemaphore(max(1, ASYNC_WEBHOOK_INFLIGHT))
+    
+    async def process(update):
+        try:
+            await async_bot.process_new_updates([update])
+        finally:
+            inflight.release()
+    
+    def sink(update) -> bool:
+        if not inflight.acquire(timeout=DISPATCH_SUBMIT_TIMEOUT):
+            return False
+        asyncio.run_coroutine_threadsafe(process(update), loop)
+        return True
+    
+    server = create_webhook_server(sink)
+    if process_coordinator.is_leader:
+        await async_bot.set_webhook(
+            url=webhook_public_url(),
+            secret_token=get_webhook_secret(),
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    logger.info(f"🌐 خادم Webhook يستمع على {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await loop.run_in_executor(None, server.shutdown)
+        server.server_close()
+
+async def serve_async_polling():
+    """getUpdates للمحرك غير المتزامن من العملية القائدة فقط (غيرها تنتظر توليها القيادة)"""
+    while not process_coordinator.is_leader:
+        await asyncio.sleep(process_coordinator.interval)
+    await async_bot.infinity_polling(timeout=60, request_timeout=90, allowed_updates=ALLOWED_UPDATES)
+
+async def run_async_engine():
+    """تشغيل البوت على AsyncTeleBot"""
+    create_async_bot()
+    if BOT_MODE == "webhook":
+        receiving = asyncio.ensure_future(serve_async_webhook())
+    else:
+        await async_bot.remove_webhook()
+        receiving = asyncio.ensure_future(serve_async_polling())
+    # SIGTERM يلغي مهمة الاستقبال لتكتمل خطوات الإيقاف وحفظ اللقطة
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, receiving.cancel)
+    try:
+        await receiving
+    except asyncio.CancelledError:
+        logger.info("⏹️ تم إيقاف المحرك غير المتزامن")
+    finally:
+        await async_bot.close_session()
+        OUTBOUND_EXECUTOR.shutdown(wait=False)
+        FALLBACK_EXECUTOR.shutdown(wait=False)
+        DB_EXECUTOR.shutdown(wait=False)
+
+# ================================
+# استقبال التحديثات عبر Long Polling
+# ================================
+
+def get_runtime_state(key: str) -> Optional[str]:
+    """قراءة قيمة من حالة التشغيل المستمرة"""
+    conn = db_connect()
+    if conn is None:
+        return None
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT value FROM runtime_state WHERE key = ?", (key,))
+        row = cur.fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"خطأ في قراءة حالة التشغيل {key}: {e}")
+        return None
+    finally:
+        conn.close()
+
+def set_runtime_state(key: str, value: str) -> bool:
+    """حفظ قيمة في حالة التشغيل المستمرة"""
+    conn = db_connect()
+    if conn is None:
+        return False
+    
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO runtime_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        """, (key, value))
+        conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"خطأ في حفظ حالة التشغيل {key}: {e}")
+        return False
+    finally:
+        conn.close()
+
+def prefetch_batch_users(updates) -> int:
+    """تحميل نقاط وحالة PRO لكل مستخدمي الدفعة باستعلام واحد إلى التخزين المؤقت"""
+    user_ids = {user_id for user_id in map(interaction_user_id, updates) if user_id is not None}
+    if not user_ids:
+        return 0
+    
+    conn = db_connect()
+    if conn is None:
+        return 0
+    
+    cur = conn.cursor()
+    try:
+        placeholders = ','.join('?' * len(user_ids))
+        cur.execute(f"SELECT id, points, is_pro, pro_expiry FROM users WHERE id IN ({placeholders})", tuple(user_ids))
+        rows = cur.fetchall()
+    except Exception as e:
+        logger.error(f"خطأ في تحميل مستخدمي الدفعة: {e}")
+        return 0
+    finally:
+        conn.close()
+    
+    now = time.time()
+    for row in rows:
+        cache_manager.user_stats_cache[row['id']] = {
+            'points': row['points'] or 0,
+            'is_pro': bool(row['is_pro']),
+            'pro_expiry': parse_db_timestamp(row['pro_expiry']),
+            'cache_time': now
+        }
+    return len(rows)
+
+class UpdatePoller:
+    """حلقة getUpdates: allowed_updates، معالجة كل دفعة كوحدة، وحفظ offset بعد اكتمالها"""
+    
+    OFFSET_KEY = "update_offset"
+    MAX_BACKOFF = 60
+    
+    def __init__(self, telebot_instance: DispatchingTeleBot, timeout: int, limit: int, drain_timeout: float):
+        self.bot = telebot_instance
+        self.timeout = timeout
+        self.limit = limit
+        self.drain_timeout = drain_timeout
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {'polls': 0, 'batches': 0, 'updates': 0, 'max_batch': 0, 'prefetched': 0,
+                      'total_drain': 0.0, 'errors': 0, 'offset': None}
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def run(self):
+        """الاستقبال حتى stop(): offset يُستأنف من قاعدة البيانات، وتأكيد الدفعة فقط بعد معالجتها
+        
+        getUpdates يقبل مستقبلاً واحداً (409)، لذا تستقبل العملية القائدة فقط وتنتظر غيرها احتياطاً.
+        """
+        offset = None
+        receiving = False
+        failures = 0
+        
+        while not self.stop_event.is_set():
+            if not process_coordinator.is_leader:
+                if receiving:
+                    logger.warning("⏸️ إيقاف getUpdates: القيادة انتقلت لعملية أخرى")
+                    receiving = False
+                self.stop_event.wait(process_coordinator.interval)
+                continue
+            if not receiving:
+                # القائد السابق ربما تقدم في offset
+                stored = get_runtime_state(self.OFFSET_KEY)
+                offset = int(stored) if stored else None
+                receiving = True
+                logger.info(f"📡 بدء الاستقبال عبر getUpdates من offset={offset} ({', '.join(ALLOWED_UPDATES)})")
+            
+            try:
+                updates = self.bot.get_updates(offset=offset, limit=self.limit, timeout=self.timeout + 10,
+                                               allowed_updates=ALLOWED_UPDATES, long_polling_timeout=self.timeout)
+            except Exception as e:
+                failures += 1
+                with self.lock:
+                    self.stats['errors'] += 1
+                if isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code == 409:
+                    # Webhook مسجل أو نسخة أخرى تستقبل التحديثات
+                    logger.error("❌ تعارض getUpdates (409): إزالة Webhook وإعادة المحاولة")
+                    self.bot.remove_webhook()
+                delay = min(self.MAX_BACKOFF, 2 ** failures) * random.uniform(0.5, 1.0)
+                logger.warning(f"⚠️ فشل getUpdates ({e}) - إعادة المحاولة بعد {delay:.1f} ثانية")
+                self.stop_event.wait(delay)
+                continue
+            
+            failures = 0
+            with self.lock:
+                self.stats['polls'] += 1
+            if not updates:
+                continue
+            
+            self.process_batch(updates)
+            # طلب offset التالي يؤكد الدفعة لدى Telegram، لذا يُحفظ بعد اكتمال معالجتها فقط
+            offset = updates[-1].update_id + 1
+            set_runtime_state(self.OFFSET_KEY, str(offset))
+            with self.lock:
+                self.stats['offset'] = offset
+    
+    def process_batch(self, updates):
+        """تحميل مشترك للدفعة، توزيعها على الأجزاء، ثم انتظار اكتمالها
+        
+        لا يعود قبل اكتمال الدفعة: offset يُحفظ بعده، وتأكيد تحديثات لم تُعالج يُسقطها عند إعادة التشغيل.
+        """
+        prefetched = prefetch_batch_users(updates)
+        self.bot.process_new_updates(updates)
+        started = time.time()
+        while not self.bot.dispatcher.wait_idle(self.drain_timeout):
+            logger.warning(f"⚠️ دفعة من {len(updates)} تحديث لم تكتمل بعد {time.time() - started:.0f} ثانية - "
+                           f"الاستمرار في الانتظار قبل تأكيد offset")
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['updates'] += len(updates)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(updates))
+            self.stats['prefetched'] += prefetched
+            self.stats['total_drain'] += time.time() - started
+    
+    def stats_snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            snapshot = dict(self.stats)
+        batches = snapshot['batches'] or 1
+        snapshot['avg_batch'] = snapshot['updates'] / batches
+        snapshot['avg_drain'] = snapshot['total_drain'] / batches
+        return snapshot
+
+update_poller = UpdatePoller(bot, POLL_TIMEOUT, POLL_LIMIT, POLL_DRAIN_TIMEOUT)
+
+# ================================
+# استقبال التحديثات عبر Webhook
+# ================================
+
+# شبكات خوادم Telegram التي ترسل طلبات Webhook
+TELEGRAM_WEBHOOK_NETWORKS = [ipaddress.ip_network("149.154.160.0/20"), ipaddress.ip_network("91.108.4.0/22")]
+# الحد الأقصى لحجم طلب التحديث (بايت)
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+WEBHOOK_STATS = {'received': 0, 'rejected': 0, 'invalid': 0, 'overloaded': 0, 'total_ingest': 0.0}
+WEBHOOK_STATS_LOCK = threading.Lock()
+
+def get_webhook_secret() -> str:
+    """الرمز السري لـ Webhook (مشتق من التوكن إذا لم يُحدد)"""
+    return WEBHOOK_SECRET or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+
+def record_webhook_stat(key: str, ingest_time: float = 0.0):
+    """تحديث إحصائيات Webhook"""
+    with WEBHOOK_STATS_LOCK:
+        WEBHOOK_STATS[key] += 1
+        WEBHOOK_STATS['total_ingest'] += ingest_time
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """استقبال تحديثات Telegram: تحقق، رد فوري، ثم تمرير التحديث للموزع"""
+    
+    # HTTP/1.1 لإبقاء اتصالات Telegram/الوكيل مفتوحة بين التحديثات
+    protocol_version = "HTTP/1.1"
+    server_version = "FreeNumbersBot"
+    sys_version = ""
+    
+    def client_ip(self) -> str:
+        """عنوان العميل الحقيقي كما سجله الوكيل الموثوق
+        
+        X-Real-IP يضعه الوكيل نفسه، وفي X-Forwarded-For يُعتد بآخر عنصر (أضافه الوكيل)
+        لأن ما قبله يرسله العميل ويمكن تزويره.
+        """
+        if WEBHOOK_TRUST_PROXY:
+            real_ip = self.headers.get('X-Real-IP')
+            if real_ip:
+                return real_ip.strip()
+            forwarded = self.headers.get('X-Forwarded-For')
+            if forwarded:
+                return forwarded.split(',')[-1].strip()
+        return self.client_address[0]
+    
+    def is_allowed_source(self) -> bool:
+        """التحقق من أن الطلب قادم من شبكات Telegram (إذا كان الفحص مفعلاً)"""
+        if not WEBHOOK_CHECK_SOURCE_IP:
+            return True
+        try:
+            address = ipaddress.ip_address(self.client_ip())
+        except ValueError:
+            return False
+        return any(address in network for network in TELEGRAM_WEBHOOK_NETWORKS)
+    
+    def reply(self, status: int):
+        """رد فارغ مع الإبقاء على الاتصال (يُغلق عند الخطأ لأن الجسم لم يُقرأ)"""
+        if status != 200:
+            self.close_connection = True
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+    
+    def do_POST(self):
+        started = time.time()
+        if self.path.split('?')[0] != WEBHOOK_PATH:
+            self.reply(404)
+            return
+        
+        # مقارنة بايتات: compare_digest يرفض النصوص غير ASCII (ترويسة مزورة) بخطأ بدل 403
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode('latin-1', 'replace')
+        if not hmac.compare_digest(secret, self.server.secret.encode()) or not self.is_allowed_source():
+            record_webhook_stat('rejected')
+            logger.warning(f"🚫 طلب Webhook مرفوض من {self.client_ip()}")
+            self.reply(403)
+            return
+        
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            record_webhook_stat('invalid')
+            self.reply(400)
+            return
+        
+        body = self.rfile.read(length)
         try:
-            cleanup_user_states()
-            time.sleep(300)  # كل 5 دقائق
+            update = types.Update.de_json(body.decode('utf-8'))
         except Exception as e:
-            logger.error(f"❌ خطأ في خيط تنظيف الحالات: {e}")
-            time.sleep(300)
+            # 200 حتى لا يعيد Telegram إرسال تحديث تالف
+            self.reply(200)
+            record_webhook_stat('invalid')
+            logger.error(f"❌ تحديث Webhook غير صالح: {e}")
+            return
+        
+        # الرد بعد الإدراج في الطابور فقط (وليس بعد المعالجة): 503 يجعل Telegram يعيد المحاولة
+        if not self.server.sink(update):
+            record_webhook_stat('overloaded')
+            self.reply(503)
+            return
+        self.reply(200)
+        record_webhook_stat('received', time.time() - started)
+    
+    def do_GET(self):
+        # فحص الصحة من الوكيل
+        self.reply(200 if self.path == '/healthz' else 404)
+    
+    def log_message(self, format, *args):
+        # سجلات الوصول معطلة لتقليل الضغط على الملف
+        pass
+
+def create_webhook_server(sink: Callable[[Any], bool]) -> ThreadingHTTPServer:
+    """إنشاء خادم HTTP المحلي لاستقبال التحديثات (sink يعيد False عند الازدحام)"""
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookRequestHandler, bind_and_activate=False)
+    server.allow_reuse_port = WEBHOOK_REUSE_PORT
+    try:
+        server.server_bind()
+        server.server_activate()
+    except OSError:
+        server.server_close()
+        raise
+    server.daemon_threads = True
+    server.sink = sink
+    server.secret = get_webhook_secret()
+    return server
+
+def webhook_public_url() -> str:
+    """الرابط العام الذي يصل إليه Telegram عبر الوكيل"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("وضع Webhook يتطلب WEBHOOK_URL")
+    return WEBHOOK_URL + WEBHOOK_PATH
+
+def run_webhook():
+    """تشغيل المحرك المتزامن على Webhook: التحديثات تذهب مباشرة لموزع الأجزاء"""
+    server = create_webhook_server(bot.enqueue_update)
+    # التسجيل مرة واحدة من القائد (العمليات الأخرى تشاركه المنفذ عبر WEBHOOK_REUSE_PORT)
+    if process_coordinator.is_leader:
+        bot.set_webhook(
+            url=webhook_public_url(),
+            secret_token=get_webhook_secret(),
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    # shutdown يجب أن يُستدعى من خيط آخر غير خيط serve_forever
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown, daemon=True).start())
+    logger.info(f"🌐 خادم Webhook يستمع على {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 # ================================
 # الدالة الرئيسية
@@ -3806,26 +8330,54 @@ def main():
         # تهيئة قاعدة البيانات
         init_db()
         
+        # انتخاب القائد وحفظ أجيال التخزين قبل التسخين (مع المخزن المشترك فقط)
+        process_coordinator.tick()
+        
+        # تسخين التخزين المؤقت (من اللقطة المحفوظة إن وجدت ثم تحديثها في الخلفية)
+        if CACHE_SNAPSHOT_PATH and cache_manager.load_snapshot(CACHE_SNAPSHOT_PATH, CACHE_SNAPSHOT_MAX_AGE):
+            settings.reload()
+            threading.Thread(target=warm_up_caches, daemon=True).start()
+        else:
+            warm_up_caches()
+        
+        # إيقاف الاستقبال بشكل نظيف عند SIGTERM لحفظ اللقطة
+        signal.signal(signal.SIGTERM, lambda signum, frame: update_poller.stop())
+        
         # بدء خيوط العمل
-        pro_worker_thread = threading.Thread(target=pro_expiry_worker, daemon=True)
-        cleanup_worker_thread = threading.Thread(target=cleanup_worker, daemon=True)
-        user_states_worker_thread = threading.Thread(target=user_states_cleanup_worker, daemon=True)
+        job_scheduler_thread = threading.Thread(target=job_scheduler.run, name="job-scheduler", daemon=True)
+        proof_publisher_thread = threading.Thread(target=proof_publisher.run, name="proof-outbox", daemon=True)
         
-        pro_worker_thread.start()
-        cleanup_worker_thread.start()
-        user_states_worker_thread.start()
+        job_scheduler_thread.start()
+        proof_publisher_thread.start()
+        if state_backend.shared:
+            threading.Thread(target=process_coordinator.run, name="process-coordinator", daemon=True).start()
+        
+        # الإذاعات المقطوعة بإعادة التشغيل تستأنفها مهمة resume في القائد
+        update_dispatcher.start()
         
         logger.info("✅ تم بدء خيوط العمل بنجاح")
         
         # بدء استماع البوت
-        logger.info("🤖 البوت يعمل الآن وجاهز لاستقبال الرسائل...")
-        bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        logger.info(f"🤖 البوت يعمل الآن وجاهز لاستقبال الرسائل (المحرك: {BOT_ENGINE}، الاستقبال: {BOT_MODE})...")
+        if BOT_ENGINE == "async":
+            asyncio.run(run_async_engine())
+        elif BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            # getUpdates لا يعمل مع Webhook مسجل مسبقاً
+            bot.remove_webhook()
+            update_poller.run()
         
     except KeyboardInterrupt:
         logger.info("⏹️ تم إيقاف البوت بواسطة المستخدم")
     except Exception as e:
         logger.error(f"💥 خطأ حرج في تشغيل البوت: {e}")
         raise
+    finally:
+        # إكمال التحديثات المستلمة قبل حفظ اللقطة
+        update_dispatcher.stop()
+        process_coordinator.stop()
+        save_cache_snapshot()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
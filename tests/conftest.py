@@ -0,0 +1,12 @@
+"""إعداد بيئة الاختبار قبل استيراد bot (التوكن ومسار قاعدة بيانات مؤقتة)"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "test.db"))
+os.environ.setdefault("STATE_BACKEND", "memory")
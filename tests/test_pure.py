@@ -0,0 +1,185 @@
+"""اختبارات الأجزاء الحتمية التي لا تحتاج Telegram ولا قاعدة بيانات"""
+
+import pytest
+
+import bot
+
+
+# ================================
+# تعبيرات شرائح الجمهور
+# ================================
+
+@pytest.fixture
+def index():
+    """فهرس شرائح مبني يدوياً: المعرفات 10، 20، 30، 40 بالترتيب"""
+    segments = bot.SegmentIndex()
+    segments.ids = bot.SegmentIds([10, 20, 30, 40], 4)
+    segments.ordinals = {10: 0, 20: 1, 30: 2, 40: 3}
+    segments.flags = {
+        'banned': 0b1000,     # 40
+        'pro': 0b0011,        # 10، 20
+        'points': 0b0110,     # 20، 30
+        'reachable': 0b0111,  # 10، 20، 30
+    }
+    segments.countries = {3: 0b0101}  # 10، 30
+    segments.last_active = [0.0] * 4
+    segments.invites = [0, 2, 5, 0]
+    segments.built_at = 1.0
+    return segments
+
+def selected(index, expression):
+    bitmap, ids = index.select(expression)
+    return {user_id for position, user_id in enumerate(ids) if bitmap >> position & 1}
+
+@pytest.mark.parametrize("expression, expected", [
+    ("pro", {10, 20}),
+    ("all", {10, 20, 30, 40}),
+    # & أقوى من |
+    ("banned | pro & points", {20, 40}),
+    ("(banned | pro) & points", {20}),
+    # - و & بنفس الأولوية ومن اليسار
+    ("all - pro & points", {30}),
+    ("all - (pro & points)", {10, 30, 40}),
+    # النفي أقوى من الثنائيات
+    ("!pro & reachable", {30}),
+    ("not pro or banned", {30, 40}),
+    ("country:3 - pro", {30}),
+    ("invited:2", {20, 30}),
+    ("PRO AND Points", {20}),
+])
+def test_segment_precedence(index, expression, expected):
+    assert selected(index, expression) == expected
+
+@pytest.mark.parametrize("expression", [
+    "(pro",
+    "- pro",
+    "pro)",
+    "pro &",
+    "",
+    "   ",
+    "unknown",
+    "pro:3",
+    "pro $ points",
+    "()",
+])
+def test_segment_invalid_expression(index, expression):
+    with pytest.raises(bot.SegmentExpressionError):
+        index.select(expression)
+
+def test_segment_audience_excludes_banned_and_unreachable(index):
+    bitmap, ids = index.audience("all")
+    assert {user_id for position, user_id in enumerate(ids) if bitmap >> position & 1} == {10, 20, 30}
+
+
+# ================================
+# لقطات المعرفات المضغوطة
+# ================================
+
+@pytest.mark.parametrize("user_ids", [
+    [],
+    [1],
+    [5, 6, 7, 127, 128, 129],
+    [100, 16_384, 2_097_152, 7_000_000_000],
+    list(range(1, 5000, 3)),
+])
+def test_pack_unpack_round_trip(user_ids):
+    assert bot.unpack_user_ids(bot.pack_user_ids(user_ids)) == user_ids
+
+
+# ================================
+# محدد المعدل GCRA
+# ================================
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ساعة monotonic يتحكم بها الاختبار"""
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    return now
+
+def test_rate_budget_of():
+    budget = bot.RateBudget.of(5, 60)
+    assert budget.interval == 12
+    assert budget.tolerance == 48
+    assert budget.window == 60
+
+def test_rate_budget_parse_falls_back_to_default():
+    assert bot.RateBudget.parse("3/30", "1/1") == bot.RateBudget.of(3, 30)
+    assert bot.RateBudget.parse("bogus", "5/60") == bot.RateBudget.of(5, 60)
+
+def test_gcra_burst_then_deny(clock):
+    limiter = bot.GCRALimiter(bot.MemoryStateBackend())
+    limiter.configure("change", bot.RateBudget.of(3, 30))
+    assert [limiter.allow(7, "change") for _ in range(4)] == [True, True, True, False]
+    # مستخدم آخر وإجراء آخر لا يتأثران
+    assert limiter.allow(8, "change")
+    limiter.configure("search", bot.RateBudget.of(1, 30))
+    assert limiter.allow(7, "search")
+    assert limiter.stats_snapshot()['denied'] == 1
+
+def test_gcra_refills_one_interval_at_a_time(clock):
+    limiter = bot.GCRALimiter(bot.MemoryStateBackend())
+    limiter.configure("change", bot.RateBudget.of(3, 30))
+    for _ in range(3):
+        assert limiter.allow(7, "change")
+    clock[0] += 9.9
+    assert not limiter.allow(7, "change")
+    clock[0] += 0.1
+    assert limiter.allow(7, "change")
+    assert not limiter.allow(7, "change")
+    # بعد نافذة كاملة تعود الدفعة كاملة
+    clock[0] += 30
+    assert [limiter.allow(7, "change") for _ in range(4)] == [True, True, True, False]
+
+def test_gcra_survives_generation_rotation(clock):
+    limiter = bot.GCRALimiter(bot.MemoryStateBackend(stripes=1))
+    limiter.configure("change", bot.RateBudget.of(3, 60))
+    clock[0] += 50
+    assert [limiter.allow(7, "change") for _ in range(4)] == [True, True, True, False]
+    # تبديل الجيل في منتصف النافذة لا يمسح وقت الوصول النظري الحالي
+    clock[0] += 10
+    assert not limiter.allow(7, "change")
+    clock[0] += 10
+    assert limiter.allow(7, "change")
+
+
+# ================================
+# موجه أزرار Callback
+# ================================
+
+@pytest.mark.parametrize("data, expected", [
+    ("m", ("m", ())),
+    ("back_main", ("m", ())),
+    ("c:12", ("c", (12,))),
+    ("country:12", ("c", (12,))),
+    ("pm:3:gold", ("pm", (3, "gold"))),
+    ("premium_type:3:gold", ("pm", (3, "gold"))),
+])
+def test_callback_resolve(data, expected):
+    assert bot.callback_router.resolve(data) == expected
+
+@pytest.mark.parametrize("data", [
+    None,
+    "",
+    "nope",
+    "c",
+    "c:abc",
+    "c:1:2",
+    "m:extra",
+    "country:",
+    "pm:x:gold",
+])
+def test_callback_resolve_rejects_bad_data(data):
+    assert bot.callback_router.resolve(data) is None
+
+def test_callback_legacy_counter():
+    before = bot.callback_router.stats_snapshot()['legacy']
+    bot.callback_router.resolve("back_main")
+    bot.callback_router.resolve("m")
+    assert bot.callback_router.stats_snapshot()['legacy'] == before + 1
+
+def test_callback_duplicate_code_rejected():
+    router = bot.CallbackRouter()
+    router.route("x", aliases=("old_x",))(lambda cq: None)
+    with pytest.raises(ValueError):
+        router.route("old_x")(lambda cq: None)